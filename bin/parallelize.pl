@@ -39,6 +39,7 @@ use warnings;
 use POSIX qw(ceil);
 use File::Basename;
 use File::Temp;
+use File::Spec;
 
 sub usage {
    local $, = "\n";
@@ -73,6 +74,11 @@ Options:
           files.  Only works correctly for jobs where each line of input
           creates one line of output.  The inputs cannot be/must not be read
           more than once by cmd.
+  -balance With -stripe, balance the jobs on the bytes of their lines instead
+          of assigning lines round-robin, evening out their work when line
+          lengths are skewed.  Costs one more pass over the first input, the
+          first -s file or else the input redirection.  N cannot exceed the
+          number of files stripe.py -r can open at once.
   -merge  merge command [cat]
   -nolocal  Run run-parallel.sh -nolocal
   -psub <O> Passes additional options to run-parallel.sh -psub.
@@ -152,6 +158,7 @@ GetOptions(
    "workdir=s" => \my $workdir,
 
    stripe      => \my $use_stripe_splitting,
+   balance     => \my $balance,
 
    "s=s"       => \@SPLITS,
    "m=s"       => \@MERGES,
@@ -203,11 +210,24 @@ $PSUB_OPTS = "-psub \"$PSUB_OPTS\"" unless ($PSUB_OPTS eq "");
 
 # Make sure we have access to stripe.py
 $use_stripe_splitting = ($use_stripe_splitting and system("which-test.sh stripe.py") == 0);
+my $merge_with_manifest;
 if ($use_stripe_splitting) {
    # If we are using stripe mode and the user DIDN'T specify is one merge
    # command tool, we will use stripe.py in rebuild mode.
+   $merge_with_manifest = ($balance and not defined($MERGE_PGM));
+   if ($merge_with_manifest) {
+      # stripe.py -r -a opens all N stripes at once, it cannot merge them in
+      # groups; it keeps 64 descriptors in reserve.
+      my $open_max = POSIX::sysconf(POSIX::_SC_OPEN_MAX());
+      die "Error: -balance cannot merge more than " . ($open_max - 64) . " jobs, the open file limit is $open_max.\n"
+         if (defined($open_max) and $N > $open_max - 64);
+   }
    $MERGE_PGM = "stripe.py -r" unless(defined($MERGE_PGM));
 }
+elsif ($balance) {
+   warn "Warning: -balance only applies to -stripe, ignoring it.\n";
+   $balance = 0;
+}
 
 
 # Make sure the merge command tool is set.
@@ -272,6 +292,8 @@ else {
 verbose(1, "Adding $merge to merge");
 push @MERGES, $merge;
 
+# -balance assigns the lines of the user's first input, before sorting.
+my $balanced_input = $SPLITS[0];
 @SPLITS = remove_dups @SPLITS;
 @MERGES = remove_dups @MERGES;
 
@@ -300,6 +322,10 @@ else {
    chmod(((stat $workdir)[2] & 0777) | ((stat ".")[2] & 0050), $workdir);
 }
 
+# With -balance, stripe.py records which job gets each line in this manifest.
+my $manifest = File::Spec->rel2abs("$workdir/manifest");
+$MERGE_PGM .= " -a $manifest" if ($merge_with_manifest);
+
 # Make sure there is at least one input file.
 die "Error: You must provide an input file." unless(scalar(@SPLITS) gt 0);
 
@@ -366,6 +392,21 @@ unless ($use_stripe_splitting) {
    }
 }
 
+if ($balance) {
+   # Assign the lines of the first input to the jobs once, balancing their
+   # bytes; the jobs then split every input following that assignment, which
+   # keeps parallel inputs aligned.
+   my $s = $balanced_input;
+   my $mimeType = getMimeType $s;
+   my $balancer = "stripe.py -w bytes -m $N -a $manifest $s";
+   if ($mimeType ne 'text/plain' and $mimeType ne 'application/x-gzip') {
+      $balancer = "$READERS{$mimeType} $s | stripe.py -w bytes -m $N -a $manifest";
+   }
+   verbose(1, "Balancing the lines of $s in $manifest");
+   $rc = system("$debug_cmd $balancer > /dev/null");
+   die "Error: Error balancing $s\n" unless($rc eq 0);
+}
+
 sub min{
    return ($_[0] < $_[1]) ? $_[0] : $_[1];
 }
@@ -393,12 +434,19 @@ for (my $i=0; $i<$NUMBER_OF_CHUNK_GENERATED; ++$i) {
    if ($use_stripe_splitting) {
       my $done = "$workdir/" . $basename{$SPLITS[0]} . "/$index.done";
       foreach my $s (@SPLITS) {
-         my $reader = $READERS{getMimeType $s} || 'cat';
-         verbose(2, "Using reader: <$reader>");
-         # NOTE: doing zcat file.gz | stripe.py is much much faster than
-         # stripe.py file.gz.  Seems like the python's implementation of gzip is
-         # quite slow.
-         unless ($SUB_CMD =~ s/(^|\s|<|=)\Q$s\E(?=$|\s|\))/$1<($reader $s | stripe.py -i $i -m $N)/g) {
+         my $mimeType = getMimeType $s;
+         # NOTE: stripe.py reads plain text and gzip files directly, decompressing
+         # in large chunks in a background thread, which is faster than piping
+         # through zcat.  Other formats still need an external reader.
+         my $stripe_opts = "-i $i -m $N";
+         $stripe_opts .= " -a $manifest" if ($balance);
+         my $striper = "stripe.py $stripe_opts $s";
+         if ($mimeType ne 'text/plain' and $mimeType ne 'application/x-gzip') {
+            my $reader = $READERS{$mimeType} || 'cat';
+            verbose(2, "Using reader: <$reader>");
+            $striper = "$reader $s | stripe.py $stripe_opts";
+         }
+         unless ($SUB_CMD =~ s/(^|\s|<|=)\Q$s\E(?=$|\s|\))/$1<($striper)/g) {
             die "Error: Unable to match $s";
          }
       }
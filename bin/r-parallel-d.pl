@@ -213,6 +213,8 @@ for ( ; $paddr = accept(Client, Server); close Client) {
          exit 2;
       } elsif ($cmd_rcvd =~ /^NUM_WORKER/i) {
          print "NUM_WORKER w:$num_workers q:$quench_count a:$add_count\n";
+      } elsif ($cmd_rcvd =~ /^STATUS/i) {
+         print "STATUS w:$num_workers q:$quench_count a:$add_count jobs:$num started:$job_no done:$done_count\n";
       } elsif ($cmd_rcvd =~ /^GET/i) {
          log_msg $cmd_rcvd;
          if ( $cmd_rcvd !~ /GET \(PRIMARY/i and $quench_count > 0 ) {
@@ -419,7 +421,11 @@ Valid messages -- response:
   PING -- PONG
 
   NUM_WORKER -- Request status of how many workers are: actively working, been
-                quenched and been added.
+                quenched and been added.  Replies "NUM_WORKER w:<W> q:<Q> a:<A>".
+
+  STATUS -- Request the NUM_WORKER counts along with how many jobs there are,
+            have been started and are done.  Replies
+            "STATUS w:<W> q:<Q> a:<A> jobs:<N> started:<S> done:<D>".
 
 EOF
 
@@ -12,20 +12,26 @@
 
 
 # source: http://pythonhosted.org/APScheduler/
+# APScheduler's CronTrigger gives the times of the -a/-q cron jobs; everything
+# else runs on a single asyncio event loop.
 
 from __future__ import print_function, unicode_literals, division, absolute_import
 
-from apscheduler.scheduler import Scheduler
-from apscheduler.events import (EVENT_JOBSTORE_ADDED, EVENT_SCHEDULER_SHUTDOWN)
-from apscheduler.triggers.cron import CronTrigger
-
 import os.path
 import sys
 import time
-from datetime import datetime  # now()
+import asyncio
+import signal
+import socket
+from datetime import datetime, timedelta  # now()
 import re
+import glob
+import heapq
+import json
+import csv
+from fnmatch import fnmatch
 from math import ceil
-from subprocess import call, check_call, check_output, CalledProcessError
+from subprocess import CalledProcessError
 from argparse import ArgumentParser, RawDescriptionHelpFormatter, Action
 
 # Activate logging or else this will be UNDEBUGGABLE.
@@ -82,10 +88,44 @@ def verbose(*args, **kwargs):
 def get_args():
    """Command line argument processing."""
 
-   usage = "r-scheduler.py [options] psub_cmd_path"
+   usage = "r-scheduler.py [options] psub_cmd_path [psub_cmd_path ...]"
    help = """
    Monitor a run-parallel.sh job on the cluster to add or quench workers on
    user specified times.
+
+   Given several jobs, or glob patterns such as 'run-p.*/psub_cmd' matching
+   the psub_cmd of several jobs, one daemon monitors them all: the free CPUs
+   are split among the jobs, in proportion to their weights (-s fair) or to
+   the jobs with the highest weights first (-s priority), and no job gets more
+   workers than it has tasks left.  Patterns are expanded again at each tick,
+   picking up new jobs, and jobs that leave the queue are dropped; the daemon
+   exits once it has no job left.
+
+   The workers and tasks of a job given by its psub_cmd are queried from its
+   r-parallel-d.pl directly, at the -host= and -port= its psub_cmd gives;
+   run-parallel.sh num_worker, add and quench are used for jobs given by
+   their PBS_JOBID.
+
+   With -p throughput, the default, a job is also given no more workers than
+   can finish it sooner, judging from its tasks left, the rate at which its
+   workers complete them and the -L time a new worker takes to start, and
+   its workers that can't are quenched; -B and -C keep the daemon from
+   adding and quenching workers back and forth.  -p free only looks at the
+   cluster's free CPUs.
+
+   With -M, workers are only added where a node has both a free CPU and the
+   memory they need, as learnt from what their job's workers have used.
+
+   The state of the cluster comes from a -k backend: pbs, the default, runs
+   analyze, qstat and pbsnodes; slurm runs sinfo and squeue; local looks at
+   the machine the daemon runs on, its CPUs, load average and CPU pressure,
+   for jobs whose workers run there, e.g. run-parallel.sh -nocluster on a
+   workstation.
+
+   Besides every -b minutes, the cluster is checked again, as soon as the
+   -t TTL allows, when a cron job fires, when one of the jobs finishes or a
+   new one appears, as seen in their run-p directories every -e seconds, or
+   when the daemon receives SIGUSR1, e.g. from a hook on queue changes.
    """
    epilog = """
    Cron like job format:
@@ -123,9 +163,16 @@ def get_args():
    parser.add_argument("-q", dest="quench", nargs="*", type=str, default=[],
                        help="schedule a cron job to quench workers [%(default)s]")
 
-   parser.add_argument("-b", dest="burst_interval", type=int, default=5,
+   parser.add_argument("-b", dest="burst_interval", type=float, default=5,
                        help="monitor cluster resources at interval X in minutes [%(default)s]")
 
+   parser.add_argument("-t", dest="ttl", type=float, default=30,
+                       help="reuse the cluster state for up to TTL seconds [%(default)s]")
+
+   parser.add_argument("-e", dest="watch_interval", type=float, default=5,
+                       help="look for finished or new jobs in their run-p directories every E seconds "
+                       "[%(default)s]")
+
    parser.add_argument("-m", dest="minimumNumberOfWorker", type=int, default=60,
                        help="minimum number of workers [%(default)s]")
 
@@ -137,7 +184,54 @@ def get_args():
    parser.add_argument("-n", "--not-really", dest="notReally", action='store_true', default=False,
                        help="don't actually change the number of workers in use [%(default)s]")
 
-   parser.add_argument("psub_cmd_or_PBS_JOBID", help="path/run-p.SUFFIX/psub_cmd or PBS_JOBID")
+   parser.add_argument("-s", dest="share", choices=("fair", "priority"), default="fair",
+                       help="how to split the free CPUs among several jobs [%(default)s]")
+
+   parser.add_argument("-p", dest="policy", choices=sorted(POLICIES), default="throughput",
+                       help="how to size the jobs: free to leave -f of the CPUs free, throughput to also "
+                       "give each job the workers that finish it soonest [%(default)s]")
+
+   parser.add_argument("--factor-add", dest="factor_add", type=float, default=0.25,
+                       help="fraction of the CPUs free beyond -f to fill at each tick [%(default)s]")
+
+   parser.add_argument("--factor-quench", dest="factor_quench", type=float, default=1,
+                       help="fraction of the CPUs missing to reach -f to free at each tick [%(default)s]")
+
+   parser.add_argument("-L", dest="startup", type=float, default=60,
+                       help="seconds a new worker takes to start, for -p throughput [%(default)s]")
+
+   parser.add_argument("-B", dest="band", type=float, default=0.02,
+                       help="only add or quench workers when the free ratio is more than B away from -f, "
+                       "for -p throughput [%(default)s]")
+
+   parser.add_argument("-C", dest="cooldown", type=float, default=300,
+                       help="seconds before quenching a job's workers after adding some, or the other way "
+                       "around, for -p throughput [%(default)s]")
+
+   parser.add_argument("-k", dest="backend", choices=sorted(BACKENDS), default="pbs",
+                       help="where to get the state of the cluster: pbs (analyze, qstat, pbsnodes), "
+                       "slurm (sinfo, squeue) or local, this machine, for jobs whose workers run here "
+                       "[%(default)s]")
+
+   parser.add_argument("-M", dest="memory", type=float, default=None,
+                       help="only add workers that fit in the free CPUs and physical memory of the nodes, as "
+                       "the -k backend gives them, a worker taking the most memory a worker of its job has "
+                       "used, per its mon.worker-* files, or MEMORY GB until known [don't check memory]")
+
+   parser.add_argument("-o", dest="metrics", type=str, default=None,
+                       help="append the metrics of each tick to METRICS, as CSV if its name ends in .csv, "
+                       "else as JSON lines [%(default)s]")
+
+   parser.add_argument("-x", dest="textfile", type=str, default=None,
+                       help="write the metrics of the latest tick to TEXTFILE in Prometheus' text format, "
+                       "e.g. for node_exporter's textfile collector [%(default)s]")
+
+   parser.add_argument("-w", dest="weights", action="append", type=str, default=[],
+                       help="weight of the jobs whose PBS_JOBID or psub_cmd path matches the glob "
+                       "PATTERN, as PATTERN=WEIGHT, repeatable; other jobs weigh 1 [%(default)s]")
+
+   parser.add_argument("psub_cmd_or_PBS_JOBID", nargs="+",
+                       help="path/run-p.SUFFIX/psub_cmd, a glob pattern of such paths, or PBS_JOBID")
 
    cmd_args = parser.parse_args()
 
@@ -145,93 +239,235 @@ def get_args():
    for arg in cmd_args.__dict__:
       info("  {0} = {1}".format(arg, getattr(cmd_args, arg)))
 
-   if cmd_args.psub_cmd_or_PBS_JOBID is "":
+   if "" in cmd_args.psub_cmd_or_PBS_JOBID:
       fatal_error("No job provided by the user")
 
+   weights = {}
+   for weight in cmd_args.weights:
+      pattern, _, value = weight.rpartition("=")
+      try:
+         weights[pattern] = float(value)
+      except ValueError:
+         pattern = ""
+      if not pattern or weights[pattern] <= 0:
+         fatal_error("Expected format for -w is PATTERN=WEIGHT, WEIGHT > 0: {}".format(weight))
+   cmd_args.weights = weights
+
    return cmd_args
 
 
-class IsDaemonAlive:
+class Job:
    """
-   This class will monitor a PBS_JOBID and indicate if it is still present on
-   the cluster.
+   A run-parallel.sh job monitored by r-scheduler.py.
    """
-   def __init__(self, jobId):
+   def __init__(self, jobID, psub_cmd=None, weight=1.0):
       """
-      Initialize with which PBS_JOBID to track.
+      Initialize with the job's PBS_JOBID, its run-p.SUFFIX/psub_cmd path if
+      known, and its weight among the jobs monitored.
       """
-      self.KeepRunning = True
-      self.jobID = jobId
-      info("Monitoring job {}".format(self.jobID))
-
-   def __call__(self):
+      self.jobID = jobID
+      self.psub_cmd = psub_cmd
+      self.workdir = os.path.dirname(psub_cmd) if psub_cmd is not None else None
+      self.weight = weight
+      self.daemon = None
+      # The job's latest JobStatus, as seen by scale().
+      self.status = None
+      # mon.worker-* file -> (bytes read, peak RSS in GB).
+      self.memory = {}
+      # jobs or rc file -> (bytes read, lines counted).
+      self.lines = {}
+
+   def __str__(self):
+      return self.jobID
+
+   def target(self):
+      """How run-parallel.sh add/quench/num_worker designate the job."""
+      return self.psub_cmd if self.psub_cmd is not None else self.jobID
+
+   def client(self):
+      """The DaemonClient of the job's r-parallel-d.pl, None if unknown."""
+      if self.daemon is None and self.psub_cmd is not None:
+         self.daemon = DaemonClient.from_psub_cmd(self.psub_cmd)
+      return self.daemon
+
+   def footprint(self, default=None):
       """
-      Make this class callable in order to make it a thread.
+      (float) -> float or None
+      The most memory, in GB, any of the job's workers has used so far, from
+      the mon.worker-* files process-memory-usage.pl writes in the job's
+      working directory, or default until they tell.
       """
-      info("Checking if job {} is still alive!".format(self.jobID))
-      cmd  = "qstat | grep " + self.jobID + " &> /dev/null"
-      debug(cmd)
-      self.KeepRunning = call(cmd, shell=True) is 0
-
-
-# This class is not used.
-class MonitorQueueActivity:
-   def __init__(self):
-      self.val = 0
+      if self.workdir is not None:
+         for filename in glob.glob(os.path.join(self.workdir, "mon.worker-*")):
+            offset, peak = self.memory.get(filename, (0, 0.0))
+            try:
+               with open(filename, "rb") as f:
+                  f.seek(offset)
+                  data = f.read()
+            except IOError:
+               continue
+            # Leave a line still being written for the next time.
+            data = data[:data.rfind(b"\n") + 1]
+            for m in mon_pattern.finditer(data.decode("utf-8", "replace")):
+               peak = max(peak, float(m.group(1)))
+            self.memory[filename] = (offset + len(data), peak)
+      peaks = [peak for offset, peak in self.memory.values() if peak > 0]
+      return max(peaks) if peaks else default
+
+   def count_lines(self, filename):
+      """
+      (str) -> int
+      The number of lines of filename, in the job's working directory,
+      reading only what was appended to it since the last call.
+      """
+      filename = os.path.join(self.workdir, filename)
+      offset, count = self.lines.get(filename, (0, 0))
+      with open(filename, "rb") as f:
+         f.seek(offset)
+         data = f.read()
+      # Leave a line still being written for the next time.
+      data = data[:data.rfind(b"\n") + 1]
+      # The (offset, count) pair is replaced whole, so counting from both
+      # watch()'s thread and the loop never counts a line twice.
+      count += data.count(b"\n")
+      self.lines[filename] = (offset + len(data), count)
+      return count
+
+   def progress(self):
+      """
+      () -> (int, int) or None
+      The number of tasks of the job and how many are done, from the jobs
+      and rc files of the job's working directory, or None if unknown.
+      """
+      if self.workdir is None:
+         return None
+      try:
+         total = self.count_lines("jobs")
+         done = 0
+         if os.path.exists(os.path.join(self.workdir, "rc")):
+            done = self.count_lines("rc")
+      except IOError:
+         return None
+      return total, done
+
+   def tasks_left(self):
+      """
+      () -> int or None
+      The number of tasks not done yet, or None if unknown.
+      """
+      progress = self.progress()
+      if progress is None:
+         return None
+      total, done = progress
+      return max(0, total - done)
 
-   def __call__(self):
-      self.val += 1
-      info("Monitoring queue's activity ".format(self.val))
-      if self.val>2:
-         info("Trying to shutdown")
-         sched.shutdown(wait=False)
 
+# A line of process-memory-usage.pl, e.g.
+# 2013-06-04 11:47:35 Total vsz: 3.124G rss: 2.843G pcpu: 99.8% 3 Processes
+mon_pattern = re.compile(r"Total vsz: [\d.]+G rss: ([\d.]+)G")
 
-def add_event_listeners(sched):
+class JobSet:
    """
-   Add two event listeners to the scheduler.
-   One to display new job added to the scheduler, one to display when the
-   scheduler is shutting down.
+   The jobs monitored, given as psub_cmd paths, glob patterns of such paths or
+   PBS_JOBIDs.  Patterns are expanded again on every refresh to discover new
+   jobs, and jobs no longer in the queue are dropped.
    """
-   def shutdown_event(event):
-       """
-       Simply advertize that the scheduler is shutting down.
-       """
-       info("Shutting down {}".format(event))
+   def __init__(self, specs, weights):
+      """
+      Initialize with the jobs' specs, and a {glob pattern: weight} dict
+      giving the weights of the jobs whose id or psub_cmd path match.
+      """
+      self.specs = specs
+      self.weights = weights
+      self.jobs = {}  # jobID -> Job
+      self.seen = set()
 
-   def new_job_event(event):
-       """
-       Simply advertize that the scheduler as a new job.
-       """
-       info("New job {}".format(event))
+   def __iter__(self):
+      return iter(sorted(self.jobs.values(), key=str))
 
-   sched.add_listener(shutdown_event, EVENT_SCHEDULER_SHUTDOWN)
-   sched.add_listener(new_job_event, EVENT_JOBSTORE_ADDED)
+   def __len__(self):
+      return len(self.jobs)
 
+   def weight(self, jobID, path):
+      for pattern, weight in self.weights.items():
+         if fnmatch(jobID, pattern) or (path is not None and fnmatch(path, pattern)):
+            return weight
+      return 1.0
 
-def get_jobID(cmd_args):
+   def discover(self):
+      """
+      () -> [(jobID, psub_cmd path or None)]
+      The jobs currently designated by the specs.
+      """
+      found = []
+      for spec in self.specs:
+         if glob.has_magic(spec):
+            paths = sorted(glob.glob(spec))
+         elif os.path.isfile(spec) or not re.match(r'\d+', spec):
+            paths = [spec]
+         else:
+            found.append((spec, None))
+            continue
+         for path in paths:
+            jobID = get_jobID(path)
+            if jobID is not None:
+               found.append((jobID, path))
+            elif not glob.has_magic(spec):
+               fatal_error("Unrecognized job id format {}".format(spec))
+      return found
+
+   def refresh(self, snapshot):
+      """
+      Add the new jobs found in the queue, drop the jobs no longer in it.
+      """
+      for jobID, path in self.discover():
+         if jobID not in self.jobs and jobID not in self.seen and jobID.split('.')[0] in snapshot.jobIDs:
+            self.jobs[jobID] = Job(jobID, path, self.weight(jobID, path))
+            self.seen.add(jobID)
+            info("Monitoring job {} (weight {})".format(jobID, self.jobs[jobID].weight))
+      for jobID in list(self.jobs):
+         if jobID.split('.')[0] not in snapshot.jobIDs:
+            info("Job {} is no longer in the queue".format(jobID))
+            del self.jobs[jobID]
+
+
+def get_jobID(psub_cmd):
    """
-   Get the job id from the psub_cmd's directory path or PBS_JOBID provided by
-   the user on the command line.
+   Get the job id from the psub_cmd's directory path, None if the path is not
+   that of a run-parallel.sh psub_cmd.
    """
-   if os.path.isfile(cmd_args.psub_cmd_or_PBS_JOBID):
-      #run-p.1355859.balza.096
-      m = re.match(r'.*run-p.(\d+).balza.\d+/psub_cmd', cmd_args.psub_cmd_or_PBS_JOBID)
-      if not m:
-          fatal_error("Error with regular expression {}".format(cmd_args.psub_cmd_or_PBS_JOBID))
-
-      return m.group(1)
-   else:
-      m = re.match(r'\d+', cmd_args.psub_cmd_or_PBS_JOBID)
-      if not m:
-         fatal_error("Unrecognized job id format {}".format(cmd_args.psub_cmd_or_PBS_JOBID))
-      return cmd_args.psub_cmd_or_PBS_JOBID
+   #run-p.1355859.balza.096
+   m = re.match(r'(.*/)?run-p\.(\d+)[^/]*/psub_cmd$', psub_cmd)
+   if not m:
+      return None
+   return m.group(2)
 
 
-def add_cronjob(sched, cmd_args):
+def allot(amount, cost, caps):
+   """
+   (int, (str, int) -> float, {str: int}) -> {str: int}
+   Hand out amount units, e.g. workers, one at a time, each to the key whose
+   cost(key, units it already got) is the lowest, never giving a key more
+   than caps[key].
+   """
+   shares = dict.fromkeys(caps, 0)
+   heap = [(cost(key, 0), key) for key in caps if caps[key] > 0]
+   heapq.heapify(heap)
+   for _ in range(amount):
+      if not heap:
+         break
+      _, key = heapq.heappop(heap)
+      shares[key] += 1
+      if shares[key] < caps[key]:
+         heapq.heappush(heap, (cost(key, shares[key]), key))
+   return shares
+
+
+def add_cronjob(cmd_args):
    """
-   Add user defined cron jobs.
-   (Scheduler, cmd_args)
+   (cmd_args) -> [(CronTrigger, float, str, function)]
+   Parse the user defined cron jobs, returning, for each one, its trigger,
+   its value, its spec and the function to call with its value when it fires.
    """
    def adding(value):
       """
@@ -253,10 +489,14 @@ def add_cronjob(sched, cmd_args):
       """
       Create cron jobs for adding and quenching based on specific time of day.
       """
+      if not liste:
+         return []
+      from apscheduler.triggers.cron import CronTrigger
       # source: http://tornadogists.org/1770500/
       _re_split_cron  = re.compile('\s*:\s*')
       _re_split_time  = re.compile("\s+")
       _sched_seq      = ('second', 'minute', 'hour', 'day', 'month', 'year', 'day_of_week')
+      crons = []
       try:
          for job in liste:
             w, date  = _re_split_cron.split(job)
@@ -268,28 +508,53 @@ def add_cronjob(sched, cmd_args):
 
             schedule = dict(zip(_sched_seq, splitted))
             info(("Adding cron for {} with these parameters: ".format(fonction.__name__), job, w, date, schedule))
-            #sched.add_job(trigger=CronTrigger(**schedule), func=(lambda v: sys.stdout.write(v, "\n")), args=[w], kwargs={})
-            sched.add_cron_job(func=fonction, name=job, args=[w], kwargs=None, **schedule)
-            #sched.add_interval_job('sys:stdout.write', args=['tick\n'], seconds=3)
+            crons.append((CronTrigger(**schedule), w, job, fonction))
       except ValueError as err:
         fatal_error("Error expected format for cron job is: %:bla blah bla")
+      return crons
 
-   addCron(cmd_args.add, adding)
-   addCron(cmd_args.quench, quenching)
+   return addCron(cmd_args.add, adding) + addCron(cmd_args.quench, quenching)
+
+
+def next_fire_time(trigger, after):
+   """
+   (CronTrigger, datetime) -> datetime or None
+   The first time trigger fires at or after after, with either APScheduler 3's
+   or 2's CronTrigger.
+   """
+   timezone = getattr(trigger, "timezone", None)
+   if timezone is not None:
+      # APScheduler 3 works with timezone aware times.
+      when = trigger.get_next_fire_time(None, after.astimezone(timezone))
+      return when and when.astimezone().replace(tzinfo=None)
+   return trigger.get_next_fire_time(after)
+
+
+async def run_command(cmd):
+   """
+   (str) -> str
+   Run cmd in a shell without blocking the event loop and return its output;
+   raises CalledProcessError if cmd fails.
+   """
+   debug(cmd)
+   process = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE)
+   output, _ = await process.communicate()
+   output = output.decode("utf-8", "replace")
+   if process.returncode != 0:
+      raise CalledProcessError(process.returncode, cmd, output)
+   return output
 
 
 #||| 265 jobs pending
 #||| 320 CPUs: 16 down or offline, 304 busy, 0 free
 jobs_pending_pattern = re.compile(r'\|\|\|( (\d+) jobs pending)?')
 free_cpu_pattern = re.compile(r'\|\|\| (\d+) CPUs: .*, (\d+) free')
-def cluster_resources():
+def cluster_resources(contents):
    """
-   () -> (int, int)
-   Check general cluster usage.
-   return (totalCPUs, freeCPUs)
+   ([str]) -> (int, int, int)
+   Check general cluster usage from the lines of analyze's output.
+   return (totalCPUs, freeCPUs, pending)
    """
-   contents = check_output("analyze").strip().split('\n')
-
    m = free_cpu_pattern.search(contents[-1])
    if not m:
        fatal_error("Error with regular expression free cpu re:{} {}".format(free_cpu_pattern, contents[-1]))
@@ -302,105 +567,1065 @@ def cluster_resources():
    if n.group(2):
       pending = n.group(2)
 
-   return int(totalCPUs), int(freeCPUs) - int(pending)
+   return int(totalCPUs), int(freeCPUs), int(pending)
 
 
-num_worker_pattern = re.compile(r"w:(\d+) q:(\d+) a:(\d+)$")
-def job_resources(jobID):
+def queued_jobs(contents):
+   """
+   ([str]) -> set(str)
+   The numeric ids of the jobs listed by qstat, e.g. 1355859 for 1355859.balza.
    """
-   (int) -> (int, int, int)
+   jobIDs = set()
+   for line in contents:
+      m = re.match(r'(\d+)\S*\s', line)
+      if m:
+         jobIDs.add(m.group(1))
+   return jobIDs
+
 
-   Queries run-parallel.sh with num_worker to get the following information:
-   W: current number of workers
-   Q: number of workers been quenched
-   A: number of workers been added
-   returns (W, Q, A)
+def memory_size(value):
    """
-   contents = check_output(["run-parallel.sh", "num_worker", str(jobID)]).strip().split('\n')[-1]
-   #contents = check_output("qstattree " + str(jobID) + " | \wc -l", shell=True)
-   #contents = check_output("qstat | grep " + str(jobID) + " | egrep '[QR] long[ ]*$' | wc -l", shell=True)
-   m = num_worker_pattern.match(contents)
+   (str) -> float
+   A PBS memory size, e.g. 131072000kb or 128gb, in GB.
+   """
+   m = re.match(r"(\d+)([kmgt]?)b?$", value.strip().lower())
    if not m:
-       fatal_error("Error with regular expression re:{} {}".format(free_cpu_pattern, contents))
+      raise ValueError("Unexpected memory size: {}".format(value))
+   return int(m.group(1)) * 1024 ** "bkmgt".index(m.group(2) or "b") / 1024 ** 3
+
 
-   return int(m.group(1)), int(m.group(2)), int(m.group(3))
+def core_count(jobs):
+   """
+   (str) -> int
+   The cores in use in Torque's jobs list, e.g. 0-3/1234.balza,4/1235.balza.
+   """
+   count = 0
+   for entry in jobs.split(","):
+      cores = entry.strip().split("/")[0]
+      if not cores:
+         continue
+      first, _, last = cores.partition("-")
+      count += int(last) - int(first) + 1 if last else 1
+   return count
 
 
-def main():
-   # Parse command line arguments.
-   cmd_args = get_args()
+def cluster_nodes(contents):
+   """
+   ([str]) -> [(int, float)]
+   The free CPUs and free memory, in GB, of each node up in the lines of
+   pbsnodes -a's output: from np, jobs and the physmem, totmem and availmem
+   of status for Torque, or from resources_available and resources_assigned
+   for PBS Pro.  Torque's availmem counts free swap too: the free physical
+   memory is physmem less the memory in use, totmem - availmem.
+   """
+   nodes = []
+   def add(attributes):
+      if not attributes or re.search(r"down|offline|unknown", attributes.get("state", "")):
+         return
+      try:
+         if "resources_available.ncpus" in attributes:
+            cpus = int(attributes["resources_available.ncpus"]) - int(attributes.get("resources_assigned.ncpus", 0))
+            memory = memory_size(attributes.get("resources_available.mem", "0")) - \
+                     memory_size(attributes.get("resources_assigned.mem", "0"))
+         else:
+            status = dict(item.partition("=")[::2] for item in attributes.get("status", "").split(","))
+            cpus = int(attributes.get("np", 0)) - core_count(attributes.get("jobs", ""))
+            memory = memory_size(status.get("availmem", "0"))
+            if "physmem" in status and "totmem" in status:
+               memory -= memory_size(status["totmem"]) - memory_size(status["physmem"])
+      except ValueError as err:
+         warn("Ignoring node {}: {}".format(attributes.get("name"), err))
+         return
+      nodes.append((max(0, cpus), max(0.0, memory)))
+   attributes = None
+   for line in contents:
+      if line.strip() and not line[0].isspace():
+         add(attributes)
+         attributes = {"name": line.strip()}
+      elif " = " in line and attributes is not None:
+         key, _, value = line.strip().partition(" = ")
+         attributes[key] = value
+   add(attributes)
+   return nodes
+
+
+class Snapshot:
+   """
+   The state of the cluster at one point in time: its CPUs, the jobs pending,
+   the ids of the jobs in the queue and, if queried, the free CPUs and
+   memory of each of its nodes.
+   """
+   def __init__(self, totalCPUs, freeCPUs, pending, jobIDs, when=None, nodes=None):
+      self.totalCPUs = totalCPUs
+      self.freeCPUs = freeCPUs
+      self.pending = pending
+      self.jobIDs = jobIDs
+      self.nodes = nodes  # [(free CPUs, free memory in GB)] or None
+      self.time = time.time() if when is None else when
+      # Wall time, in seconds, of the query that took the snapshot.
+      self.latency = None
+
+   def available(self):
+      """The free CPUs left once the jobs pending get theirs."""
+      return self.freeCPUs - self.pending
+
+   def fit(self, wanted, footprints):
+      """
+      ({str: int}, {str: float}) -> {str: int}
+      How many of the wanted workers of each job fit on the nodes, a worker
+      taking one CPU and footprints[jobID] GB of memory, or no memory if
+      None, on a single node.  The jobs whose workers need the most memory
+      are placed first, each on the first nodes with room for them.  All the
+      wanted workers fit if the nodes are unknown.
+      """
+      if self.nodes is None:
+         return dict(wanted)
+      nodes = [[cpus, memory] for cpus, memory in self.nodes]
+      fitted = dict.fromkeys(wanted, 0)
+      for jobID in sorted(wanted, key=lambda jobID: -(footprints.get(jobID) or 0)):
+         need = footprints.get(jobID) or 0
+         for node in nodes:
+            if fitted[jobID] >= wanted[jobID]:
+               break
+            n = min(node[0], wanted[jobID] - fitted[jobID])
+            if need > 0:
+               n = min(n, int(node[1] / need))
+            if n > 0:
+               node[0] -= n
+               node[1] -= n * need
+               fitted[jobID] += n
+      return fitted
+
+
+# The commands a backend runs for a snapshot are run by one shell, their outputs
+# separated by this line.
+SNAPSHOT_SEPARATOR = "||| r-scheduler.py snapshot |||"
+
+async def run_sections(cmds):
+   """
+   ([str]) -> [[str]]
+   Run cmds in one shell, one after the other, and return the lines each one
+   printed.
+   """
+   cmd = " && ".join(cmds[:1] + ["echo '{}' && {}".format(SNAPSHOT_SEPARATOR, c) for c in cmds[1:]])
+   sections = [[]]
+   for line in (await run_command(cmd)).strip().split('\n'):
+      if line == SNAPSHOT_SEPARATOR:
+         sections.append([])
+      else:
+         sections[-1].append(line)
+   if len(sections) != len(cmds):
+      fatal_error("Unexpected output from {}".format(cmd))
+   return sections
+
+
+class Backend:
+   """
+   Where r-scheduler.py gets its Snapshot of the cluster from; -k picks one
+   of BACKENDS.  snapshot() gives the cluster's CPUs, free and in total,
+   the CPUs or jobs pending, the ids of the jobs in the queue and, if nodes
+   is True, the free CPUs and memory of each node.
+   """
+   def __init__(self, cmd_args):
+      self.cmd_args = cmd_args
+
+   async def snapshot(self, nodes=False):
+      """
+      (bool) -> Snapshot
+      """
+      raise NotImplementedError
+
+
+class PBSBackend(Backend):
+   """
+   A PBS or Torque cluster, from analyze, qstat and pbsnodes -a.
+   """
+   async def snapshot(self, nodes=False):
+      sections = await run_sections(["analyze", "qstat"] + (["pbsnodes -a"] if nodes else []))
+      totalCPUs, freeCPUs, pending = cluster_resources(sections[0])
+      return Snapshot(totalCPUs, freeCPUs, pending, queued_jobs(sections[1]),
+                      nodes=cluster_nodes(sections[2]) if nodes else None)
+
+
+class SlurmBackend(Backend):
+   """
+   A Slurm cluster, from sinfo and squeue: the CPUs pending are those of the
+   jobs pending.
+   """
+   async def snapshot(self, nodes=False):
+      sections = await run_sections(["sinfo -h -o '%C'", "squeue -h -o '%i %t %C'"] +
+                                    (["sinfo -h -N -o '%n %C %e %t'"] if nodes else []))
+      # allocated/idle/other/total
+      m = re.match(r"(\d+)/(\d+)/(\d+)/(\d+)$", sections[0][-1].strip() if sections[0] else "")
+      if not m:
+         fatal_error("Unexpected output from sinfo: {}".format(sections[0]))
+      totalCPUs, freeCPUs = int(m.group(4)), int(m.group(2))
+      pending, jobIDs = 0, set()
+      for line in sections[1]:
+         fields = line.split()
+         m = re.match(r"\d+", fields[0]) if len(fields) == 3 else None
+         if m:
+            jobIDs.add(m.group(0))
+            if fields[1] == "PD" and fields[2].isdigit():
+               pending += int(fields[2])
+      nodeList = None
+      if nodes:
+         # One line per node and partition: count each node once.
+         found = {}
+         for line in sections[2]:
+            fields = line.split()
+            if len(fields) != 4 or re.search(r"down|drain|drng|fail|maint|unk|\*", fields[3]):
+               continue
+            try:
+               found[fields[0]] = (int(fields[1].split("/")[1]), int(fields[2]) / 1024)
+            except (ValueError, IndexError):
+               warn("Ignoring node {}".format(line))
+         nodeList = list(found.values())
+      return Snapshot(totalCPUs, freeCPUs, pending, jobIDs, nodes=nodeList)
+
+
+def cpu_pressure():
+   """
+   () -> float or None
+   The share of the last 10 seconds, in %, some tasks waited for a CPU, from
+   Linux's pressure stall information, None if not available.
+   """
+   try:
+      with open("/proc/pressure/cpu") as f:
+         m = re.match(r"some avg10=([\d.]+)", f.readline())
+   except IOError:
+      return None
+   return float(m.group(1)) if m else None
+
 
+def memory_available():
+   """The memory, in GB, available to new processes on this machine."""
+   try:
+      with open("/proc/meminfo") as f:
+         for line in f:
+            if line.startswith("MemAvailable:"):
+               return int(line.split()[1]) / 1024 ** 2
+   except IOError:
+      pass
+   return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024 ** 3
 
-   # Figure out which job to monitor.
-   jobID = get_jobID(cmd_args)
 
+class LocalBackend(Backend):
+   """
+   The machine r-scheduler.py runs on, for run-parallel.sh jobs whose
+   workers run there, e.g. with -nocluster.  The busy CPUs are the load
+   average or, if more, the tasks runnable right now, so that workers just
+   added count at once; the CPUs pending are the load beyond the CPUs or, if
+   more, the share of the CPUs the CPU pressure says tasks waited for.  The
+   jobs in the "queue" are the processes running: a job is there as long as
+   the run-parallel.sh whose pid names its run-p.PID.local directory is.
+   """
+   async def snapshot(self, nodes=False):
+      totalCPUs = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+      busy = os.getloadavg()[0]
+      try:
+         with open("/proc/loadavg") as f:
+            # e.g. 0.52 0.58 0.59 3/1024 12345: runnable/total, ourselves included.
+            busy = max(busy, int(f.read().split()[3].split("/")[0]) - 1)
+      except (IOError, IndexError, ValueError):
+         pass
+      freeCPUs = max(0, totalCPUs - int(ceil(busy)))
+      pending = max(0, int(round(busy - totalCPUs)))
+      pressure = cpu_pressure()
+      if pressure is not None:
+         pending = max(pending, int(round(totalCPUs * pressure / 100)))
+      jobIDs = set(name for name in os.listdir("/proc") if name.isdigit())
+      return Snapshot(totalCPUs, freeCPUs, pending, jobIDs,
+                      nodes=[(freeCPUs, memory_available())] if nodes else None)
+
+
+BACKENDS = {
+   "pbs": PBSBackend,
+   "slurm": SlurmBackend,
+   "local": LocalBackend,
+}
+
+
+class SnapshotCache:
+   """
+   Cluster and job state shared by everything that needs it during a tick:
+   the cluster is queried at most once every ttl seconds, whatever the
+   number of consumers, and the worker counts of each job likewise.
+   """
+   def __init__(self, ttl, backend, nodes=False):
+      self.ttl = ttl
+      self.backend = backend
+      self.nodes = nodes
+      self.snapshot = None
+      self.workers = {}  # jobID -> JobStatus
+
+   def age(self):
+      """Seconds since the last snapshot was taken."""
+      return float("inf") if self.snapshot is None else time.time() - self.snapshot.time
+
+   async def get(self):
+      """
+      () -> Snapshot
+      The cluster's state, no older than ttl seconds.
+      """
+      if self.age() >= self.ttl:
+         start = time.time()
+         self.snapshot = await self.backend.snapshot(self.nodes)
+         self.snapshot.latency = time.time() - start
+      return self.snapshot
 
-   # Create the scheduler
-   sched = Scheduler()
+   async def job_status(self, job):
+      """
+      (Job) -> JobStatus
+      job_status(job), no older than ttl seconds.
+      """
+      status = self.workers.get(job.jobID)
+      if status is None or time.time() - status.time >= self.ttl:
+         status = await job_status(job)
+         self.workers[job.jobID] = status
+      return status
 
+   def invalidate(self, jobID):
+      """Forget the worker counts of jobID, after adding or quenching workers."""
+      self.workers.pop(jobID, None)
 
-   # Add event listeners
-   add_event_listeners(sched)
 
+class JobStatus:
+   """
+   What a job's r-parallel-d.pl reports: its workers (W), the workers being
+   quenched (Q) and added (A), and, from a daemon that knows STATUS, its
+   number of tasks, of tasks started and of tasks done, None otherwise.
+   """
+   def __init__(self, workers, quenched, added, jobs=None, started=None, done=None, when=None):
+      self.workers = workers
+      self.quenched = quenched
+      self.added = added
+      self.jobs = jobs
+      self.started = started
+      self.done = done
+      self.time = time.time() if when is None else when
+      # Wall time, in seconds, of the query that got the status.
+      self.latency = None
+
+   def resources(self):
+      """(W, Q, A)"""
+      return self.workers, self.quenched, self.added
+
+   def queued(self):
+      """The tasks not started yet, None if unknown."""
+      return None if self.started is None else self.jobs - self.started
+
+   def running(self):
+      """The tasks started but not done yet, None if unknown."""
+      return None if self.started is None else self.started - self.done
+
+
+num_worker_pattern = re.compile(r"(?:NUM_WORKER )?w:(\d+) q:(\d+) a:(\d+)$")
+status_pattern = re.compile(r"STATUS w:(\d+) q:(\d+) a:(\d+) jobs:(\d+) started:(\d+) done:(\d+)$")
+
+class DaemonClient:
+   """
+   Speaks r-parallel-d.pl's protocol to a job's daemon, like
+   r-parallel-worker.pl -netcat does.  The daemon serves its workers from a
+   single thread and reads one command per connection, closing it once it
+   has replied, so a connection can't be kept open between requests: what
+   is reused is the daemon's address, resolved once.
+   """
+   def __init__(self, host, port, timeout=10):
+      self.host = host
+      self.port = port
+      self.timeout = timeout
+      self.address = None
+      # Daemons started by an older run-parallel.sh don't know STATUS.
+      self.legacy = False
+
+   @staticmethod
+   def from_psub_cmd(psub_cmd):
+      """
+      (str) -> DaemonClient or None
+      The client of the daemon whose -host= and -port= psub_cmd gives to the
+      workers, None if psub_cmd can't be read or doesn't give them.
+      """
+      try:
+         with open(psub_cmd) as f:
+            cmd = f.read()
+      except IOError:
+         return None
+      host = re.search(r"-host=(\S+)", cmd)
+      port = re.search(r"-port=(\d+)", cmd)
+      if not host or not port:
+         return None
+      return DaemonClient(host.group(1), int(port.group(1)))
+
+   def __str__(self):
+      return "{}:{}".format(self.host, self.port)
+
+   async def send(self, message):
+      """
+      (str) -> str
+      Send message to the daemon and return its reply; raises IOError if the
+      daemon can't be reached, e.g. because the job is over.
+      """
+      try:
+         if self.address is None:
+            infos = await asyncio.get_running_loop().getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+            self.address = infos[0][4][:2]
+         reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), self.timeout)
+         try:
+            writer.write((message + "\n").encode("utf-8"))
+            await writer.drain()
+            reply = await asyncio.wait_for(reader.read(), self.timeout)
+         finally:
+            writer.close()
+      except (OSError, asyncio.TimeoutError) as err:
+         raise IOError("Can't send {} to r-parallel-d.pl at {}: {}".format(message, self, err or "timed out"))
+      reply = reply.decode("utf-8", "replace").strip()
+      debug("r-parallel-d.pl at {}: {} -> {}".format(self, message, reply))
+      return reply
+
+   async def status(self):
+      """
+      () -> JobStatus
+      The job's worker counts and, if the daemon knows STATUS, its task counts.
+      """
+      if not self.legacy:
+         reply = await self.send("STATUS")
+         m = status_pattern.match(reply)
+         if m:
+            return JobStatus(*(int(n) for n in m.groups()))
+         self.legacy = True
+      reply = await self.send("NUM_WORKER")
+      m = num_worker_pattern.match(reply)
+      if not m:
+         raise IOError("Unexpected reply from r-parallel-d.pl at {}: {}".format(self, reply))
+      return JobStatus(*(int(n) for n in m.groups()))
+
+   async def add(self, n):
+      """Ask the daemon to launch n more workers."""
+      reply = await self.send("ADD {}".format(n))
+      if reply != "ADDED":
+         raise IOError("Daemon error (response={}), add request failed.".format(reply))
+      # Like run-parallel.sh add, ping the daemon to make it launch the next
+      # extra worker requested.
+      await self.send("PING")
+
+   async def quench(self, n):
+      """Ask the daemon to stop n of its workers."""
+      reply = await self.send("QUENCH {}".format(n))
+      if reply != "QUENCHED":
+         raise IOError("Daemon error (response={}), quench request failed.".format(reply))
+
+
+async def job_status(job):
+   """
+   (Job) -> JobStatus
+   Ask the job's r-parallel-d.pl directly, or run-parallel.sh num_worker when
+   the job's daemon is unknown, e.g. given as a PBS_JOBID.
+   """
+   start = time.time()
+   client = job.client()
+   if client is not None:
+      status = await client.status()
+   else:
+      contents = (await run_command("run-parallel.sh num_worker {}".format(job.target()))).strip().split('\n')[-1]
+      m = num_worker_pattern.match(contents)
+      if not m:
+          fatal_error("Error with regular expression re:{} {}".format(num_worker_pattern, contents))
+      status = JobStatus(*(int(n) for n in m.groups()))
+   status.latency = time.time() - start
+   return status
 
-   # Add user defined cron jobs.
-   add_cronjob(sched, cmd_args)
 
+class Policy:
+   """
+   How r-scheduler.py sizes the jobs.  At each tick, decide() gets the jobs,
+   the cluster's Snapshot and each job's (W, Q, A) worker counts, and returns
+   how many more workers to add to each job, or to quench from it if
+   negative, beyond those already being added or quenched.  Policies are
+   registered in POLICIES and picked with -p.
+   """
+   def __init__(self, cmd_args):
+      self.cmd_args = cmd_args
 
-   # Add the thread that checks if master is still alive.
-   d = IsDaemonAlive(jobID)
-   sched.add_interval_job(d, seconds=60)
+   def decide(self, jobs, snapshot, workers):
+      """
+      ([Job], Snapshot, {str: (int, int, int)}) -> {str: int}
+      """
+      raise NotImplementedError
 
-   # Start the scheduler
-   try:
-      sched.start()
-   except (KeyboardInterrupt, SystemExit):
-      pass
+   def budget(self, snapshot, band=0):
+      """
+      (Snapshot, float) -> int
+      The workers to add, or if negative to quench, to leave
+      cmd_args.freeRessource of the cluster's CPUs free, scaled by
+      --factor-add or --factor-quench; 0 while the free ratio is within band
+      of its target.
+      """
+      totalCPUs = float(snapshot.totalCPUs)
+      gap = float(snapshot.available()) / totalCPUs - self.cmd_args.freeRessource
+      if gap > band:
+         return int(ceil(gap * totalCPUs * self.cmd_args.factor_add))
+      if gap < -band:
+         return -int(-gap * totalCPUs * self.cmd_args.factor_quench)
+      return 0
+
+   def fit(self, jobs, snapshot, adds):
+      """
+      ([Job], Snapshot, {str: int}) -> {str: int}
+      The workers to add to each job trimmed to those that fit on the nodes'
+      free CPUs and memory, with -M.
+      """
+      if snapshot.nodes is None:
+         return adds
+      footprints = dict((job.jobID, job.footprint(self.cmd_args.memory)) for job in jobs)
+      fitted = snapshot.fit(dict((jobID, n) for jobID, n in adds.items() if n > 0), footprints)
+      for jobID, n in fitted.items():
+         if n < adds[jobID]:
+            debug("Job {J}: only {n} of {w} workers fit on the nodes ({G:.3g}GB each)".format(
+                   J = jobID, n = n, w = adds[jobID], G = footprints[jobID]))
+      return dict(adds, **fitted)
+
+   def add_cost(self, jobs):
+      """The cost to allot() workers to add among jobs, as -s says."""
+      weight = dict((job.jobID, job.weight) for job in jobs)
+      if self.cmd_args.share == "priority":
+         return lambda jobID, n: (-weight[jobID], n)
+      return lambda jobID, n: (n + 1) / weight[jobID]
+
+   def quench_cost(self, jobs, running):
+      """The cost to allot() workers to quench among jobs, as -s says."""
+      weight = dict((job.jobID, job.weight) for job in jobs)
+      if self.cmd_args.share == "priority":
+         return lambda jobID, n: (weight[jobID], n)
+      return lambda jobID, n: -(running[jobID] - n) / weight[jobID]
+
+
+class FreeResourcePolicy(Policy):
+   """
+   Add or quench workers to leave cmd_args.freeRessource of the cluster's
+   CPUs free, whatever the jobs have left to do but the number of their
+   tasks.
+   """
+   def decide(self, jobs, snapshot, workers):
+      budget = self.budget(snapshot)
+      if budget > 0:
+         # A job can't use more workers than it has tasks left.
+         caps = {}
+         for job in jobs:
+            left = job.tasks_left()
+            caps[job.jobID] = budget if left is None else max(0, left - workers[job.jobID][0])
+         shares = allot(budget, self.add_cost(jobs), caps)
+         return self.fit(jobs, snapshot, dict((jobID, max(0, share - workers[jobID][2]))
+                                              for jobID, share in shares.items()))
+      # Make sure there is at least a minimum number of worker running.
+      caps = dict((jobID, max(0, w[0] - self.cmd_args.minimumNumberOfWorker)) for jobID, w in workers.items())
+      running = dict((jobID, w[0]) for jobID, w in workers.items())
+      shares = allot(-budget, self.quench_cost(jobs, running), caps)
+      return dict((jobID, -max(0, share - workers[jobID][1])) for jobID, share in shares.items())
+
+
+def fewest_workers(left, n):
+   """
+   (int, int) -> int
+   The fewest workers that run left tasks in as few rounds as n workers do.
+   """
+   if left is None or n <= 0:
+      return max(0, n)
+   if left == 0:
+      return 0
+   return int(ceil(left / ceil(left / n)))
+
+
+def makespan(left, running, extra, duration, startup):
+   """
+   (int, int, int, float, float) -> float
+   How soon running workers, and extra workers starting in startup seconds,
+   can complete left tasks of duration seconds each: the least, over the
+   rounds b each extra worker does, of the time the extra workers take for
+   their b rounds and the running workers for the tasks left to them.
+   """
+   if left <= 0:
+      return 0.0
+   best = float("inf")
+   for b in range(int(ceil(left / extra)) + 1 if extra > 0 else 1):
+      rest = max(0, left - extra * b)
+      if rest > 0 and running <= 0:
+         continue
+      a = int(ceil(rest / running)) if rest > 0 else 0
+      best = min(best, max(a * duration, startup + b * duration if b > 0 else 0.0))
+   return best
+
+
+def fewest_extra_workers(left, running, extra, duration, startup):
+   """
+   (int, int, int, float, float) -> int
+   The fewest of extra workers that complete left tasks with running workers
+   as soon as all extra workers do, by makespan().
+   """
+   best = makespan(left, running, extra, duration, startup)
+   # makespan() never grows with more workers: bisect the fewest reaching best.
+   low, high = 0, extra
+   while low < high:
+      middle = (low + high) // 2
+      if makespan(left, running, middle, duration, startup) <= best:
+         high = middle
+      else:
+         low = middle + 1
+   return low
+
+
+class ThroughputPolicy(Policy):
+   """
+   Give each job the workers that finish it soonest.  From the tasks a job
+   has left, the rate at which its workers complete them, as its daemon or
+   rc file tell from tick to tick, and the time a new worker takes to start (-L),
+   a job's makespan() with n more workers counts the tasks its current
+   workers complete and those the new ones complete once started; a job can
+   use the fewest workers beyond which its makespan stops improving.  The
+   free CPUs are split among the jobs up to the workers they can use, workers
+   that can't shorten their job are quenched, and CPUs are given back when
+   the cluster runs short of them.
+
+   To avoid thrashing, the cluster is only short of or rich in CPUs beyond a
+   band (-B) around the -f target, and a job isn't quenched within a
+   cooldown (-C) of being added to, nor added to within one of being
+   quenched.
+   """
+   # Weight of the latest measure in the smoothed completion rates.
+   SMOOTHING = 0.5
+
+   def __init__(self, cmd_args):
+      super(ThroughputPolicy, self).__init__(cmd_args)
+      self.progress = {}  # jobID -> (time, tasks done)
+      self.rates = {}     # jobID -> tasks completed per second per worker
+      self.changes = {}   # jobID -> (time, 1 or -1) of its last add or quench
+
+   @staticmethod
+   def counts(job):
+      """
+      (Job) -> (float, int, int) or None
+      When and how many tasks job has and has done, from its daemon's STATUS
+      if it knows it, else from its jobs and rc files; None if unknown.
+      """
+      status = job.status
+      if status is not None and status.done is not None:
+         return status.time, status.jobs, status.done
+      progress = job.progress()
+      if progress is None:
+         return None
+      return (time.time(),) + progress
+
+   def rate(self, job, running):
+      """
+      (Job, int) -> float or None
+      The smoothed rate at which each of job's running workers completes
+      tasks, in tasks per second, None until it can be measured.
+      """
+      counts = self.counts(job)
+      if counts is None:
+         return None
+      now, done = counts[0], counts[2]
+      previous = self.progress.get(job.jobID)
+      if previous is None or now > previous[0]:
+         self.progress[job.jobID] = (now, done)
+      if previous is not None and now > previous[0] and running > 0:
+         rate = max(0, done - previous[1]) / (now - previous[0]) / running
+         old = self.rates.get(job.jobID)
+         self.rates[job.jobID] = rate if old is None else self.SMOOTHING * rate + (1 - self.SMOOTHING) * old
+      return self.rates.get(job.jobID)
+
+   def useful(self, left, running, rate):
+      """
+      (int, int, float) -> int or None
+      The workers that complete a job with left tasks soonest, running
+      workers completing rate tasks per second each; None if unknown.
+      """
+      if left is None:
+         return None
+      if rate and running > 0:
+         extra = fewest_extra_workers(left, running, left, 1 / rate, self.cmd_args.startup)
+         if extra == 0:
+            # No new worker would start soon enough to help: keep the fewest
+            # current workers that take as many rounds of tasks.
+            return fewest_workers(left, running)
+         return running + extra
+      return left
+
+   def trim(self, left, running, rate, share):
+      """
+      (int, int, float, int) -> int
+      The fewest of share more workers that complete a job as soon as all of
+      them do.
+      """
+      if left is not None and rate and running > 0:
+         return fewest_extra_workers(left, running, share, 1 / rate, self.cmd_args.startup)
+      return max(0, fewest_workers(left, running + share) - running)
+
+   def allowed(self, jobID, sign, now):
+      """Whether the cooldown lets jobID's workers change in direction sign."""
+      when, last = self.changes.get(jobID, (None, sign))
+      return last == sign or now - when >= self.cmd_args.cooldown
+
+   def decide(self, jobs, snapshot, workers):
+      now = time.time()
+      running, left, useful, rates = {}, {}, {}, {}
+      for job in jobs:
+         W, Q, A = workers[job.jobID]
+         running[job.jobID] = max(0, W + A - Q)
+         rate = rates[job.jobID] = self.rate(job, W)
+         counts = self.counts(job)
+         left[job.jobID] = None if counts is None else max(0, counts[1] - counts[2])
+         useful[job.jobID] = self.useful(left[job.jobID], running[job.jobID], rate)
+         debug("Job {J}: {L} tasks left, {R} tasks/s/worker, {U} useful workers".format(
+                J = job.jobID, L = left[job.jobID], R = rate, U = useful[job.jobID]))
+
+      deltas = dict.fromkeys(running, 0)
+      budget = self.budget(snapshot, self.cmd_args.band)
+      if budget > 0:
+         caps = {}
+         for jobID in running:
+            if self.allowed(jobID, 1, now):
+               caps[jobID] = budget if useful[jobID] is None else max(0, useful[jobID] - running[jobID])
+         shares = allot(budget, self.add_cost(jobs), caps)
+         for jobID, share in shares.items():
+            if share > 0:
+               deltas[jobID] = self.trim(left[jobID], running[jobID], rates[jobID], share)
+         deltas = self.fit(jobs, snapshot, deltas)
+
+      # Make sure there is at least a minimum number of worker running.
+      caps = dict((jobID, max(0, n - self.cmd_args.minimumNumberOfWorker)) for jobID, n in running.items()
+                  if deltas[jobID] == 0 and self.allowed(jobID, -1, now))
+      quench = {}
+      for jobID in caps:
+         if useful[jobID] is not None and useful[jobID] < running[jobID]:
+            quench[jobID] = min(caps[jobID], running[jobID] - useful[jobID])
+            caps[jobID] -= quench[jobID]
+      if budget < 0:
+         shares = allot(max(0, -budget - sum(quench.values())), self.quench_cost(jobs, running), caps)
+         for jobID, share in shares.items():
+            quench[jobID] = quench.get(jobID, 0) + share
+      for jobID, n in quench.items():
+         deltas[jobID] = -n
+
+      for jobID, delta in deltas.items():
+         if delta != 0:
+            self.changes[jobID] = (now, 1 if delta > 0 else -1)
+      return deltas
+
+
+POLICIES = {
+   "free": FreeResourcePolicy,
+   "throughput": ThroughputPolicy,
+}
+
+
+async def scale(jobs, snapshot, snapshots, policy, cmd_args, metrics=None):
+   """
+   Add or quench workers of jobs as policy decides, and record the tick in
+   metrics.
+   """
+   start = time.time()
+   workers = {}
+   for job in list(jobs):
+      try:
+         job.status = await snapshots.job_status(job)
+      except (IOError, CalledProcessError) as err:
+         # e.g. a job that finished since qstat listed it.
+         warn("Skipping job {}: {}".format(job.jobID, err))
+         continue
+      workers[job.jobID] = job.status.resources()
+      currentNumberOfWorker, workersQuenched, workersAdded = workers[job.jobID]
+      info("STATUS: {J} ({W} + {A} - {Q}) / {T} CPUs, {F} free (minimum {R}% free)".format(
+             J = job.jobID,
+             W = currentNumberOfWorker,
+             A = workersAdded,
+             Q = workersQuenched,
+             T = snapshot.totalCPUs,
+             F = snapshot.available(),
+             R = cmd_args.freeRessource))
+      if job.status.started is not None:
+         debug("Job {J}: {N} tasks, {S} queued, {U} running, {D} done".format(
+                J = job.jobID, N = job.status.jobs, S = job.status.queued(),
+                U = job.status.running(), D = job.status.done))
+   jobs = [job for job in jobs if job.jobID in workers]
+   deltas = policy.decide(jobs, snapshot, workers)
+   latencies = await request(jobs, deltas, snapshots, cmd_args)
+   if metrics is not None:
+      metrics.record(start, snapshot, jobs, deltas, latencies)
+
+
+async def request(jobs, deltas, snapshots, cmd_args):
+   """
+   Ask run-parallel.sh to add deltas[jobID] workers to each job, or to
+   quench -deltas[jobID] workers from it if negative; returns the wall time
+   of each request, in seconds.
+   """
+   latencies = {}
+   for job in jobs:
+      x = deltas.get(job.jobID, 0)
+      if x != 0:
+         action = "add" if x > 0 else "quench"
+         if not cmd_args.notReally:
+            client = job.client()
+            start = time.time()
+            try:
+               if client is None:
+                  await run_command("run-parallel.sh {} {} {} &> /dev/null".format(action, abs(x), job.target()))
+               elif action == "add":
+                  await client.add(x)
+               else:
+                  await client.quench(-x)
+            except (IOError, CalledProcessError) as err:
+               warn("Job {}: {}".format(job.jobID, err))
+               continue
+            latencies[job.jobID] = time.time() - start
+            snapshots.invalidate(job.jobID)
+            if action == "add":
+               info("Dynamically adding {w} worker(s) to job {J}".format(w = x, J = job.jobID))
+            else:
+               info("Dynamically quenching {w} worker(s) from job {J}".format(w = -x, J = job.jobID))
+   return latencies
+
+
+class Metrics:
+   """
+   What r-scheduler.py saw and decided at each tick, one record per job: the
+   cluster's CPUs and pending jobs, the job's W/Q/A workers and tasks, the
+   workers added (> 0) or quenched (< 0), and the wall time of the queries
+   behind them.  Records are appended to a CSV file, or a JSON lines file,
+   and the latest tick is also written as a Prometheus textfile, e.g. for
+   node_exporter's textfile collector.
+   """
+   FIELDS = ("time", "job", "policy", "total_cpus", "free_cpus", "pending", "available",
+             "free_target", "workers", "quenched", "added", "tasks", "started", "done",
+             "decision", "snapshot_age", "snapshot_seconds", "status_seconds",
+             "request_seconds", "tick_seconds")
+
+   def __init__(self, cmd_args):
+      """Initialize with the -o and -x files of cmd_args, either of which may be None."""
+      self.cmd_args = cmd_args
+      self.textfile = cmd_args.textfile
+      self.writer = None
+      self.file = None
+      if cmd_args.metrics is not None:
+         self.file = open(cmd_args.metrics, "a")
+         if cmd_args.metrics.endswith(".csv"):
+            self.writer = csv.DictWriter(self.file, self.FIELDS)
+            if self.file.tell() == 0:
+               self.writer.writeheader()
+      # Workers added and quenched since the daemon started, per job.
+      self.added = {}
+      self.quenched = {}
+
+   def close(self):
+      if self.file is not None:
+         self.file.close()
+
+   def record(self, start, snapshot, jobs, deltas, latencies):
+      """
+      (float, Snapshot, [Job], {str: int}, {str: float}) -> None
+      Record the tick that started at time start.
+      """
+      now = time.time()
+      seconds = lambda latency: None if latency is None else round(latency, 6)
+      records = []
+      for job in jobs:
+         status, decision = job.status, deltas.get(job.jobID, 0)
+         if decision > 0:
+            self.added[job.jobID] = self.added.get(job.jobID, 0) + decision
+         elif decision < 0:
+            self.quenched[job.jobID] = self.quenched.get(job.jobID, 0) - decision
+         records.append({
+            "time": round(now, 3),
+            "job": job.jobID,
+            "policy": self.cmd_args.policy,
+            "total_cpus": snapshot.totalCPUs,
+            "free_cpus": snapshot.freeCPUs,
+            "pending": snapshot.pending,
+            "available": snapshot.available(),
+            "free_target": self.cmd_args.freeRessource,
+            "workers": status.workers,
+            "quenched": status.quenched,
+            "added": status.added,
+            "tasks": status.jobs,
+            "started": status.started,
+            "done": status.done,
+            "decision": decision,
+            "snapshot_age": round(now - snapshot.time, 3),
+            "snapshot_seconds": seconds(snapshot.latency),
+            "status_seconds": seconds(status.latency),
+            "request_seconds": seconds(latencies.get(job.jobID)),
+            "tick_seconds": round(now - start, 6),
+         })
+      if self.file is not None:
+         for record in records:
+            if self.writer is not None:
+               self.writer.writerow(record)
+            else:
+               print(json.dumps(record, sort_keys=True), file=self.file)
+         self.file.flush()
+      if self.textfile is not None:
+         self.write_textfile(now, snapshot, records)
+
+   # The Prometheus metrics written by write_textfile(): name, record field or
+   # None, and help; per job metrics are labelled with the job.
+   GAUGES = (
+      ("r_scheduler_cpus", "total_cpus", "CPUs of the cluster."),
+      ("r_scheduler_cpus_free", "free_cpus", "Free CPUs of the cluster."),
+      ("r_scheduler_jobs_pending", "pending", "Jobs pending in the cluster's queue."),
+      ("r_scheduler_free_target_ratio", "free_target", "Ratio of the CPUs to leave free (-f)."),
+      ("r_scheduler_snapshot_age_seconds", "snapshot_age", "Age of the cluster snapshot used."),
+      ("r_scheduler_snapshot_query_seconds", "snapshot_seconds", "Wall time of the query for the cluster snapshot."),
+      ("r_scheduler_tick_seconds", "tick_seconds", "Wall time of the last tick."),
+   )
+   JOB_GAUGES = (
+      ("r_scheduler_workers", "workers", "Workers of the job (W)."),
+      ("r_scheduler_workers_quenching", "quenched", "Workers of the job being quenched (Q)."),
+      ("r_scheduler_workers_adding", "added", "Workers being added to the job (A)."),
+      ("r_scheduler_tasks", "tasks", "Tasks of the job."),
+      ("r_scheduler_tasks_started", "started", "Tasks of the job started."),
+      ("r_scheduler_tasks_done", "done", "Tasks of the job done."),
+      ("r_scheduler_decision_workers", "decision", "Workers added (> 0) or quenched (< 0) at the last tick."),
+      ("r_scheduler_status_query_seconds", "status_seconds", "Wall time of the query for the job's status."),
+      ("r_scheduler_request_seconds", "request_seconds", "Wall time of the last add or quench request."),
+   )
+
+   def write_textfile(self, now, snapshot, records):
+      """Replace the -x textfile with the metrics of the latest tick."""
+      lines = []
+      def metric(name, kind, help, samples):
+         samples = [(labels, value) for labels, value in samples if value is not None]
+         if samples:
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+               lines.append("{}{} {}".format(name, labels, value))
+      label = lambda jobID, **more: "{" + ",".join('{}="{}"'.format(k, v)
+                                                   for k, v in [("job", jobID)] + sorted(more.items())) + "}"
+      first = records[0] if records else {"total_cpus": snapshot.totalCPUs, "free_cpus": snapshot.freeCPUs,
+                                          "pending": snapshot.pending, "free_target": self.cmd_args.freeRessource,
+                                          "snapshot_age": round(now - snapshot.time, 3),
+                                          "snapshot_seconds": snapshot.latency and round(snapshot.latency, 6)}
+      for name, field, help in self.GAUGES:
+         metric(name, "gauge", help, [("", first.get(field))])
+      for name, field, help in self.JOB_GAUGES:
+         metric(name, "gauge", help, [(label(record["job"]), record[field]) for record in records])
+      metric("r_scheduler_workers_changed_total", "counter", "Workers added or quenched since the daemon started.",
+             [(label(jobID, action="add"), n) for jobID, n in sorted(self.added.items())] +
+             [(label(jobID, action="quench"), n) for jobID, n in sorted(self.quenched.items())])
+      metric("r_scheduler_last_tick_timestamp_seconds", "gauge", "When the last tick ended.", [("", round(now, 3))])
+
+      # Write to a temporary file first: the collector must never read half a file.
+      tmp = "{}.{}.tmp".format(self.textfile, os.getpid())
+      with open(tmp, "w") as f:
+         f.write("\n".join(lines) + "\n")
+      os.rename(tmp, self.textfile)
+
+
+class Daemon:
+   """
+   The control loop of r-scheduler.py and the tasks waking it up, all running
+   on one asyncio event loop: the loop checks the cluster and scales the jobs
+   every -b minutes, or sooner when woken up by a cron job, a change in the
+   jobs' run-p directories or SIGUSR1, but never queries the cluster more
+   often than every -t TTL seconds.
+   """
+   def __init__(self, cmd_args):
+      self.cmd_args = cmd_args
+      self.jobs = JobSet(cmd_args.psub_cmd_or_PBS_JOBID, cmd_args.weights)
+      # Cluster state, queried once per tick and shared by all its consumers.
+      self.snapshots = SnapshotCache(cmd_args.ttl, BACKENDS[cmd_args.backend](cmd_args),
+                                     nodes=cmd_args.memory is not None)
+      self.crons = add_cronjob(cmd_args)
+      self.policy = POLICIES[cmd_args.policy](cmd_args)
+      try:
+         self.metrics = Metrics(cmd_args)
+      except IOError as err:
+         fatal_error("Can't open {}: {}".format(cmd_args.metrics, err))
+      self.wake = None
+
+   async def cron(self, trigger, value, name, fonction):
+      """Call fonction(value) each time trigger fires, and wake the loop up."""
+      after = datetime.now()
+      while True:
+         when = next_fire_time(trigger, after)
+         if when is None:
+            info("Cron job {} will not fire again".format(name))
+            return
+         await asyncio.sleep(max(0, (when - datetime.now()).total_seconds()))
+         fonction(value)
+         self.wake.set()
+         after = when + timedelta(seconds=1)
+
+   def events(self, jobs):
+      """
+      ([Job]) -> set
+      What the loop reacts to in the jobs' run-p directories: the jobs found
+      and which of jobs are finished.  Only reads what was appended to their
+      rc files since the last call.
+      """
+      found = set(jobID for jobID, path in self.jobs.discover())
+      finished = set(job.jobID for job in jobs
+                     if job.psub_cmd is not None and (not os.path.exists(job.psub_cmd) or job.tasks_left() == 0))
+      return found, finished
+
+   async def watch(self):
+      """
+      Wake the loop up whenever events() changes, calling it in a thread so
+      that its file I/O never blocks the loop.
+      """
+      loop = asyncio.get_running_loop()
+      # List the jobs on the loop: refresh() may change them while events() runs.
+      previous = await loop.run_in_executor(None, self.events, list(self.jobs))
+      while True:
+         await asyncio.sleep(self.cmd_args.watch_interval)
+         current = await loop.run_in_executor(None, self.events, list(self.jobs))
+         if current != previous:
+            debug("Jobs changed: {}".format(current))
+            self.wake.set()
+         previous = current
+
+   async def run(self):
+      self.wake = asyncio.Event()
+      loop = asyncio.get_running_loop()
+      loop.add_signal_handler(signal.SIGUSR1, self.wake.set)
+      tasks = [asyncio.ensure_future(self.cron(*cron)) for cron in self.crons]
+      tasks.append(asyncio.ensure_future(self.watch()))
+      try:
+         while True:
+            self.wake.clear()
+            snapshot = await self.snapshots.get()
+            # Pick up new jobs and drop those that finished.
+            self.jobs.refresh(snapshot)
+            if not self.jobs:
+               info("No job left to monitor")
+               break
+
+            await scale(self.jobs, snapshot, self.snapshots, self.policy, self.cmd_args, self.metrics)
+
+            try:
+               await asyncio.wait_for(self.wake.wait(), timeout=60 * self.cmd_args.burst_interval)
+            except asyncio.TimeoutError:
+               continue
+            # Woken up: wait until the snapshot can be refreshed.
+            await asyncio.sleep(max(0, self.snapshots.ttl - self.snapshots.age()))
+      except CalledProcessError as err:
+         warn("Process Error {}".format(err.returncode))
+      finally:
+         for task in tasks:
+            task.cancel()
+         self.metrics.close()
+         loop.remove_signal_handler(signal.SIGUSR1)
+
+
+def main():
+   # Parse command line arguments.
+   cmd_args = get_args()
 
-   factor_add = 0.25
-   factor_quench = 1
    try:
-      while d.KeepRunning:
-         totalCPUs, freeCPUs = cluster_resources()
-
-         currentNumberOfWorker, workersQuenched, workersAdded = job_resources(jobID)
-
-         info("STATUS: ({W} + {A} - {Q}) / {T} CPUs, {F} free (minimum {R}% free)".format(
-                W = currentNumberOfWorker,
-                A = workersAdded,
-                Q = workersQuenched,
-                T = totalCPUs,
-                F = freeCPUs,
-                R = cmd_args.freeRessource))
-
-         currentlyFreeResource = float(freeCPUs) / float(totalCPUs)
-         if currentlyFreeResource > cmd_args.freeRessource:
-            x = int(ceil((currentlyFreeResource - cmd_args.freeRessource) * (float(totalCPUs) * factor_add))) - workersAdded
-            x = max(0, x)
-            if x > 0:
-               cmd = "run-parallel.sh add " + str(x) + " " + jobID
-               debug(cmd)
-               if not cmd_args.notReally:
-                  check_call(cmd + " &> /dev/null", shell=True)
-                  info("Dynamically adding {w} worker(s) to job {J}".format(w = x, J = jobID))
-         else:
-            # Make sure there is at least a minimum number of worker running.
-            if currentNumberOfWorker > cmd_args.minimumNumberOfWorker:
-               x = (cmd_args.freeRessource - currentlyFreeResource) * (float(totalCPUs) * factor_quench) - workersQuenched
-               x = max(0, x) # we cannot remove a negative number of workers.
-               # Never quench below the minimum number of workers.
-               x = int(min(x, currentNumberOfWorker-cmd_args.minimumNumberOfWorker))
-               if x > 0:
-                  cmd = "run-parallel.sh quench " + str(x) + " " + jobID
-                  debug(cmd)
-                  if not cmd_args.notReally:
-                     check_call(cmd + " &> /dev/null", shell=True)
-                     info("Dynamically quenching {w} worker(s) from job {J}".format(w = x, J = jobID))
-
-         time.sleep(60 * cmd_args.burst_interval)
-   except CalledProcessError as err:
-      warn("Process Error ".format(err.returncode))
-      sched.shutdown(wait=False)
+      asyncio.run(Daemon(cmd_args).run())
+   except KeyboardInterrupt:
+      pass
 
 
 if __name__ == '__main__':
@@ -0,0 +1,714 @@
+#!/usr/bin/env python3
+
+# @file rp-utilization.py
+# @brief Utilization, idle time, queue waits and churn from run-parallel.sh
+#        and r-scheduler.py logs.
+#
+# Traitement multilingue de textes / Multilingual Text Processing
+# Centre de recherche en technologies numeriques / Digital Technologies Research Centre
+# Conseil national de recherches Canada / National Research Council Canada
+# Copyright 2026, Sa Majeste le Roi du Chef du Canada /
+# Copyright 2026, His Majesty the King in Right of Canada
+
+from __future__ import print_function, division
+
+import sys
+import os
+import re
+import csv
+import gzip
+import json
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+try:
+   import numpy as np
+except ImportError:
+   print("rp-utilization.py: Fatal error: NumPy is required, e.g.: pip install numpy", file=sys.stderr)
+   sys.exit(1)
+
+
+# Size of the blocks of whole lines searched at once.
+BLOCK_SIZE = 64 << 20
+
+# What r-parallel-d.pl logs, as run-parallel.sh -v, -v -v or -d show it:
+#    [Fri Oct 16 09:12:01 2026] starting (node12:4567) (5) cmd
+#    [Fri Oct 16 09:12:31 2026] 3/100 DONE (node12:4567) (rc=0) (5) cmd
+# Groups: time, tasks of the run, kind, worker, rc, task number, count.
+DAEMON_EVENT = re.compile(
+   br"^\[(\w{3} \w{3} [ \d]\d \d\d:\d\d:\d\d \d{4})\] (?:\d+/(\d+) )?"
+   br"(started listening|starting|DONE-STOPPING|DONE|GET|quenching|returning: \*\*\*EMPTY|"
+   br"Launching worker|ADD|QUENCH)"
+   br"(?: \(([^)\n]*)\))?(?: \**\(rc=(-?\d+)\)\**)?(?: \((\d+)\)| (\d+))?", re.M)
+
+# The kinds of daemon events.
+STARTED, STARTING, STOPPING, DONE, GET, QUENCHING, EMPTY, LAUNCH, ADD, QUENCH = range(10)
+KINDS = {
+   b"started listening": STARTED,
+   b"starting": STARTING,
+   b"DONE-STOPPING": STOPPING,
+   b"DONE": DONE,
+   b"GET": GET,
+   b"quenching": QUENCHING,
+   b"returning: ***EMPTY": EMPTY,
+   b"Launching worker": LAUNCH,
+   b"ADD": ADD,
+   b"QUENCH": QUENCH,
+}
+
+# What r-scheduler.py logs at each tick and for each of its requests.
+# Groups: year, month, day, hour, minute, second, then job, workers, added,
+# quenched, total and available CPUs for STATUS_LINE, or kind, count and job for
+# REQUEST_LINE.
+STATUS_LINE = re.compile(
+   br"^(\d+)-(\d+)-(\d+) (\d+):(\d+):([\d.]+) STATUS: (?:(\S+) )?"
+   br"\((\d+) \+ (\d+) - (\d+)\) / (\d+) CPUs, (-?[\d.]+) free", re.M)
+REQUEST_LINE = re.compile(
+   br"^(\d+)-(\d+)-(\d+) (\d+):(\d+):([\d.]+) Dynamically (adding|quenching) (\d+) "
+   br"worker\(s\) (?:to|from) job (\S+)", re.M)
+
+MONTHS = dict((month, i) for i, month in enumerate(b"Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()))
+# Also by the day of the week and month that start Perl's localtime() strings.
+MONTHS.update((day + b" " + month, i) for month, i in list(MONTHS.items())
+              for day in b"Sun Mon Tue Wed Thu Fri Sat".split())
+
+# Bounds, in seconds, of the queue wait histogram.
+WAIT_BINS = (0, 10, 60, 300, 1800, 7200, float("inf"))
+
+PERCENTILES = (50, 90, 99)
+
+
+def get_args():
+   """Command line argument processing."""
+
+   usage = "rp-utilization.py [options] [LOG ...]"
+   help = """
+   Report how well run-parallel.sh jobs used their workers, from the logs of
+   their daemon, r-parallel-d.pl, and of r-scheduler.py.
+
+   Logs are searched in large blocks and their events turned into columns of
+   NumPy arrays, so that all the runs they hold, over months of history, are
+   analyzed at once.  A log may hold several runs of run-parallel.sh, one
+   after the other; logs may be gzipped; - or no LOG reads standard input.
+   r-scheduler.py's -o metrics files, ending in .csv or .jsonl, are read as
+   well.
+
+   For each run of run-parallel.sh, found with -v or more: its tasks and
+   failures, the worker time its workers held, from their first request for
+   a task to their exit, the part of it busy running tasks, the rest idle,
+   and the utilization, busy over held.  Queue waits, from a worker's
+   submission to its first request, are estimated by pairing submissions and
+   first requests in order, and need the full daemon log, from
+   run-parallel.sh -v -v or -d.  Churn is ADD and QUENCH requests undoing
+   each other within -w seconds: each such reversal counts the workers it
+   undoes times the seconds between the two requests.
+
+   From r-scheduler.py's STATUS lines or -o metrics: the share of the
+   cluster's CPUs busy, and the churn of its requests for each job.
+
+   With -c, utilization curves go to a TSV file: per run and for all runs
+   (run *), the mean workers held, the mean tasks running and their ratio
+   in each -i second interval, with, for all runs, the cluster's busy share.
+   """
+
+   parser = ArgumentParser(usage=usage, description=help,
+                           formatter_class=RawDescriptionHelpFormatter, add_help=False)
+   parser.add_argument("-h", "--help", action="help",
+                       help="print this help message and exit")
+   parser.add_argument("-i", dest="interval", type=float, default=300,
+                       help="seconds per point of the -c curves [%(default)s]")
+   parser.add_argument("-w", dest="window", type=float, default=300,
+                       help="seconds within which opposite requests count as churn [%(default)s]")
+   parser.add_argument("-c", dest="curves", type=str, default=None,
+                       help="write the utilization curves to CURVES, a TSV file [don't]")
+   parser.add_argument("-s", dest="summary", action="store_true", default=False,
+                       help="only print the totals, not each run [%(default)s]")
+   parser.add_argument("--json", dest="json", action="store_true", default=False,
+                       help="print the report as JSON [%(default)s]")
+   parser.add_argument("logs", nargs="*", default=["-"],
+                       help="run-parallel.sh or r-scheduler.py logs, or r-scheduler.py -o metrics [-]")
+
+   args = parser.parse_args()
+   if args.interval <= 0:
+      parser.error("-i must be positive")
+   return args
+
+
+def blocks(filename, block_size=BLOCK_SIZE):
+   """Yield the contents of filename, gzipped or not, in blocks of whole lines."""
+   if filename == "-":
+      f = sys.stdin.buffer
+   elif filename.endswith(".gz"):
+      f = gzip.open(filename, "rb")
+   else:
+      f = open(filename, "rb")
+   try:
+      rest = b""
+      while True:
+         block = f.read(block_size)
+         if not block:
+            break
+         block = rest + block
+         cut = block.rfind(b"\n") + 1
+         rest = block[cut:]
+         if cut:
+            yield block[:cut]
+      if rest:
+         yield rest
+   finally:
+      if f is not sys.stdin.buffer:
+         f.close()
+
+
+def ints(column):
+   """An integer array of column, an array of decimal bytes, some of them empty."""
+   return np.where(column == b"", b"0", column).astype(np.int64)
+
+
+def codes(column, table):
+   """The codes table gives the values of column, looking up each distinct value once."""
+   values, inverse = np.unique(column, return_inverse=True)
+   return np.array([table.get(value, 0) for value in values], dtype=np.int64)[inverse]
+
+
+def clock(year, month, day, hour, minute, second):
+   """
+   Seconds from 1970-01-01 00:00 to the dates and times given as arrays,
+   month counting from 0.  Logs give local times: durations are right,
+   except across daylight saving time changes.
+   """
+   days = ((year - 1970) * 12 + month).astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+   return (days + day - 1) * 86400.0 + hour * 3600 + minute * 60 + second
+
+
+def digits(chars):
+   """The numbers written by the columns of chars, an array of ASCII codes, spaces counting as 0."""
+   values = np.maximum(chars.astype(np.int64) - ord("0"), 0)
+   return values.dot(10 ** np.arange(chars.shape[1] - 1, -1, -1))
+
+
+def perl_clock(times):
+   """
+   clock() of times, an array of Perl's localtime() strings, all of the
+   same width, e.g. "Fri Oct  9 09:12:01 2026".
+   """
+   chars = times.view(np.uint8).reshape(len(times), -1)
+   return clock(digits(chars[:, 20:24]), codes(times.astype("S7"), MONTHS), digits(chars[:, 8:10]),
+                digits(chars[:, 11:13]), digits(chars[:, 14:16]), digits(chars[:, 17:19]))
+
+
+def columns(matches):
+   """The groups of the matches of a regex, as one array of bytes per group."""
+   return [np.array(column) for column in zip(*matches)]
+
+
+def parse_daemon(block, source):
+   """The daemon events of block, as a dict of arrays."""
+   matches = DAEMON_EVENT.findall(block)
+   if not matches:
+      return None
+   when, num, kind, worker, rc, task, n = columns(matches)
+   return {
+      "source": np.full(len(matches), source, dtype=np.int64),
+      "time": perl_clock(when),
+      "kind": codes(kind, KINDS),
+      "worker": worker,
+      "rc": ints(rc),
+      "task": ints(task),
+      "num": ints(num),
+      "n": ints(n),
+   }
+
+
+def log_clock(year, month, day, hour, minute, second):
+   """clock() of the date and time groups of STATUS_LINE and REQUEST_LINE."""
+   return clock(ints(year), ints(month) - 1, ints(day), ints(hour), ints(minute), second.astype(float))
+
+
+def parse_scheduler(block):
+   """The STATUS lines and the requests of block, as dicts of arrays, or None."""
+   status = requests = None
+   matches = STATUS_LINE.findall(block) if b" STATUS: " in block else None
+   if matches:
+      year, month, day, hour, minute, second, job, _, _, _, total, free = columns(matches)
+      status = {
+         "time": log_clock(year, month, day, hour, minute, second),
+         "job": job.astype(str),
+         "total": ints(total),
+         "free": free.astype(float),
+      }
+   matches = REQUEST_LINE.findall(block) if b" Dynamically " in block else None
+   if matches:
+      year, month, day, hour, minute, second, kind, n, job = columns(matches)
+      requests = {
+         "time": log_clock(year, month, day, hour, minute, second),
+         "job": job.astype(str),
+         "n": np.where(kind == b"adding", 1, -1) * ints(n),
+      }
+   return status, requests
+
+
+def local_time(seconds):
+   """seconds since the epoch, as time.time() gives them, on the clock of the logs."""
+   return seconds + time.localtime(seconds).tm_gmtoff
+
+
+def parse_metrics(filename):
+   """The ticks and requests recorded by r-scheduler.py -o in filename."""
+   with (gzip.open if filename.endswith(".gz") else open)(filename, "rt") as f:
+      if filename.endswith((".jsonl", ".jsonl.gz")):
+         rows = [json.loads(line) for line in f if line.strip()]
+      else:
+         rows = list(csv.DictReader(f))
+   # A restarted daemon appends to its -o file, header included.
+   rows = [row for row in rows if row.get("time") not in (None, "", "time")]
+   if not rows:
+      return None, None
+   number = lambda field: np.array([float(row.get(field) or 0) for row in rows])
+   when = np.array([local_time(float(row["time"])) for row in rows])
+   job = np.array([str(row["job"]) for row in rows])
+   decision = number("decision").astype(np.int64)
+   status = {
+      "time": when,
+      "job": job,
+      "total": number("total_cpus").astype(np.int64),
+      "free": number("available"),
+   }
+   changed = decision != 0
+   requests = {"time": when[changed], "job": job[changed], "n": decision[changed]}
+   return status, requests
+
+
+def concatenate(tables):
+   """One dict of arrays from a list of them, None if the list is empty."""
+   tables = [table for table in tables if table is not None]
+   if not tables:
+      return None
+   return dict((key, np.concatenate([table[key] for table in tables])) for key in tables[0])
+
+
+def read_logs(filenames):
+   """The daemon events, scheduler ticks and scheduler requests of filenames."""
+   daemon, status, requests = [], [], []
+   for source, filename in enumerate(filenames):
+      if filename.endswith((".csv", ".jsonl", ".csv.gz", ".jsonl.gz")):
+         ticks, changes = parse_metrics(filename)
+         status.append(ticks)
+         requests.append(changes)
+         continue
+      for block in blocks(filename):
+         daemon.append(parse_daemon(block, source))
+         ticks, changes = parse_scheduler(block)
+         status.append(ticks)
+         requests.append(changes)
+   return concatenate(daemon), concatenate(status), concatenate(requests)
+
+
+def group_ranks(groups):
+   """The rank of each element within its group, groups being sorted."""
+   return np.arange(len(groups)) - np.searchsorted(groups, groups)
+
+
+def churn(groups, times, amounts, window):
+   """
+   The group and the churn, in worker seconds, of each reversal among
+   requests of amounts workers, positive to add and negative to quench:
+   a request undoing the previous one of its group within window seconds.
+   """
+   order = np.lexsort((times, groups))
+   groups, times, amounts = groups[order], times[order], amounts[order]
+   gaps = times[1:] - times[:-1]
+   reversal = ((groups[1:] == groups[:-1]) & (np.sign(amounts[1:]) != np.sign(amounts[:-1]))
+               & (gaps <= window))
+   undone = np.minimum(np.abs(amounts[1:]), np.abs(amounts[:-1]))
+   return groups[1:][reversal], (undone * gaps)[reversal]
+
+
+def occupancy(starts, ends, edges):
+   """
+   The integral, over each interval between edges, of the number of
+   [start, end) intervals open: e.g. the worker seconds held in each bin.
+   starts and ends need not be paired.
+   """
+   starts, ends = np.sort(starts), np.sort(ends)
+   def covered(x):
+      # sum over starts before x of (x - start), minus the same over ends.
+      i, j = np.searchsorted(starts, x), np.searchsorted(ends, x)
+      before = np.concatenate(([0], np.cumsum(starts)))[i]
+      after = np.concatenate(([0], np.cumsum(ends)))[j]
+      return (i * x - before) - (j * x - after)
+   return np.diff(covered(edges))
+
+
+def percentiles(values):
+   """Count, mean, PERCENTILES and max of values, as a dict."""
+   if not len(values):
+      return {"count": 0}
+   stats = {"count": int(len(values)), "mean": float(np.mean(values)), "max": float(np.max(values))}
+   for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+      stats["p%d" % p] = float(value)
+   return stats
+
+
+class Runs(object):
+   """
+   The runs of run-parallel.sh in the daemon events, analyzed all at once:
+   each attribute is an array with one element per run, per task or per
+   worker arrival or exit, as named.
+   """
+   def __init__(self, events, filenames, window):
+      kind, time_, run = events["kind"], events["time"], self.split(events)
+      self.count = n = int(run[-1]) + 1
+      first = np.flatnonzero(np.diff(run, prepend=-1))
+      self.begin = np.minimum.reduceat(time_, first)
+      self.end = np.maximum.reduceat(time_, first)
+      self.labels = self.label(events["source"][first], filenames)
+      self.daemon = np.bincount(run[kind == STARTED], minlength=n) > 0
+
+      # Tasks: paired on their number within their run.
+      starting, done = kind == STARTING, (kind == DONE) | (kind == STOPPING)
+      m = int(events["task"].max()) + 1
+      skeys = run[starting] * m + events["task"][starting]
+      dkeys = run[done] * m + events["task"][done]
+      keys = np.union1d(skeys, dkeys)
+      self.task_run = keys // m
+      self.task_start = self.begin[self.task_run].copy()
+      self.task_start[np.searchsorted(keys, skeys)] = time_[starting]
+      self.task_end = self.end[self.task_run].copy()
+      self.task_end[np.searchsorted(keys, dkeys)] = time_[done]
+      self.task_rc = np.zeros(len(keys), dtype=np.int64)
+      self.task_rc[np.searchsorted(keys, dkeys)] = events["rc"][done]
+
+      # Worker exits: once told there is nothing left to start, quenched or
+      # stopping to be relaunched.
+      started = np.cumsum(starting)
+      started -= (started[first] - starting[first])[run]
+      exits = ((kind == EMPTY) | (kind == QUENCHING) | (kind == STOPPING)
+               | ((kind == DONE) & (started >= events["num"])))
+      arrivals = self.arrivals(events, run, done & ~exits)
+      self.pair_workers(run[arrivals], time_[arrivals], run[exits], time_[exits])
+      self.queue_waits(run[arrivals], time_[arrivals], run[kind == LAUNCH], time_[kind == LAUNCH])
+
+      # Requests for more or fewer workers.
+      request = (kind == ADD) | (kind == QUENCH)
+      amounts = np.where(kind == ADD, 1, -1)[request] * events["n"][request]
+      self.adds = np.bincount(run[request], np.maximum(amounts, 0), minlength=n)
+      self.quenches = np.bincount(run[request], np.maximum(-amounts, 0), minlength=n)
+      reversals, seconds = churn(run[request], time_[request], amounts, window)
+      self.reversals = np.bincount(reversals, minlength=n)
+      self.churn = np.bincount(reversals, seconds, minlength=n)
+
+      self.tasks = np.bincount(self.task_run, minlength=n)
+      self.failed = np.bincount(self.task_run, self.task_rc != 0, minlength=n).astype(np.int64)
+      self.busy = np.bincount(self.task_run, self.task_end - self.task_start, minlength=n)
+      self.held = (np.bincount(self.exit_run, self.exit_time, minlength=n)
+                   - np.bincount(self.arrival_run, self.arrival_time, minlength=n))
+      self.workers = np.bincount(self.arrival_run, minlength=n)
+
+   @staticmethod
+   def split(events):
+      """
+      The run of each event: a run starts with its daemon, with each log
+      and, in logs without the daemon's start, when task numbers start over.
+      """
+      kind, source, task = events["kind"], events["source"], events["task"]
+      new = kind == STARTED
+      new[0] = True
+      new[1:] |= source[1:] != source[:-1]
+      starting = np.flatnonzero(kind == STARTING)
+      runs = np.cumsum(new)
+      over = (task[starting[1:]] <= task[starting[:-1]]) & (runs[starting[1:]] == runs[starting[:-1]])
+      new[starting[1:][over]] = True
+      return np.cumsum(new) - 1
+
+   @staticmethod
+   def label(sources, filenames):
+      """Each run's log, numbered when a log holds several runs."""
+      labels = [filenames[source] for source in sources]
+      counts = np.bincount(sources)
+      ranks = group_ranks(sources)
+      return [label if counts[source] == 1 else "%s#%d" % (label, rank + 1)
+              for label, source, rank in zip(labels, sources, ranks)]
+
+   @staticmethod
+   def arrivals(events, run, continuing):
+      """
+      The indices of the events where a worker first asks for a task: its
+      first GET, or starting in logs without GETs, that doesn't follow a
+      DONE of the same worker that it goes on after.
+      """
+      kind = events["kind"]
+      gets = (np.bincount(run[kind == GET], minlength=int(run[-1]) + 1) > 0)[run]
+      contact = ((kind == GET) & gets) | ((kind == STARTING) & ~gets)
+      selected = np.flatnonzero(contact | continuing | (kind == STOPPING) | (kind == DONE))
+      worker = np.unique(events["worker"][selected], return_inverse=True)[1]
+      order = np.lexsort((selected, worker, run[selected]))
+      selected, worker = selected[order], worker[order]
+      follows = np.zeros(len(selected), dtype=bool)
+      follows[1:] = ((run[selected[1:]] == run[selected[:-1]]) & (worker[1:] == worker[:-1])
+                     & continuing[selected[:-1]])
+      return np.sort(selected[contact[selected] & ~follows])
+
+   def pair_workers(self, arrival_run, arrival_time, exit_run, exit_time):
+      """
+      Keep the arrivals and exits of workers, adding, at the end of its run,
+      the exits of workers still there and, at its start, the arrivals of
+      workers that were already there.
+      """
+      arrived = np.bincount(arrival_run, minlength=self.count)
+      left = np.bincount(exit_run, minlength=self.count)
+      missing = np.repeat(np.arange(self.count), np.maximum(arrived - left, 0))
+      self.exit_run = np.concatenate((exit_run, missing))
+      self.exit_time = np.concatenate((exit_time, self.end[missing]))
+      missing = np.repeat(np.arange(self.count), np.maximum(left - arrived, 0))
+      self.arrival_run = np.concatenate((arrival_run, missing))
+      self.arrival_time = np.concatenate((arrival_time, self.begin[missing]))
+
+   def queue_waits(self, arrival_run, arrival_time, launch_run, launch_time):
+      """
+      The queue wait of workers, in runs whose daemon's start was logged:
+      the workers run-parallel.sh submitted as it started the daemon, and
+      those the daemon launched after, are paired in order with the workers
+      asking for their first task.
+      """
+      initial = np.maximum(np.bincount(arrival_run, minlength=self.count)
+                           - np.bincount(launch_run, minlength=self.count), 0)
+      submit_run = np.concatenate((np.repeat(np.arange(self.count), initial), launch_run))
+      submit_time = np.concatenate((np.repeat(self.begin, initial), launch_time))
+      order = np.lexsort((submit_time, submit_run))
+      submit_run, submit_time = submit_run[order], submit_time[order]
+      order = np.lexsort((arrival_time, arrival_run))
+      arrival_run, arrival_time = arrival_run[order], arrival_time[order]
+      m = max(len(arrival_run), len(submit_run)) + 1
+      _, a, s = np.intersect1d(arrival_run * m + group_ranks(arrival_run),
+                               submit_run * m + group_ranks(submit_run), return_indices=True)
+      keep = self.daemon[arrival_run[a]]
+      self.wait_run = arrival_run[a][keep]
+      self.waits = np.maximum(arrival_time[a] - submit_time[s], 0)[keep]
+
+   def per_run(self, runs, values):
+      """values, split into one array per run, runs giving the run of each value."""
+      order = np.argsort(runs, kind="stable")
+      return np.split(values[order], np.searchsorted(runs[order], np.arange(1, self.count)))
+
+   def curves(self, edges):
+      """
+      (array) -> [(label, first bin, held, running)], for each run and, last,
+      for all runs, label *: the worker seconds held and the task seconds
+      running in each bin of edges from the first bin the run covers.
+      """
+      curves = []
+      for run, arrivals, exits, starts, ends in zip(
+            range(self.count), self.per_run(self.arrival_run, self.arrival_time),
+            self.per_run(self.exit_run, self.exit_time), self.per_run(self.task_run, self.task_start),
+            self.per_run(self.task_run, self.task_end)):
+         lo = max(np.searchsorted(edges, self.begin[run], side="right") - 1, 0)
+         hi = min(np.searchsorted(edges, self.end[run], side="left"), len(edges) - 1)
+         bins = edges[lo:max(hi, lo + 1) + 1]
+         curves.append((self.labels[run], lo, occupancy(arrivals, exits, bins), occupancy(starts, ends, bins)))
+      curves.append(("*", 0, occupancy(self.arrival_time, self.exit_time, edges),
+                     occupancy(self.task_start, self.task_end, edges)))
+      return curves
+
+   def report(self):
+      """Each run, as a list of dicts."""
+      runs = []
+      for i, waits in enumerate(self.per_run(self.wait_run, self.waits)):
+         runs.append({
+            "run": self.labels[i],
+            "start": timestamp(self.begin[i]),
+            "wall": float(self.end[i] - self.begin[i]),
+            "tasks": int(self.tasks[i]),
+            "failed": int(self.failed[i]),
+            "workers": int(self.workers[i]),
+            "held": float(self.held[i]),
+            "busy": float(self.busy[i]),
+            "idle": float(max(self.held[i] - self.busy[i], 0)),
+            "utilization": ratio(self.busy[i], self.held[i]),
+            "queue_wait": percentiles(waits),
+            "adds": int(self.adds[i]),
+            "quenches": int(self.quenches[i]),
+            "reversals": int(self.reversals[i]),
+            "churn": float(self.churn[i]),
+         })
+      return runs
+
+   def totals(self):
+      """All runs together, as a dict."""
+      held, busy = float(self.held.sum()), float(self.busy.sum())
+      counts, _ = np.histogram(self.waits, bins=WAIT_BINS)
+      return {
+         "runs": int(self.count),
+         "tasks": int(self.tasks.sum()),
+         "failed": int(self.failed.sum()),
+         "workers": int(self.workers.sum()),
+         "held": held,
+         "busy": busy,
+         "idle": max(held - busy, 0.0),
+         "utilization": ratio(busy, held),
+         "queue_wait": percentiles(self.waits),
+         # The last bin has no upper bound: None.
+         "queue_wait_histogram": [[WAIT_BINS[i], WAIT_BINS[i + 1] if i + 2 < len(WAIT_BINS) else None, int(c)]
+                                  for i, c in enumerate(counts)],
+         "adds": int(self.adds.sum()),
+         "quenches": int(self.quenches.sum()),
+         "reversals": int(self.reversals.sum()),
+         "churn": float(self.churn.sum()),
+      }
+
+
+def scheduler_report(status, requests, window):
+   """What r-scheduler.py's STATUS lines, requests or metrics tell, as a dict."""
+   report = {}
+   if status is not None:
+      busy = 1 - status["free"] / np.maximum(status["total"], 1)
+      report.update({
+         "ticks": int(len(status["time"])),
+         "jobs": int(len(np.unique(status["job"]))),
+         "start": timestamp(status["time"].min()),
+         "end": timestamp(status["time"].max()),
+         "cluster_busy": float(np.mean(busy)),
+      })
+   if requests is not None:
+      jobs, groups = np.unique(requests["job"], return_inverse=True)
+      reversals, seconds = churn(groups, requests["time"], requests["n"], window)
+      report.update({
+         "adds": int(np.maximum(requests["n"], 0).sum()),
+         "quenches": int(np.maximum(-requests["n"], 0).sum()),
+         "reversals": int(len(reversals)),
+         "churn": float(seconds.sum()),
+         "churn_by_job": dict((str(job), float(s)) for job, s in
+                              zip(jobs, np.bincount(reversals, seconds, minlength=len(jobs))) if s),
+      })
+   return report
+
+
+def timestamp(seconds):
+   """seconds, from clock(), as a date and time."""
+   return str(np.datetime64(int(seconds), "s")).replace("T", " ")
+
+
+def ratio(a, b):
+   return float(a / b) if b else None
+
+
+def write_curves(filename, runs, status, interval):
+   """Write the utilization curves of runs and, with them, the cluster's busy share from status."""
+   times = []
+   if runs is not None:
+      times += [runs.begin.min(), runs.end.max()]
+   if status is not None:
+      times += [status["time"].min(), status["time"].max()]
+   if not times:
+      open(filename, "w").close()
+      return
+   start = np.floor(min(times) / interval) * interval
+   edges = start + interval * np.arange(int(np.ceil((max(times) - start) / interval)) + 2)
+   labels = np.char.replace(edges.astype(np.int64).astype("datetime64[s]").astype(str), "T", " ")
+   busy = None
+   if status is not None:
+      bins = np.searchsorted(edges, status["time"], side="right") - 1
+      counts = np.bincount(bins, minlength=len(edges))
+      share = np.bincount(bins, 1 - status["free"] / np.maximum(status["total"], 1), minlength=len(edges))
+      busy = np.where(counts > 0, share / np.maximum(counts, 1), np.nan)
+   if runs is not None:
+      curves = runs.curves(edges)
+   else:
+      # Only the cluster's busy share is known.
+      curves = [("*", 0, np.full(len(edges) - 1, np.nan), np.full(len(edges) - 1, np.nan))]
+   number = lambda value, format: "" if np.isnan(value) else format % value
+   with open(filename, "w") as f:
+      print("time", "run", "workers", "running", "utilization", "cluster_busy", sep="\t", file=f)
+      for label, first, held, running in curves:
+         for i, (h, r) in enumerate(zip(held, running), first):
+            cluster = busy[i] if label == "*" and busy is not None else np.nan
+            if label == "*" and not h > 0 and np.isnan(cluster):
+               continue
+            print(labels[i], label, number(h / interval, "%.3f"), number(r / interval, "%.3f"),
+                  number(r / h if h > 0 else np.nan, "%.4f"), number(cluster, "%.4f"), sep="\t", file=f)
+
+
+def duration(seconds):
+   return "%.1fh" % (seconds / 3600) if seconds >= 3600 else "%.0fs" % seconds
+
+
+def percent(value):
+   return "-" if value is None else "%.1f%%" % (100 * value)
+
+
+def wait_bin(lo, hi):
+   return "%ds+" % lo if hi is None else "%d-%ds" % (lo, hi)
+
+
+def wait(stats, key):
+   return "%.0f" % stats[key] if key in stats else "-"
+
+
+def print_report(report, summary):
+   """Print report for people."""
+   totals = report.get("totals")
+   if totals:
+      print("Runs: {runs}  Tasks: {tasks} ({failed} failed)  Workers: {workers}".format(**totals))
+      print("Worker time: held {}  busy {}  idle {}  utilization {}".format(
+            duration(totals["held"]), duration(totals["busy"]), duration(totals["idle"]),
+            percent(totals["utilization"])))
+      stats = totals["queue_wait"]
+      if stats["count"]:
+         print("Queue waits: {} workers, mean {:.0f}s, p50 {}s, p90 {}s, p99 {}s, max {:.0f}s".format(
+               stats["count"], stats["mean"], wait(stats, "p50"), wait(stats, "p90"),
+               wait(stats, "p99"), stats["max"]))
+         print("  " + "  ".join("{}: {}".format(wait_bin(lo, hi), n)
+                                for lo, hi, n in totals["queue_wait_histogram"]))
+      else:
+         print("Queue waits: unknown, from logs without the daemon's start, GETs and launches")
+      print("Requests: {adds} added, {quenches} quenched, {reversals} reversals, churn {churn:.0f}s".format(**totals))
+   if totals and not summary:
+      print()
+      columns = ("run", "start", "wall", "tasks", "failed", "workers", "held", "busy", "idle",
+                 "util", "wait50", "wait90", "adds", "quench", "churn")
+      print("\t".join(columns))
+      for run in report["runs"]:
+         print("\t".join(str(field) for field in (
+               run["run"], run["start"], "%.0f" % run["wall"], run["tasks"], run["failed"],
+               run["workers"], "%.0f" % run["held"], "%.0f" % run["busy"], "%.0f" % run["idle"],
+               percent(run["utilization"]), wait(run["queue_wait"], "p50"),
+               wait(run["queue_wait"], "p90"), run["adds"], run["quenches"], "%.0f" % run["churn"])))
+   scheduler = report.get("scheduler")
+   if scheduler:
+      if totals:
+         print()
+      if "ticks" in scheduler:
+         print("r-scheduler.py: {ticks} job ticks, {jobs} jobs, {start} to {end}, cluster {busy} busy".format(
+               busy=percent(scheduler["cluster_busy"]), **scheduler))
+      if "adds" in scheduler:
+         print("r-scheduler.py requests: {adds} added, {quenches} quenched, {reversals} reversals, "
+               "churn {churn:.0f}s".format(**scheduler))
+   if not totals and not scheduler:
+      print("No run-parallel.sh or r-scheduler.py events found")
+
+
+def main():
+   args = get_args()
+   for filename in args.logs:
+      if filename != "-" and not os.path.isfile(filename):
+         print("rp-utilization.py: Fatal error: Can't read {}".format(filename), file=sys.stderr)
+         sys.exit(1)
+   events, status, requests = read_logs(args.logs)
+   runs = Runs(events, args.logs, args.window) if events is not None else None
+   report = {}
+   if runs is not None:
+      report["totals"] = runs.totals()
+      report["runs"] = runs.report()
+   scheduler = scheduler_report(status, requests, args.window)
+   if scheduler:
+      report["scheduler"] = scheduler
+   if args.curves:
+      write_curves(args.curves, runs, status, args.interval)
+   if args.json:
+      print(json.dumps(report, indent=1, sort_keys=True))
+   else:
+      print_report(report, args.summary)
+
+
+if __name__ == '__main__':
+   main()
@@ -222,6 +222,8 @@ on_head_node()
 
 if [[ $PBS_JOBID ]]; then
    SHORT_JOB_ID=${PBS_JOBID:0:13}
+elif [[ $SLURM_JOB_ID ]]; then
+   SHORT_JOB_ID=$SLURM_JOB_ID
 elif [[ $GECOSHEP_JOB_ID ]]; then
    SHORT_JOB_ID=$GECOSHEP_JOB_ID
 else
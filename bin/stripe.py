@@ -11,109 +11,1091 @@
 # Copyright 2011, Sa Majeste la Reine du Chef du Canada /
 # Copyright 2011, Her Majesty in Right of Canada
 
-from __future__ import print_function
+"""
+Striped split and rebuild, usable as a script or as a module.
+
+Python programs can stripe in-process instead of running stripe.py:
+
+   sys.path.insert(0, "/path/to/PortageClusterUtils/bin")
+   import stripe
+   for line in stripe.stripe_lines("input.gz", 2, 10):
+      ...
+   for line in stripe.merge_lines(streams):
+      ...
+
+Lines are bytes, with their newline.  split(), split_stripes(),
+split_contiguous(), split_lockstep(), merge_files() and rebuild() work on
+files like the command line does.  Library functions raise IOError or
+ValueError instead of exiting; only main() prints errors and exits.
+
+Modules needed by a single mode are imported where they are used, keeping
+the startup of the command line short: check with
+   python3 -X importtime stripe.py -h
+"""
 
 import sys
-import gzip
-import glob
-import re 
-from optparse import OptionParser
+import os
+import io
+import zlib
+import struct
+from array import array
+from operator import add
+from itertools import accumulate, chain, compress, cycle, islice, repeat, zip_longest
 
 
-def sort_nicely( l ): 
-   """ Sort the given list in the way that humans expect. 
-   """ 
-   convert = lambda text: int(text) if text.isdigit() else text 
-   alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ] 
-   l.sort( key=alphanum_key ) 
+# Default size of the blocks read at once.
+BLOCK_SIZE = 1<<20
+
+# Set by main() from -v and -d.
+verbose_flag = False
+debug_flag = False
+# Size of the thread pool compressing .gz outputs, set by main() from -j.
+compression_threads = min(4, os.cpu_count() or 1)
+
+
+def sort_nicely( l ):
+   """ Sort the given list in the way that humans expect.
+   """
+   import re
+   convert = lambda text: int(text) if text.isdigit() else text
+   alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ]
+   l.sort( key=alphanum_key )
 
 
 usage="stripe.py [options] [infile [outfile]]"
 help="""
   Perform a striped split, assigning lines in a round-robin fashion to each
   chunk.  Intended for splitting files without creating temporary copies.
-  stripe.py -r [infiles] will rebuild the whole file from striped pieces.
+  stripe.py -r [infiles] will rebuild the whole file from striped pieces;
+  stripe.py -r -i i:j [infiles] only merges infiles i to j-1, and -r -i k
+  outputs infile k alone.
+  stripe.py -r -n [infiles] rebuilds it from stripes split with -n, merging
+  them on their line numbers, so the stripes may have lost, duplicated or
+  gained lines as long as each one stays sorted by line number.
+  stripe.py -o out.%04d [infile] writes all the stripes, or those selected
+  with -i, in a single pass over infile.
+  stripe.py -b splits a plain text infile in contiguous chunks instead,
+  reading only the selected chunks thanks to a line-offset index saved in
+  infile.idx; stripe.py -r -b [infiles] simply concatenates the chunks.
+  Once stripe.py -x has built that index, stripes of a plain text infile are
+  also written straight from a memory map of infile, without copying lines.
+  stripe.py -w bytes balances the stripes instead, assigning each line to
+  the stripe with the fewest bytes so far, so that jobs get equal work even
+  when line lengths are skewed; -a MANIFEST saves the assignment, which
+  stripe.py -r -a MANIFEST [infiles] needs to restore the original order,
+  and stripe.py -a MANIFEST (without -w) splits parallel files the same way.
+  stripe.py -l infile1 outfile1 infile2 outfile2 ... splits parallel files,
+  e.g. a source and a target file, in a single process reading them in
+  lockstep, writing the same stripes of each infile to its outfile, and
+  fails as soon as the infiles turn out to have different line counts.
+  stripe.py -k FIELD [-t SEP] or -e REGEX partitions the lines on a key
+  instead, their field FIELD or their match of REGEX: lines sharing a key
+  land in the same stripe, e.g. stripe.py -k 1 -t ' ||| ' -m 8 -o part.%d
+  phrases.gz writes 8 partitions of a phrase table grouped by source phrase
+  in a single pass, replacing a global sort before parallel processing.
+  stripe.py -f fifo.%d [infile] serves the stripes to consumers running
+  concurrently on the same machine through named pipes, reading and
+  decompressing infile only once, e.g.:
+     stripe.py -m 4 -f fifo.%d in.gz &
+     for i in 0 1 2 3; do cmd < fifo.$i > out.$i & done; wait
 """
 
-parser = OptionParser(usage=usage, description=help)
-parser.add_option("-i", dest="indices", type="string", default="0",
-                  help="what indices to display [%default] valid value [0, m)"
-                  + "-i [i:j) where 0 <= i < j <= m")
-parser.add_option("-m", dest="modulo", type="int", default=3,
-                  help="How many chunks aka modulo [%default]")
-parser.add_option("-c", dest="complement", action="store_true", default=False,
-                  help="writes lines that are NOT 0 <= i < j <=m [%default]")
-parser.add_option("-n", dest="numbered", action="store_true", default=False,
-                  help="Prefix each line with its line number [%default]")
-parser.add_option("-r", dest="rebuild", action="store_true", default=False,
-                  help="rebuild whole file from stripes [%default]")
-parser.add_option("-v", dest="verbose", action="store_true", default=False,
-                  help="write verbose output to stderr [%default]")
-parser.add_option("-d", dest="debug", action="store_true", default=False,
-                  help="write debug output to stderr [%default]")
-
-
-(opts, args) = parser.parse_args()
-if opts.rebuild:
-   if len(args) == 0:
-       parser.error("too few arguments to rebuild the output")
-else:
-   if len(args) > 2:
-       parser.error("too many arguments")
-
-# Check if the user provided a rane of indices or a single index.
-all_indices = opts.indices.split(":")
-index = int(all_indices[0])
-jndex = index + 1
-if len(all_indices) == 2:
-   jndex = int(all_indices[1])
-elif len(all_indices) > 2:
-   print("Indices format is -i i:j where [i,j) where 0 <= i < j <= m.", file=sys.stderr)
-   sys.exit(1)
-# validate the index range.
-if not (0 <= index < jndex <= opts.modulo):
-   print("Indices format is -i i:j where [i,j) where 0 <= i < j <= m.", file=sys.stderr)
-   sys.exit(1)
-
-if opts.debug:
-   print("index %d, jndex %d" % (index, jndex), file=sys.stderr)
-
-if opts.verbose:
-   print("options are:", opts, file=sys.stderr)
-   print("positional args are:", args, file=sys.stderr)
-
-
-def myopen(filename, mode='r'):
-   "This function will try to open transparently compress files or not."
-   if opts.debug: print("myopen: ", filename, " in ", mode, " mode", file=sys.stderr)
+# Size of the decompressed/uncompressed chunks handled by GzipReader/GzipWriter.
+GZIP_CHUNK_SIZE = 1<<20
+# gzip(1)'s default compression level, much faster than gzip.open()'s 9.
+GZIP_LEVEL = 6
+
+
+class GzipReader(io.RawIOBase):
+   """
+   Read a gzip file, decompressing it in large chunks in a background thread
+   so that decompression overlaps with the processing of the lines.
+   Concatenated gzip members, as written by GzipWriter, are supported.
+   Closing the reader early stops the thread.
+   """
+   def __init__(self, filename, prefetch=4):
+      import threading
+      from queue import Queue
+      super(GzipReader, self).__init__()
+      self.raw = open(filename, 'rb')
+      self.chunks = Queue(prefetch)
+      self.chunk = memoryview(b'')
+      self.stopping = threading.Event()
+      self.thread = threading.Thread(target=self.decompress)
+      self.thread.daemon = True
+      self.thread.start()
+
+   def decompress(self):
+      "Decompress the whole file chunk by chunk into self.chunks."
+      try:
+         decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+         in_member = False
+         while True:
+            data = self.raw.read(GZIP_CHUNK_SIZE // 4)
+            if not data:
+               break
+            while data:
+               in_member = True
+               chunk = decompressor.decompress(data, GZIP_CHUNK_SIZE)
+               if chunk and not self.put(chunk):
+                  return
+               if decompressor.eof:
+                  # Start of the next gzip member, if any: all the input left
+                  # is in unused_data, unconsumed_tail may be stale.
+                  data = decompressor.unused_data
+                  decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                  in_member = False
+               else:
+                  data = decompressor.unconsumed_tail
+         if in_member:
+            raise IOError("Compressed file ended before the end-of-stream marker was reached")
+         self.put(b'')
+      except Exception as err:
+         self.put(err)
+
+   def put(self, item):
+      """
+      Queue item for the reader, waiting for room unless the reader is being
+      closed; returns False if it is.
+      """
+      from queue import Full
+      while not self.stopping.is_set():
+         try:
+            self.chunks.put(item, timeout=0.1)
+            return True
+         except Full:
+            pass
+      return False
+
+   def readable(self):
+      return True
+
+   def next_chunk(self):
+      "Wait for the next decompressed chunk, b'' at the end of the file."
+      chunk = self.chunks.get()
+      if isinstance(chunk, Exception):
+         self.chunks.put(chunk)
+         raise IOError("%s: %s" % (self.raw.name, chunk))
+      if not chunk:
+         # Leave the end-of-file marker for the next reads.
+         self.chunks.put(chunk)
+      return chunk
+
+   def read(self, size=-1):
+      """
+      Return at most size bytes, at most one decompressed chunk at a time;
+      whole chunks are returned without being copied.
+      """
+      if not self.chunk:
+         chunk = self.next_chunk()
+         if size < 0 or size >= len(chunk):
+            return chunk
+         self.chunk = memoryview(chunk)
+      if size < 0:
+         size = len(self.chunk)
+      data = self.chunk[:size].tobytes()
+      self.chunk = self.chunk[size:]
+      return data
+
+   def readinto(self, b):
+      data = self.read(len(b))
+      b[:len(data)] = data
+      return len(data)
+
+   def close(self):
+      "Stop the decompression thread, if still running, and close the file."
+      from queue import Empty
+      if not self.closed:
+         self.stopping.set()
+         # Free the queue and the thread, should it be waiting for room in it.
+         try:
+            while True:
+               self.chunks.get_nowait()
+         except Empty:
+            pass
+         self.thread.join()
+         self.raw.close()
+      super(GzipReader, self).close()
+
+
+def gzip_member(data):
+   "Return data compressed as a complete gzip member."
+   # zlib.compress() only takes wbits from Python 3.11.
+   compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+   return compressor.compress(data) + compressor.flush()
+
+
+compressors = None
+def compressor_pool():
+   "Return the thread pool shared by all GzipWriters."
+   global compressors
+   if compressors is None:
+      from concurrent.futures import ThreadPoolExecutor
+      compressors = ThreadPoolExecutor(compression_threads)
+   return compressors
+
+
+class GzipWriter(io.RawIOBase):
+   """
+   Write a gzip file as a series of independent gzip members, each compressed
+   from GZIP_CHUNK_SIZE bytes of data on a thread pool; zlib releases the GIL
+   while compressing, so the members get compressed in parallel.
+   """
+   def __init__(self, filename):
+      from collections import deque
+      super(GzipWriter, self).__init__()
+      self.raw = open(filename, 'wb')
+      self.buffer = []
+      self.size = 0
+      self.pending = deque()
+
+   def writable(self):
+      return True
+
+   def write(self, data):
+      self.buffer.append(bytes(data))
+      self.size += len(data)
+      if self.size >= GZIP_CHUNK_SIZE:
+         self.submit()
+      return len(data)
+
+   def submit(self):
+      "Queue the buffered data for compression and write completed members."
+      pool = compressor_pool()
+      self.pending.append(pool.submit(gzip_member, b''.join(self.buffer)))
+      self.buffer = []
+      self.size = 0
+      # Bound the amount of data in flight, writing members in order.
+      while len(self.pending) > 2 * compression_threads or (self.pending and self.pending[0].done()):
+         self.raw.write(self.pending.popleft().result())
+
+   def close(self):
+      if not self.closed:
+         if self.size:
+            self.submit()
+         while self.pending:
+            self.raw.write(self.pending.popleft().result())
+         self.raw.close()
+      super(GzipWriter, self).close()
+
+
+def myopen(filename, mode='r', prefetch=True):
+   """
+   This function will try to open transparently compress files or not.
+   Binary mode .gz files are read with a GzipReader, decompressing in a
+   background thread, unless prefetch is False, and written with a GzipWriter.
+   A GzipReader is meant to be read in blocks, use prefetch=False to get a
+   file with an efficient readline().
+   """
+   if debug_flag: print("myopen: ", filename, " in ", mode, " mode", file=sys.stderr)
    if filename == "-":
       if mode == 'r':
          theFile = sys.stdin
       elif mode == 'w':
          theFile = sys.stdout
       else:
-         print("Unsupported mode.", file=sys.stderr)
-         sys.exit(1)
+         raise ValueError("Unsupported mode: %s" % mode)
    elif filename[-3:] == ".gz":
       if "b" not in mode:
          mode += "b"
-      theFile = gzip.open(filename, mode)
+      if mode == 'rb' and prefetch:
+         theFile = GzipReader(filename)
+      elif mode == 'wb':
+         theFile = GzipWriter(filename)
+      else:
+         import gzip
+         theFile = gzip.open(filename, mode)
    else:
       theFile = open(filename, mode)
    return theFile
 
 
-def rebuild():
-   "This function will unstripe the output of a previous usage of stripe.py."
-   def myOpenRead(filename):
-      "Trying out a function closure."
-      if opts.debug: print("myOpenRead: ", filename, file=sys.stderr)
-      return myopen(filename, 'rb')
+def line_blocks(infile, block_size):
+   """
+   Read infile in blocks of block_size bytes and yield (lines, terminated)
+   where lines is a list of the complete lines found, stripped of their newline.
+   If the file doesn't end with a newline, its last line is yielded alone with
+   terminated set to False.
+   """
+   # The pieces of a line spanning blocks, joined once its newline is found.
+   carry = []
+   while True:
+      block = infile.read(block_size)
+      if not block:
+         break
+      lines = block.split(b'\n')
+      if len(lines) == 1:
+         carry.append(block)
+         continue
+      if carry:
+         carry.append(lines[0])
+         lines[0] = b''.join(carry)
+      last = lines.pop()
+      carry = [last] if last else []
+      yield lines, True
+   if carry:
+      yield [b''.join(carry)], False
+
+
+def select(items, cpt, keep):
+   """
+   Return the items whose line number, cpt being the line number of
+   items[0], falls in a stripe s for which keep[s] is True.
+   """
+   M = len(keep)
+   offset = cpt % M
+   stripes = [s for s in range(M) if keep[s]]
+   if len(stripes) == 1:
+      # Single stripe: a plain slice is the fastest selection possible.
+      return items[(stripes[0] - offset) % M::M]
+   return list(compress(items, islice(cycle(keep), offset, None)))
+
+
+def join_lines(lines, numbers=None, terminated=True):
+   """
+   Join lines, as yielded by line_blocks(), back together, prefixing each line
+   with its line number and a tab if numbers is given.
+   """
+   if numbers is not None:
+      data = b''.join([b'%d\t%s\n' % pair for pair in zip(numbers, lines)])
+   else:
+      data = b'\n'.join(lines) + b'\n'
+   if not terminated:
+      data = data[:-1]
+   return data
+
+
+def stripe_mask(index, jndex, modulo, complement=False):
+   """
+   Return keep, keep[s] being True for the stripes s of modulo selected by
+   [index, jndex) or, with complement, for the other ones.
+   """
+   if not (0 <= index < jndex <= modulo):
+      raise ValueError("Stripes [%d, %d) are not within [0, %d)" % (index, jndex, modulo))
+   # NOTE this is XOR
+   return [complement ^ (index <= step < jndex) for step in range(modulo)]
+
+
+# Costs of a line for balancing the stripes with -w: its length in bytes,
+# newline included, or its number of tokens plus one for the line itself.
+COSTS = {
+   "bytes": lambda line: len(line) + 1,
+   "tokens": lambda line: len(line.split()) + 1,
+}
+
+
+def stripe_typecode(modulo):
+   "Array typecode wide enough for the stripe numbers of modulo stripes."
+   return 'B' if modulo <= 1<<8 else 'H' if modulo <= 1<<16 else 'I'
+
+
+class Manifest(object):
+   """
+   Stripe of each line of a file split with stripe.py -w, saved so that
+   stripe.py -r -a can restore the original order exactly, and so that
+   parallel files can be split the same way: a header, b'STPM' followed by
+   the number of stripes as a little-endian 32 bit integer, then the stripe of
+   each line as a little-endian unsigned integer of 1, 2 or 4 bytes, for up
+   to 2**8, 2**16 or 2**32 stripes.
+   """
+   header = struct.Struct('<4sI')
+   magic = b'STPM'
+
+   def __init__(self, filename, modulo=None):
+      """
+      Open filename to read its manifest or, if modulo is given, to write a
+      new one, which replaces filename atomically when closed.
+      """
+      self.name = filename
+      self.tmpname = None
+      if modulo is None:
+         self.file = open(filename, 'rb')
+         header = self.file.read(self.header.size)
+         magic, modulo = self.header.unpack(header) if len(header) == self.header.size else (None, 0)
+         if magic != self.magic:
+            self.file.close()
+            raise IOError("%s is not a stripe.py manifest" % filename)
+      else:
+         self.tmpname = "%s.%d.tmp" % (filename, os.getpid())
+         self.file = open(self.tmpname, 'wb')
+         self.file.write(self.header.pack(self.magic, modulo))
+      self.modulo = modulo
+      self.typecode = stripe_typecode(modulo)
+
+   def read(self, n):
+      "Read the stripes of the next n lines, fewer at the end of the manifest."
+      stripes = array(self.typecode)
+      data = self.file.read(n * stripes.itemsize)
+      stripes.frombytes(data[:len(data) - len(data) % stripes.itemsize])
+      if sys.byteorder == 'big':
+         stripes.byteswap()
+      if stripes and max(stripes) >= self.modulo:
+         raise IOError("%s: stripe %d out of range" % (self.name, max(stripes)))
+      return stripes
+
+   def write(self, stripes):
+      if sys.byteorder == 'big':
+         stripes = array(self.typecode, stripes)
+         stripes.byteswap()
+      self.file.write(stripes.tobytes())
+
+   def close(self):
+      self.file.close()
+      if self.tmpname is not None:
+         os.rename(self.tmpname, self.name)
+         self.tmpname = None
+
+
+def balance(lines, loads, cost, typecode):
+   """
+   Assign each line, in turn, to the stripe with the lowest total cost so
+   far, loads being a heap of (total cost, stripe) for every stripe; return
+   the stripe of each line as an array of typecode.
+   """
+   from heapq import heapreplace
+   stripes = array(typecode)
+   append = stripes.append
+   for c in map(cost, lines):
+      load, s = loads[0]
+      heapreplace(loads, (load + c, s))
+      append(s)
+   return stripes
+
+
+def partition_key(field=None, separator=None, regex=None):
+   """
+   Return the function extracting the partitioning key of a line: its field
+   number field, counting from 1, the fields being separated by separator, or
+   by runs of whitespace if separator is None; or, given regex instead, the
+   first group of its first match of regex, or the whole match if regex has
+   no group.  Lines without such a field or match get an empty key.
+   """
+   if regex is not None:
+      import re
+      search = re.compile(regex).search
+      group = 1 if search.__self__.groups else 0
+      def key(line):
+         match = search(line)
+         return match.group(group) if match else b''
+   else:
+      def key(line):
+         fields = line.split(separator, field)
+         return fields[field - 1] if len(fields) >= field else b''
+   return key
+
+
+def partition(lines, key, modulo, typecode):
+   """
+   Assign each line to the stripe given by the CRC-32 of its key modulo
+   modulo, so that all the lines sharing a key land in the same stripe, in
+   every run; return the stripe of each line as an array of typecode.
+   """
+   crc32 = zlib.crc32
+   return array(typecode, [crc32(k) % modulo for k in map(key, lines)])
+
+
+def assigned_blocks(infile, modulo, block_size=BLOCK_SIZE, cost=None, manifest=None, key=None):
+   """
+   Yield (lines, stripes, terminated) for the blocks of infile, like
+   line_blocks(), stripes holding the stripe of each line.  Lines are balanced
+   on their cost, a function or a key of COSTS, or partitioned on their key, a
+   function as returned by partition_key(), and their stripes are saved to
+   manifest, if given; without cost or key, they are read from manifest.
+   """
+   return assign_stripes(line_blocks(infile, block_size), modulo, cost, manifest, key)
+
+
+def assign_stripes(blocks, modulo, cost=None, manifest=None, key=None):
+   "Assign the lines of blocks, as yielded by line_blocks(), like assigned_blocks()."
+   if cost is not None:
+      cost = COSTS.get(cost, cost)
+      loads = [(0, s) for s in range(modulo)]
+   typecode = stripe_typecode(modulo)
+   following = cost is None and key is None
+   for lines, terminated in blocks:
+      if following:
+         stripes = manifest.read(len(lines))
+         if len(stripes) < len(lines):
+            raise IOError("%s: the input has more lines than the manifest" % manifest.name)
+      else:
+         if cost is not None:
+            stripes = balance(lines, loads, cost, typecode)
+         else:
+            stripes = partition(lines, key, modulo, typecode)
+         if manifest is not None:
+            manifest.write(stripes)
+      yield lines, stripes, terminated
+   if following and manifest.read(1):
+      raise IOError("%s: the input has fewer lines than the manifest" % manifest.name)
+
+
+def selected_blocks(infile, keep, numbered=False, block_size=BLOCK_SIZE, cost=None, manifest=None, key=None):
+   """
+   Yield (lines, numbers, terminated) for the lines of infile, by blocks, that
+   belong to a stripe s for which keep[s] is True; numbers holds their line
+   numbers if numbered, and is None otherwise.  Lines are assigned to stripes
+   round-robin or, given cost, manifest or key, as assigned_blocks() does.
+   """
+   return select_blocks(line_blocks(infile, block_size), keep, numbered, cost, manifest, key)
+
+
+def select_blocks(blocks, keep, numbered=False, cost=None, manifest=None, key=None):
+   "Select the lines of blocks, as yielded by line_blocks(), like selected_blocks()."
+   if not any(keep):
+      return
+   cpt = 0
+   if cost is None and manifest is None and key is None:
+      for lines, terminated in blocks:
+         selected = select(lines, cpt, keep)
+         if selected:
+            numbers = select(range(cpt, cpt + len(lines)), cpt, keep) if numbered else None
+            yield selected, numbers, terminated
+         cpt += len(lines)
+   else:
+      for lines, stripes, terminated in assign_stripes(blocks, len(keep), cost, manifest, key):
+         mask = list(map(keep.__getitem__, stripes))
+         selected = list(compress(lines, mask))
+         if selected:
+            numbers = list(compress(range(cpt, cpt + len(lines)), mask)) if numbered else None
+            yield selected, numbers, terminated
+         cpt += len(lines)
+
+
+def split(infile, outfile, index, jndex, modulo, complement=False, numbered=False, block_size=BLOCK_SIZE,
+          cost=None, manifest=None, key=None):
+   """
+   Write to outfile the lines of infile that belong to stripes [index, jndex)
+   or, with complement, the lines that don't.  With numbered, each line is
+   prefixed by its line number and a tab.  Given cost, manifest or key, lines
+   are assigned to stripes as assigned_blocks() does instead of round-robin.
+   """
+   keep = stripe_mask(index, jndex, modulo, complement)
+   for selected, numbers, terminated in selected_blocks(infile, keep, numbered, block_size, cost, manifest, key):
+      outfile.write(join_lines(selected, numbers, terminated))
+
+
+def stripe_lines(source, index, modulo, jndex=None, complement=False, numbered=False, block_size=BLOCK_SIZE,
+                 cost=None, manifest=None, key=None):
+   """
+   Iterate over the lines of stripe index of modulo of source, a filename or
+   a binary file, or over those of stripes [index, jndex), or of the other
+   stripes with complement.  Lines are bytes ending with their newline, but
+   for an unterminated last line; with numbered, they are prefixed by their
+   line number and a tab, as stripe.py -n writes them.  Given cost, manifest
+   or key, lines are assigned to stripes as assigned_blocks() does.
+   """
+   if jndex is None:
+      jndex = index + 1
+   keep = stripe_mask(index, jndex, modulo, complement)
+   infile = myopen(source, 'rb') if isinstance(source, str) else source
+   try:
+      for selected, numbers, terminated in selected_blocks(infile, keep, numbered, block_size, cost, manifest, key):
+         if numbers is not None:
+            lines = [b'%d\t%s\n' % pair for pair in zip(numbers, selected)]
+         else:
+            lines = [line + b'\n' for line in selected]
+         if not terminated:
+            lines[-1] = lines[-1][:-1]
+         for line in lines:
+            yield line
+   finally:
+      if infile is not source:
+         infile.close()
+
+
+def split_stripes(infile, outfiles, index, modulo, numbered=False, block_size=BLOCK_SIZE, cost=None, manifest=None,
+                  key=None):
+   """
+   Write, in a single pass over infile, stripe index + k to outfiles[k] for
+   every outfile given.  With numbered, each line is prefixed by its line
+   number and a tab.  Given cost, manifest or key, lines are assigned to
+   stripes as assigned_blocks() does instead of round-robin.
+   """
+   cpt = 0
+   if cost is None and manifest is None and key is None:
+      for lines, terminated in line_blocks(infile, block_size):
+         offset = cpt % modulo
+         for step, outfile in enumerate(outfiles, index):
+            start = (step - offset) % modulo
+            selected = lines[start::modulo]
+            if selected:
+               numbers = range(cpt + start, cpt + len(lines), modulo) if numbered else None
+               outfile.write(join_lines(selected, numbers, terminated))
+         cpt += len(lines)
+      return
+   for lines, stripes, terminated in assigned_blocks(infile, modulo, block_size, cost, manifest, key):
+      # Distribute the line numbers to their stripes in a single pass.
+      buckets = [[] for step in range(modulo)]
+      appends = [bucket.append for bucket in buckets]
+      for s, k in zip(stripes, range(cpt, cpt + len(lines))):
+         appends[s](k)
+      for step, outfile in enumerate(outfiles, index):
+         numbers = buckets[step]
+         if numbers:
+            selected = [lines[k - cpt] for k in numbers]
+            outfile.write(join_lines(selected, numbers if numbered else None, terminated))
+      cpt += len(lines)
+
+
+def lockstep_blocks(infiles, names, block_size=BLOCK_SIZE):
+   """
+   Read the parallel files infiles in lockstep and yield (lines, terminated)
+   like line_blocks(), lines[k] being the tuple of line k of every file and
+   terminated the tuple of whether each file's last line ends with a newline.
+   Raise IOError, naming the files by names, as soon as one file runs out of
+   lines before the others.
+   """
+   leader = line_blocks(infiles[0], block_size)
+   followers = [StripeReader(infile, block_size) for infile in infiles[1:]]
+   for lines, terminated in leader:
+      n = len(lines)
+      parts = [lines]
+      terminateds = [terminated]
+      for follower, name in zip(followers, names[1:]):
+         follower.fill(n)
+         if follower.available() < n:
+            raise IOError("%s has fewer lines than %s" % (name, names[0]))
+         parts.append(follower.take(n))
+         terminateds.append(follower.available() > 0 or follower.terminated)
+      lines = list(zip(*parts))
+      if all(terminateds):
+         yield lines, tuple(terminateds)
+      else:
+         # Some file ended without a newline: give its last line a block of
+         # its own, as line_blocks() does.
+         if n > 1:
+            yield lines[:-1], (True,) * len(parts)
+         yield lines[-1:], tuple(terminateds)
+   for follower, name in zip(followers, names[1:]):
+      if follower.fill():
+         raise IOError("%s has more lines than %s" % (name, names[0]))
+
+
+def line_counts(infilenames):
+   """
+   Return the number of lines of each of infilenames if all of them are plain
+   text files with an up-to-date line-offset index, None otherwise.
+   """
+   counts = []
+   for filename in infilenames:
+      if filename == "-" or filename[-3:] == ".gz":
+         return None
+      try:
+         lineIndex = LineIndex(filename, build=False)
+      except (IOError, OSError):
+         return None
+      counts.append(len(lineIndex))
+      lineIndex.file.close()
+   return counts
+
+
+def split_lockstep(infilenames, outfiles, index, jndex, modulo, complement=False, numbered=False,
+                   block_size=BLOCK_SIZE, cost=None, manifest=None, key=None):
+   """
+   Split the parallel files infilenames, which must have the same number of
+   lines, in a single pass reading them in lockstep: write to outfiles[k] the
+   lines of infilenames[k] that belong to stripes [index, jndex) or, with
+   complement, the lines that don't, as split() does.  Lines are assigned to
+   stripes round-robin or, given cost, manifest or key, as assigned_blocks()
+   does, the cost of a line being the sum of the costs of its parallel lines
+   and its key that of its line in infilenames[0].
+
+   A line count mismatch raises IOError: before writing anything if every
+   infile is indexed, as soon as the shorter file ends otherwise.
+   """
+   counts = line_counts(infilenames)
+   if counts is not None and len(set(counts)) > 1:
+      raise IOError("Parallel files have different line counts: %s"
+                    % ", ".join("%s: %d" % pair for pair in zip(infilenames, counts)))
+   keep = stripe_mask(index, jndex, modulo, complement)
+   if cost is not None:
+      cost = COSTS.get(cost, cost)
+      cost = lambda lines, cost=cost: sum(map(cost, lines))
+   if key is not None:
+      key = lambda lines, key=key: key(lines[0])
+   infiles = []
+   try:
+      for filename in infilenames:
+         infiles.append(myopen(filename, 'rb'))
+      blocks = lockstep_blocks(infiles, infilenames, block_size)
+      for selected, numbers, terminated in select_blocks(blocks, keep, numbered, cost, manifest, key):
+         for lines, last, outfile in zip(zip(*selected), terminated, outfiles):
+            outfile.write(join_lines(lines, numbers, last))
+   finally:
+      for infile in infiles:
+         infile.close()
+
+
+# Blocks queued for each consumer of stripe.py -f before the reader waits.
+FIFO_QUEUE_SIZE = 8
+
+
+class FifoWriter(object):
+   """
+   Write to the named pipe filename, created if needed, from a thread of its
+   own through a queue of at most FIFO_QUEUE_SIZE blocks: the reader only
+   waits once this consumer is that far behind, so a slow consumer throttles
+   the reader instead of piling the file up in memory.  If the consumer
+   closes its end early, the rest of its data is discarded, so the other
+   consumers still get theirs, and close() raises IOError.
+   """
+   def __init__(self, filename):
+      import stat
+      import threading
+      from queue import Queue
+      self.name = filename
+      self.created = False
+      try:
+         os.mkfifo(filename)
+         self.created = True
+      except OSError as err:
+         if not (os.path.exists(filename) and stat.S_ISFIFO(os.stat(filename).st_mode)):
+            raise IOError("Cannot create the named pipe %s: %s" % (filename, err))
+      self.error = None
+      self.blocks = Queue(FIFO_QUEUE_SIZE)
+      self.thread = threading.Thread(target=self.drain)
+      self.thread.daemon = True
+
+   def start(self):
+      self.thread.start()
+
+   def drain(self):
+      try:
+         with open(self.name, 'wb') as fifo:
+            for data in iter(self.blocks.get, None):
+               fifo.write(data)
+      except (IOError, OSError) as err:
+         self.error = err
+         for data in iter(self.blocks.get, None):
+            pass
+
+   def write(self, data):
+      if data:
+         self.blocks.put(data)
+
+   def close(self):
+      "Wait until the consumer has read everything, and remove the pipe if we created it."
+      self.blocks.put(None)
+      self.thread.join()
+      self.remove()
+      if self.error is not None:
+         raise IOError("%s: %s" % (self.name, self.error))
+
+   def remove(self):
+      if self.created:
+         os.remove(self.name)
+         self.created = False
+
 
+def serve_stripes(infile, fifonames, index, modulo, numbered=False, block_size=BLOCK_SIZE, cost=None,
+                  manifest=None, key=None):
+   """
+   Read infile once and serve stripe index + k to the consumer of the named
+   pipe fifonames[k], for every name given, as split_stripes() would write
+   them, through FifoWriters.  All the consumers must read concurrently: the
+   reader waits for the slowest one.
+   """
+   writers = []
+   try:
+      for name in fifonames:
+         writers.append(FifoWriter(name))
+      for writer in writers:
+         writer.start()
+      split_stripes(infile, writers, index, modulo, numbered, block_size, cost, manifest, key)
+      errors = []
+      for writer in writers:
+         try:
+            writer.close()
+         except IOError as err:
+            errors.append(str(err))
+      if errors:
+         raise IOError("Consumers closed their named pipe early: %s" % "; ".join(errors))
+   finally:
+      for writer in writers:
+         writer.remove()
+
+
+class MappedFile(object):
+   "Read-only file interface to bytes [start, end) of a mmap."
+   def __init__(self, mapped, start, end):
+      self.view = memoryview(mapped)
+      self.position = start
+      self.end = end
+
+   def read(self, size):
+      start = self.position
+      self.position = min(self.end, start + size)
+      return self.view[start:self.position].tobytes()
+
+   def close(self):
+      self.view.release()
+
+
+class LineIndex(object):
+   """
+   Line-offset index of a plain text file, kept in the sidecar file
+   filename.idx: the little-endian 64 bit offset of the start of each line,
+   followed by the size of the file.  Only the offsets needed get read.
+   """
+   entry = struct.Struct('<Q')
+
+   def __init__(self, filename, block_size=BLOCK_SIZE, build=True):
+      """
+      Open the index of filename, building it if it is missing or out of
+      date, or raising IOError then if build is False.
+      """
+      self.filename = filename + ".idx"
+      self.file = None
+      if self.is_stale(filename):
+         if not build:
+            raise IOError("%s is missing or out of date" % self.filename)
+         self.build(filename, block_size)
+      if self.file is None:
+         self.file = open(self.filename, 'rb')
+      self.file.seek(0, os.SEEK_END)
+      self.num_lines = self.file.tell() // self.entry.size - 1
+
+   def __len__(self):
+      return self.num_lines
+
+   def offsets(self, first, last):
+      "Array of the byte offsets of lines [first, last], last <= len(self)."
+      self.file.seek(first * self.entry.size)
+      offsets = array('Q')
+      offsets.frombytes(self.file.read((last + 1 - first) * self.entry.size))
+      if sys.byteorder == 'big':
+         offsets.byteswap()
+      return offsets
+
+   def offset(self, k):
+      "Byte offset of the start of line k, the size of the file for k == len(self)."
+      self.file.seek(k * self.entry.size)
+      return self.entry.unpack(self.file.read(self.entry.size))[0]
+
+   def is_stale(self, filename):
+      "Is the sidecar index missing or older than filename?"
+      try:
+         index_stat = os.stat(self.filename)
+         file_stat = os.stat(filename)
+      except OSError:
+         return True
+      if index_stat.st_mtime < file_stat.st_mtime or index_stat.st_size < self.entry.size:
+         return True
+      with open(self.filename, 'rb') as index:
+         index.seek(-self.entry.size, os.SEEK_END)
+         return self.entry.unpack(index.read(self.entry.size))[0] != file_stat.st_size
+
+   def build(self, filename, block_size):
+      """
+      Scan filename and stream its line offsets to the sidecar index, written
+      atomically so that concurrent builds are harmless; if the sidecar cannot
+      be written, the index is only kept in memory.
+      """
+      if verbose_flag: print("Building line-offset index", self.filename, file=sys.stderr)
+      tmpname = "%s.%d.tmp" % (self.filename, os.getpid())
+      with open(filename, 'rb') as infile:
+         try:
+            with open(tmpname, 'wb') as index:
+               self.scan(infile, block_size, index)
+            os.rename(tmpname, self.filename)
+            return
+         except (IOError, OSError) as err:
+            print("Warning: cannot save the line-offset index %s: %s" % (self.filename, err), file=sys.stderr)
+            if os.path.exists(tmpname):
+               os.remove(tmpname)
+         infile.seek(0)
+         offsets = io.BytesIO()
+         self.scan(infile, block_size, offsets)
+      offsets.seek(0)
+      self.file = offsets
+
+   def scan(self, infile, block_size, index):
+      "Write the packed line offsets of infile, and its size, to index."
+      position = 0
+      terminated = True
+      starts = array('Q', [0])
+      while True:
+         block = infile.read(block_size)
+         if not block:
+            break
+         lines = block.split(b'\n')
+         # Each newline starts a new line; the last piece doesn't end with one.
+         starts.extend(islice(accumulate(chain([position], map(add, map(len, lines[:-1]), repeat(1)))), 1, None))
+         position += len(block)
+         terminated = block.endswith(b'\n')
+         if sys.byteorder == 'big':
+            starts.byteswap()
+         index.write(starts.tobytes())
+         del starts[:]
+      if not terminated:
+         index.write(self.entry.pack(position))
+
+
+def split_contiguous(filename, outfiles, index, jndex, modulo, complement=False, numbered=False, block_size=BLOCK_SIZE):
+   """
+   Split filename in modulo contiguous chunks of lines, chunk i holding lines
+   [i*N/m, (i+1)*N/m), and write chunks [index, jndex), or the other ones with
+   complement, to outfiles[0], or chunk index + k to outfiles[k] if there is
+   one outfile per chunk.  Only the selected chunks are read, using the
+   line-offset index of filename and a mmap.
+   """
+   lineIndex = LineIndex(filename, block_size)
+   N = len(lineIndex)
+   boundaries = [step * N // modulo for step in range(modulo + 1)]
+   if len(outfiles) > 1:
+      ranges = [(boundaries[step], boundaries[step + 1]) for step in range(index, jndex)]
+   elif complement:
+      ranges = [(0, boundaries[index]), (boundaries[jndex], N)]
+   else:
+      ranges = [(boundaries[index], boundaries[jndex])]
+   if debug_flag: print("Line ranges", ranges, "of", N, file=sys.stderr)
+
+   if os.path.getsize(filename) == 0:
+      return
+   import mmap
+   with open(filename, 'rb') as infile:
+      mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+   for k, (first, last) in enumerate(ranges):
+      outfile = outfiles[k] if len(outfiles) > 1 else outfiles[0]
+      if first >= last:
+         continue
+      start, end = lineIndex.offset(first), lineIndex.offset(last)
+      if numbered:
+         chunk = MappedFile(mapped, start, end)
+         for lines, terminated in line_blocks(chunk, block_size):
+            outfile.write(join_lines(lines, range(first, first + len(lines)), terminated))
+            first += len(lines)
+         chunk.close()
+      else:
+         view = memoryview(mapped)
+         for position in range(start, end, block_size):
+            outfile.write(view[position:min(position + block_size, end)])
+         view.release()
+   mapped.close()
+
+
+def write_views(outfile, views):
+   """
+   Write views, a list of memoryviews, to outfile, with vectored writes
+   straight from the views when outfile is a plain file or pipe, joining them
+   otherwise.
+   """
+   try:
+      fd = outfile.fileno() if hasattr(os, 'writev') else None
+   except (AttributeError, io.UnsupportedOperation):
+      fd = None
+   if fd is None:
+      outfile.write(b''.join(views))
+      return
+   outfile.flush()
+   for start in range(0, len(views), IOV_MAX):
+      batch = views[start:start + IOV_MAX]
+      written = os.writev(fd, batch)
+      size = sum(map(len, batch))
+      if written < size:
+         rest = b''.join(batch)[written:]
+         while rest:
+            rest = rest[os.write(fd, rest):]
+
+
+# How many buffers os.writev() accepts at once.
+try:
+   IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+   IOV_MAX = 1024
+if IOV_MAX <= 0:
+   IOV_MAX = 1024
+
+
+def stripe_runs(keep, numbered=False):
+   """
+   Return the runs [a, b) of consecutive stripes s for which keep[s] is True,
+   or, if numbered, one run per such stripe, since each line then needs its
+   own prefix.
+   """
+   runs = []
+   for s, kept in enumerate(keep):
+      if kept:
+         if runs and runs[-1][1] == s and not numbered:
+            runs[-1] = (runs[-1][0], s + 1)
+         else:
+            runs.append((s, s + 1))
+   return runs
+
+
+def mapped_lines(view, offsets, first, n, runs, modulo, numbered=False):
+   """
+   Return memoryviews, from view, of the lines [first, first + n) whose
+   stripe falls in one of runs, first being a multiple of modulo and offsets
+   holding the byte offsets of lines [first, first + n].  With numbered, each
+   line is preceded by its line number and a tab.
+   """
+   parts = []
+   for a, b in runs:
+      starts = offsets[a:n:modulo]
+      ends = offsets[b:n + 1:modulo]
+      if len(ends) < len(starts):
+         # The last round stops short of the end of the run.
+         ends.append(offsets[n])
+      part = list(map(view.__getitem__, map(slice, starts, ends)))
+      if numbered:
+         part = list(zip([b'%d\t' % k for k in range(first + a, first + n, modulo)], part))
+      parts.append(part)
+   if len(parts) == 1:
+      lines = parts[0]
+   else:
+      # Interleave the runs, round by round.
+      lines = [line for turn in zip_longest(*parts) for line in turn if line is not None]
+   return list(chain.from_iterable(lines)) if numbered else lines
+
+
+def split_mapped(filename, outfiles, index, jndex, modulo, complement=False, numbered=False, block_size=BLOCK_SIZE,
+                 lineIndex=None):
+   """
+   Write stripes [index, jndex) of filename, or the other ones with
+   complement, to outfiles[0], or stripe index + k to outfiles[k] if there is
+   one outfile per stripe, like split() and split_stripes(), without copying
+   the lines: filename is mapped in memory, its line-offset index gives the
+   boundaries of the lines, and memoryviews of the selected lines are written
+   with write_views(), block_size / 16 lines at a time, the index entries of
+   a block of text.  Consecutive lines of selected stripes are written as one
+   view unless numbered.
+   """
+   if lineIndex is None:
+      lineIndex = LineIndex(filename, block_size)
+   N = len(lineIndex)
+   if len(outfiles) > 1:
+      jobs = [(outfile, [(step, step + 1)]) for step, outfile in enumerate(outfiles, index)]
+   else:
+      jobs = [(outfiles[0], stripe_runs(stripe_mask(index, jndex, modulo, complement), numbered))]
+   if N == 0:
+      return
+   import mmap
+   with open(filename, 'rb') as infile:
+      mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+   view = memoryview(mapped)
+   chunk = max(1, block_size // 16 // modulo) * modulo
+   for first in range(0, N, chunk):
+      # Chunks start on a multiple of modulo: line first + k is in stripe k % modulo.
+      n = min(chunk, N - first)
+      offsets = lineIndex.offsets(first, first + n)
+      for outfile, runs in jobs:
+         views = mapped_lines(view, offsets, first, n, runs, modulo, numbered)
+         if views:
+            write_views(outfile, views)
+   # The views of the lines must all be gone before the map can be closed.
+   views = None
+   view.release()
+   mapped.close()
+
+
+def stripe_filenames(args):
+   "Return the stripes to rebuild, given as a list of files or a prefix."
    # Open files from a pattern.
    inputfilenames = args
    # Let see if the user provided us with a pattern.
    if len(args) == 1:
+      import glob
       inputfilenames = glob.glob(args[0] + "*")
       sort_nicely(inputfilenames)  # Safer sort if filename are not properly sorted when using alpha sorting.
       if len(inputfilenames) == 0:
@@ -122,68 +1104,641 @@ def rebuild():
          inputfilenames = args
 
    if len(inputfilenames) <= 0:
-      print("Cannot find any file with ", inputfilenames, file=sys.stderr)
-      sys.exit(1)
+      raise IOError("Cannot find any file with %s" % inputfilenames)
 
-   if opts.verbose: print("Rebuilding output from ", repr(inputfilenames), file=sys.stderr)
+   if verbose_flag: print("Rebuilding output from ", repr(inputfilenames), file=sys.stderr)
+   return inputfilenames
 
-   # What if the user provided use we more files than the os allows us to have opened at once?
-   try:
-      inputfiles = list(map(myOpenRead, inputfilenames))
-   except IOError:
-      print("You provided %d files to merge but the os doesn't allow that many file to be opened at once." % len(inputfilenames), file=sys.stderr)
-      sys.exit(1)
 
-   if opts.debug: print(inputfiles, file=sys.stderr)
+def concatenate(inputfilenames, outfile, block_size=BLOCK_SIZE):
+   "Rebuild the output of stripe.py -b, simply concatenating its chunks."
+   for filename in inputfilenames:
+      inputfile = myopen(filename, 'rb')
+      while True:
+         block = inputfile.read(block_size)
+         if not block:
+            break
+         outfile.write(block)
+      inputfile.close()
 
-   if sys.version_info >= (3, 0):
-      outfile = sys.stdout.buffer
-   else:
-      outfile = sys.stdout
 
-   cpt = 0
-   M = len(inputfiles)
+# Memory shared by the read buffers of all the stripes when merging them.
+MERGE_BUFFER_SIZE = 256<<20
+# Beyond this many stripes, .gz stripes are decompressed without a thread each.
+MAX_PREFETCHED_STRIPES = 32
+
+
+class StripeReader(object):
+   "Buffered access to the lines of one stripe, read in blocks."
+   def __init__(self, inputfile, block_size):
+      self.blocks = line_blocks(inputfile, block_size)
+      self.lines = []
+      self.position = 0
+      self.terminated = True
+
+   def available(self):
+      return len(self.lines) - self.position
+
+   def fill(self, n=1):
+      """
+      Buffer at least n lines, fewer only at the end of the stripe.
+      Returns False once the stripe is exhausted.
+      """
+      if self.available() < n:
+         lines = self.lines[self.position:]
+         for block, self.terminated in self.blocks:
+            lines.extend(block)
+            if len(lines) >= n:
+               break
+         self.lines, self.position = lines, 0
+      return self.available() > 0
+
+   def take(self, n):
+      start = self.position
+      self.position += n
+      return self.lines[start:self.position]
+
+
+def merge_stripes(inputfiles, outfile, quotas=None, block_size=BLOCK_SIZE, regular=False):
+   """
+   Round-robin merge of inputfiles to outfile: quotas[s], 1 by default,
+   lines from input s in turn, skipping inputs that are exhausted.  Lines are
+   merged by whole blocks, as many rounds at a time as every input has lines
+   buffered.  The last line of the output is left unterminated if it was
+   unterminated in its input.  If regular, raises IOError unless every input
+   has its full quota in each turn but the last.
+   """
+   if quotas is None:
+      quotas = [1] * len(inputfiles)
+   active = [(StripeReader(inputfile, block_size), quota) for inputfile, quota in zip(inputfiles, quotas)]
+   newline = b''
    while True:
-      if M == 0: break
-      index = cpt % M
-      if opts.debug: print("\t", repr(index), file=sys.stderr)
-      inputfile = inputfiles[index]
-      line = inputfile.readline()
-      if line == b'':
-         inputfiles.pop(index)
-         M -= 1
+      before = len(active)
+      active = [(reader, quota) for reader, quota in active if reader.fill(quota)]
+      if not active:
+         break
+      M = len(active)
+      if regular and M < before:
+         # An input ran out, so this turn must be the last one.
+         for reader, quota in active:
+            reader.fill(quota + 1)
+         if any(reader.available() > quota for reader, quota in active):
+            raise IOError("stripe lengths differ by more than one line, cannot merge them in groups")
+      rounds = min(reader.available() // quota for reader, quota in active)
+      if rounds == 0:
+         # Some stripe is down to its last, partial turn: do a single round.
+         parts = [reader.take(min(quota, reader.available())) for reader, quota in active]
+         lines = list(chain.from_iterable(parts))
+         last = [reader for (reader, quota), part in zip(active, parts) if part][-1]
+         if regular and any(reader.fill() for reader, quota in active):
+            raise IOError("stripe lengths differ by more than one line, cannot merge them in groups")
+      elif len(quotas) == quotas.count(1):
+         lines = [None] * (rounds * M)
+         for s, (reader, quota) in enumerate(active):
+            lines[s::M] = reader.take(rounds)
+         last = active[-1][0]
       else:
-         outfile.write(line)
-      cpt += 1
+         parts = [reader.take(rounds * quota) for reader, quota in active]
+         lines = [line for r in range(rounds)
+                       for part, (reader, quota) in zip(parts, active)
+                       for line in part[r * quota:(r + 1) * quota]]
+         last = active[-1][0]
+      # Hold back the newline of the last line until we know it was terminated.
+      outfile.write(newline + b'\n'.join(lines))
+      newline = b'\n' if last.available() or last.terminated else b''
+   outfile.write(newline)
 
 
-if opts.rebuild:
-   if index + 1 != jndex:
-      print("Not implemented yet!  You can only merge if you used -i without a range.", file=sys.stderr)
-      sys.exit(1)
-   rebuild()
-else:
-   # Performing a split
-   # NOTE: look at import fileinput for line in fileinput.input(filenames): process(line)  to process all lines from a list of filenames.
-   if sys.version_info >= (3, 0):
-      infile  = myopen(args[0], 'rb') if len(args) >= 1 else sys.stdin.buffer
-      outfile = myopen(args[1], 'wb') if len(args) == 2 else sys.stdout.buffer
+def merge_assigned(inputfiles, outfile, manifest, block_size=BLOCK_SIZE):
+   """
+   Merge inputfiles, the stripes of a file split with stripe.py -w, to
+   outfile, taking each line from the stripe manifest assigned it to, so that
+   the original order is restored exactly.
+   """
+   from collections import Counter
+   readers = [StripeReader(inputfile, block_size) for inputfile in inputfiles]
+   newline = b''
+   while True:
+      stripes = manifest.read(max(1, block_size // 64))
+      if not stripes:
+         break
+      parts = [iter(())] * len(readers)
+      for s, n in Counter(stripes).items():
+         reader = readers[s]
+         reader.fill(n)
+         if reader.available() < n:
+            raise IOError("%s: stripe %d has fewer lines than the manifest" % (manifest.name, s))
+         parts[s] = iter(reader.take(n))
+      lines = list(map(next, map(parts.__getitem__, stripes)))
+      # Hold back the newline of the last line until we know it was terminated.
+      outfile.write(newline + b'\n'.join(lines))
+      last = readers[stripes[-1]]
+      newline = b'\n' if last.available() or last.terminated else b''
+   for s, reader in enumerate(readers):
+      if reader.fill():
+         raise IOError("%s: stripe %d has more lines than the manifest" % (manifest.name, s))
+   outfile.write(newline)
+
+
+def numbered_lines(inputfile, s, strip=False, block_size=BLOCK_SIZE):
+   """
+   Yield (line number, s, line, terminated) for each line of inputfile, a
+   stripe written by stripe.py -n, with its line number stripped if strip.
+   """
+   previous = -1
+   for lines, terminated in line_blocks(inputfile, block_size):
+      for line in lines:
+         number, tab, text = line.partition(b'\t')
+         try:
+            if not tab:
+               raise ValueError
+            key = int(number)
+         except ValueError:
+            raise IOError("%s: line not prefixed by a line number: %r" % (inputfile.name, line[:60]))
+         if key < previous:
+            raise IOError("%s: line %d comes after line %d, stripes must be sorted by line number" % (inputfile.name, key, previous))
+         previous = key
+         yield key, s, text if strip else line, terminated
+
+
+def merge_numbered(inputfiles, outfile, strip=False, report_gaps=False, block_size=BLOCK_SIZE):
+   """
+   Merge inputfiles, stripes written by stripe.py -n, on their line numbers
+   with a k-way heap merge, streaming them without loading any in memory.
+   With report_gaps, missing and duplicated line numbers are reported to
+   stderr.
+   """
+   import heapq
+   streams = [numbered_lines(inputfile, s, strip, block_size) for s, inputfile in enumerate(inputfiles)]
+   expected = 0
+   missing = gaps = duplicates = 0
+   batch = []
+   newline = b''
+   terminated = True
+   for key, s, line, terminated in heapq.merge(*streams):
+      if key != expected:
+         if key > expected:
+            missing += key - expected
+            gaps += 1
+            if report_gaps:
+               print("Missing lines %d to %d" % (expected, key - 1), file=sys.stderr)
+         else:
+            duplicates += 1
+            if report_gaps:
+               print("Duplicated line %d" % key, file=sys.stderr)
+      expected = key + 1
+      batch.append(line)
+      if len(batch) >= 4096:
+         outfile.write(newline + b'\n'.join(batch))
+         newline = b'\n'
+         batch = []
+   if batch:
+      outfile.write(newline + b'\n'.join(batch))
+      newline = b'\n'
+   if terminated:
+      outfile.write(newline)
+   if report_gaps or verbose_flag:
+      print("Merged lines 0 to %d: %d missing line(s) in %d gap(s), %d duplicated line(s)"
+            % (expected - 1, missing, gaps, duplicates), file=sys.stderr)
+
+
+def line_number(line):
+   "Return the line number prefixed to line, bytes or str, by stripe.py -n."
+   number, tab, text = line.partition(b'\t' if isinstance(line, bytes) else '\t')
+   if not tab:
+      raise ValueError("line not prefixed by a line number: %r" % line[:60])
+   return int(number)
+
+
+def merge_lines(streams, numbered=False, strip=False):
+   """
+   Iterate over the lines of streams, iterables of lines such as those of
+   stripe_lines(), taking one line from each stream in turn and skipping
+   exhausted streams, which rebuilds the lines the stripes came from.  With
+   numbered, the streams hold numbered lines, each sorted by line number, and
+   are merged on their line numbers, which are stripped if strip.
+   """
+   if numbered:
+      import heapq
+      for line in heapq.merge(*streams, key=line_number):
+         if strip:
+            line = line.partition(b'\t' if isinstance(line, bytes) else '\t')[2]
+         yield line
+      return
+   iterators = [iter(stream) for stream in streams]
+   while iterators:
+      active = []
+      for iterator in iterators:
+         for line in iterator:
+            yield line
+            active.append(iterator)
+            break
+      iterators = active
+
+
+def max_open_files(max_open=None):
+   """
+   How many stripes can be opened at once, keeping some descriptors in
+   reserve, unless max_open is given; at least 2, to merge them in groups.
+   """
+   if max_open is not None:
+      return max(2, max_open)
+   try:
+      import resource
+      limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+   except (ImportError, ValueError):
+      return 1000
+   if limit == resource.RLIM_INFINITY:
+      return 1<<16
+   return max(2, limit - 64)
+
+
+def merge_files(inputfilenames, outfile, quotas=None, tmpdir=None, numbered=False, strip=False, report_gaps=False,
+                block_size=BLOCK_SIZE, max_open=None, manifest=None, regular=False):
+   """
+   Merge the stripes in inputfilenames to outfile, round-robin or, if
+   numbered, on their line numbers, or following manifest if given.  If there
+   are more stripes than can be opened at once, or than max_open, consecutive
+   groups of stripes are first merged to temporary files, and those are merged
+   taking, in turn, as many lines from each one as there are stripes in its
+   group, or on their line numbers.  That only restores the round-robin order
+   if the lengths of the stripes of a group differ by at most one line, as
+   stripe.py writes them; IOError is raised otherwise, by merge_stripes() with
+   regular.
+   """
+   if quotas is None:
+      quotas = [1] * len(inputfilenames)
+   M = len(inputfilenames)
+   max_open = max_open_files(max_open)
+   if manifest is not None and manifest.modulo != M:
+      raise ValueError("%s is the manifest of %d stripes, not %d" % (manifest.name, manifest.modulo, M))
+   if M > max_open:
+      if manifest is not None:
+         raise IOError("Cannot open the %d stripes at once to merge them following a manifest" % M)
+      import tempfile
+      import shutil
+      if verbose_flag: print("Merging %d stripes in groups of %d" % (M, max_open), file=sys.stderr)
+      groups = [(inputfilenames[start:start + max_open], quotas[start:start + max_open])
+                for start in range(0, M, max_open)]
+      workdir = tempfile.mkdtemp(prefix="stripe.py.", dir=tmpdir)
+      try:
+         groupfilenames = []
+         for g, (filenames, group_quotas) in enumerate(groups):
+            groupfilenames.append(os.path.join(workdir, "%d" % g))
+            with open(groupfilenames[-1], 'wb') as groupfile:
+               merge_files(filenames, groupfile, group_quotas, tmpdir, numbered,
+                           block_size=block_size, max_open=max_open, regular=True)
+         merge_files(groupfilenames, outfile, [sum(q) for f, q in groups], tmpdir, numbered, strip, report_gaps,
+                     block_size, max_open)
+      finally:
+         shutil.rmtree(workdir)
+      return
+
+   prefetch = M <= MAX_PREFETCHED_STRIPES
+   block_size = max(1<<16, min(block_size, MERGE_BUFFER_SIZE // M))
+   inputfiles = []
+   try:
+      for filename in inputfilenames:
+         if debug_flag: print("Opening stripe: ", filename, file=sys.stderr)
+         inputfiles.append(myopen(filename, 'rb', prefetch))
+      if manifest is not None:
+         merge_assigned(inputfiles, outfile, manifest, block_size)
+      elif numbered:
+         merge_numbered(inputfiles, outfile, strip, report_gaps, block_size)
+      else:
+         merge_stripes(inputfiles, outfile, quotas, block_size, regular)
+   finally:
+      for inputfile in inputfiles:
+         inputfile.close()
+
+
+def rebuild(inputfilenames, outfile, index=0, jndex=-1, **kwargs):
+   """
+   This function will unstripe the output of a previous usage of stripe.py.
+   Only stripes [index, jndex) are merged, all of them if jndex is -1.
+   Other keyword arguments are passed on to merge_files().
+   """
+   if jndex == -1:
+      jndex = len(inputfilenames)
+   if not (0 <= index < jndex <= len(inputfilenames)):
+      raise ValueError("Indices format is -i i:j where [i,j) where 0 <= i < j <= %d, the number of stripes." % len(inputfilenames))
+   merge_files(inputfilenames[index:jndex], outfile, **kwargs)
+
+
+def open_stripes(template, index, jndex):
+   "Open the outfiles of stripes [index, jndex) named after template."
+   outfiles = []
+   try:
+      for step in range(index, jndex):
+         outfiles.append(myopen(template % step, 'wb'))
+   except IOError as err:
+      for outfile in outfiles:
+         outfile.close()
+      raise IOError("Cannot open the output for stripe %d: %s" % (step, err))
+   return outfiles
+
+
+def mapped_index(args, opts):
+   """
+   Return the line-offset index of the infile in args if the split can be
+   done by split_mapped(), None otherwise: infile must be a plain text file
+   with an up-to-date index, and the lines assigned round-robin.
+   """
+   if len(args) == 0 or args[0] == "-" or args[0][-3:] == ".gz":
+      return None
+   if opts.cost is not None or opts.manifest is not None or opts.field is not None or opts.regex is not None:
+      return None
+   try:
+      return LineIndex(args[0], opts.block_size, build=False)
+   except (IOError, OSError):
+      return None
+
+
+def get_parser():
+   "Return the parser of stripe.py's command line."
+   from optparse import OptionParser, SUPPRESS_HELP
+   parser = OptionParser(usage=usage, description=help)
+   parser.add_option("-i", dest="indices", type="string", default=None,
+                     help="what indices to display [0, or 0:m with -o] valid value [0, m)"
+                     + "-i [i:j) where 0 <= i < j <= m; with -r, which of the infiles "
+                     + "to merge, 0 <= i < j <= their number [all of them]")
+   parser.add_option("-m", dest="modulo", type="int", default=None,
+                     help="How many chunks aka modulo [3, or as in the manifest with -a]")
+   parser.add_option("-c", dest="complement", action="store_true", default=False,
+                     help="writes lines that are NOT 0 <= i < j <=m [%default]")
+   parser.add_option("-n", dest="numbered", action="store_true", default=False,
+                     help="Prefix each line with its line number [%default]")
+   parser.add_option("-o", dest="template", type="string", default=None,
+                     help="write each stripe i to the file named TEMPLATE % i, "
+                     + "e.g. -o out.%04d, in a single pass over the input [%default]",
+                     metavar="TEMPLATE")
+   parser.add_option("-f", dest="fifos", type="string", default=None,
+                     help="serve each stripe i to the consumer of the named pipe TEMPLATE % i, "
+                     + "created if needed, in a single pass over the input [%default]",
+                     metavar="TEMPLATE")
+   parser.add_option("-b", dest="contiguous", action="store_true", default=False,
+                     help="split in contiguous chunks of lines instead of stripes, "
+                     + "using the line-offset index infile.idx [%default]")
+   parser.add_option("-l", dest="lockstep", action="store_true", default=False,
+                     help="split parallel files in lockstep, given as infile outfile pairs [%default]")
+   parser.add_option("-x", dest="build_index", action="store_true", default=False,
+                     help="only build or refresh the line-offset index infile.idx [%default]")
+   parser.add_option("-w", dest="cost", type="choice", choices=sorted(COSTS), default=None,
+                     help="balance the stripes on the COST of their lines, "
+                     + "one of: %s, instead of round-robin [%%default]" % ", ".join(sorted(COSTS)),
+                     metavar="COST")
+   parser.add_option("-k", dest="field", type="int", default=None,
+                     help="partition the lines on the hash of their field number FIELD, counting "
+                     + "from 1, instead of striping them [%default]",
+                     metavar="FIELD")
+   parser.add_option("-t", dest="separator", type="string", default=None,
+                     help="with -k, fields are separated by SEP [runs of whitespace]",
+                     metavar="SEP")
+   parser.add_option("-e", dest="regex", type="string", default=None,
+                     help="partition the lines on the hash of the first group, or the whole match, "
+                     + "of the first match of REGEX [%default]",
+                     metavar="REGEX")
+   parser.add_option("-a", dest="manifest", type="string", default=None,
+                     help="with -w, -k or -e, save the stripe of each line to MANIFEST; otherwise, split "
+                     + "following MANIFEST; with -r, merge following MANIFEST [%default]",
+                     metavar="MANIFEST")
+   parser.add_option("-r", dest="rebuild", action="store_true", default=False,
+                     help="rebuild whole file from stripes, or only merge the "
+                     + "stripes selected with -i [%default]")
+   parser.add_option("-s", dest="strip", action="store_true", default=False,
+                     help="with -r -n, strip the line numbers from the output [%default]")
+   parser.add_option("-g", dest="report_gaps", action="store_true", default=False,
+                     help="with -r -n, report missing and duplicated line numbers to stderr [%default]")
+   parser.add_option("-j", dest="threads", type="int", default=compression_threads,
+                     help="number of threads compressing .gz outputs [%default]")
+   parser.add_option("-v", dest="verbose", action="store_true", default=False,
+                     help="write verbose output to stderr [%default]")
+   parser.add_option("-d", dest="debug", action="store_true", default=False,
+                     help="write debug output to stderr [%default]")
+   # Hidden options for unit testing the block boundaries and the merge of more
+   # stripes than can be opened at once.
+   parser.add_option("--block-size", dest="block_size", type="int", default=BLOCK_SIZE,
+                     help=SUPPRESS_HELP)
+   parser.add_option("--max-open", dest="max_open", type="int", default=None,
+                     help=SUPPRESS_HELP)
+   return parser
+
+
+def main(argv=None):
+   """
+   Run stripe.py's command line, argv defaulting to sys.argv[1:], printing
+   errors and exiting with status 1 on failure.
+   """
+   global verbose_flag, debug_flag, compression_threads
+   parser = get_parser()
+   (opts, args) = parser.parse_args(argv)
+   if opts.rebuild:
+      if len(args) == 0:
+          parser.error("too few arguments to rebuild the output")
+   elif opts.build_index:
+      if len(args) != 1:
+          parser.error("-x requires exactly one infile")
+   elif opts.lockstep:
+      if len(args) == 0 or len(args) % 2 != 0:
+          parser.error("-l requires infile outfile pairs")
+      if opts.template is not None or opts.fifos is not None or opts.contiguous:
+          parser.error("-l cannot be used with -o, -f or -b")
+   elif opts.fifos is not None:
+      if len(args) > 1:
+          parser.error("too many arguments, the named pipes are given by -f")
+      if opts.complement or opts.template is not None or opts.contiguous:
+          parser.error("-f cannot be used with -c, -o or -b")
+      try:
+         opts.fifos % 0
+      except (TypeError, ValueError):
+         parser.error("-f TEMPLATE must contain exactly one integer conversion, e.g. fifo.%d")
+   elif opts.template is not None:
+      if len(args) > 1:
+          parser.error("too many arguments, the outfiles are given by -o")
+      if opts.complement:
+          parser.error("-c cannot be used with -o")
+      try:
+         opts.template % 0
+      except (TypeError, ValueError):
+         parser.error("-o TEMPLATE must contain exactly one integer conversion, e.g. out.%04d")
    else:
-      infile  = myopen(args[0], 'rb') if len(args) >= 1 else sys.stdin
-      outfile = myopen(args[1], 'wb') if len(args) == 2 else sys.stdout
+      if len(args) > 2:
+          parser.error("too many arguments")
 
-   cpt = 0
-   for line in infile:
-      step = cpt % opts.modulo
-      # NOTE this is XOR
-      if (opts.complement) ^ (index <= step < jndex):
-         if (opts.numbered):
-            outfile.write(repr(cpt))
-            outfile.write('\t')
-         outfile.write(line)
-      cpt += 1
+   if (opts.contiguous or opts.build_index) and not opts.rebuild:
+      if len(args) == 0 or args[0] == "-" or args[0][-3:] == ".gz":
+         parser.error("-b and -x require a plain text infile")
+
+   if opts.threads < 1:
+      parser.error("-j requires at least one thread")
+
+   if opts.max_open is not None and opts.max_open < 2:
+      parser.error("--max-open requires at least 2 stripes")
+
+   partitioned = opts.field is not None or opts.regex is not None
+   if (opts.cost is not None or opts.manifest is not None or partitioned) and (opts.contiguous or opts.build_index):
+      parser.error("-w, -a, -k and -e cannot be used with -b or -x")
+   if opts.field is not None and opts.regex is not None:
+      parser.error("-k and -e cannot be used together")
+   if partitioned and opts.cost is not None:
+      parser.error("-k and -e cannot be used with -w")
+   if opts.rebuild and partitioned:
+      parser.error("-k and -e cannot be used with -r, use -r -a MANIFEST")
+   if opts.field is not None and opts.field < 1:
+      parser.error("-k FIELD counts from 1")
+   if opts.separator is not None and opts.field is None:
+      parser.error("-t requires -k")
+   if opts.separator == "":
+      parser.error("-t SEP cannot be empty")
+   if opts.lockstep and (opts.rebuild or opts.build_index):
+      parser.error("-l cannot be used with -r or -x")
+   if opts.fifos is not None and (opts.rebuild or opts.build_index):
+      parser.error("-f cannot be used with -r or -x")
+   if opts.rebuild and opts.cost is not None:
+      parser.error("-w cannot be used with -r, use -r -a MANIFEST")
+   if opts.rebuild and opts.manifest is not None and (opts.numbered or opts.indices is not None):
+      parser.error("-r -a MANIFEST merges all the stripes and cannot be used with -n or -i")
+
+   manifest = None
+   key = None
+   if partitioned:
+      import re
+      try:
+         key = partition_key(opts.field, opts.separator and opts.separator.encode(),
+                             opts.regex and opts.regex.encode())
+      except re.error as err:
+         parser.error("invalid -e REGEX: %s" % err)
+   assigning = opts.cost is not None or key is not None
+   if opts.manifest is not None and not assigning:
+      try:
+         manifest = Manifest(opts.manifest)
+      except IOError as err:
+         print("Cannot read the manifest: %s" % err, file=sys.stderr)
+         sys.exit(1)
+      if not opts.rebuild:
+         if opts.modulo is not None and opts.modulo != manifest.modulo:
+            parser.error("-m %d differs from the %d stripes of the manifest" % (opts.modulo, manifest.modulo))
+         opts.modulo = manifest.modulo
+   if opts.modulo is None:
+      opts.modulo = 3
+
+   if opts.indices is None:
+      opts.indices = "0:%d" % opts.modulo if opts.template is not None or opts.fifos is not None else "0"
+      if opts.rebuild:
+         # Rebuild from all the stripes, however many there are.
+         opts.indices = "0:-1"
+
+   # Check if the user provided a rane of indices or a single index.
+   all_indices = opts.indices.split(":")
+   index = int(all_indices[0])
+   jndex = index + 1
+   if len(all_indices) == 2:
+      jndex = int(all_indices[1])
+   elif len(all_indices) > 2:
+      print("Indices format is -i i:j where [i,j) where 0 <= i < j <= m.", file=sys.stderr)
+      sys.exit(1)
+   # validate the index range; when rebuilding, m is the number of stripes.
+   if not (0 <= index < jndex <= opts.modulo) and not opts.rebuild:
+      print("Indices format is -i i:j where [i,j) where 0 <= i < j <= m.", file=sys.stderr)
+      sys.exit(1)
+
+   if opts.debug:
+      print("index %d, jndex %d" % (index, jndex), file=sys.stderr)
+
+   if opts.verbose:
+      print("options are:", opts, file=sys.stderr)
+      print("positional args are:", args, file=sys.stderr)
+
+   verbose_flag, debug_flag = opts.verbose, opts.debug
+   compression_threads = opts.threads
+
+   stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
 
+   if opts.rebuild:
+      try:
+         inputfilenames = stripe_filenames(args)
+         if opts.contiguous:
+            concatenate(inputfilenames, stdout, opts.block_size)
+         else:
+            rebuild(inputfilenames, stdout, index, jndex, numbered=opts.numbered, strip=opts.strip,
+                    report_gaps=opts.report_gaps, block_size=opts.block_size, max_open=opts.max_open,
+                    manifest=manifest)
+      except ValueError as err:
+         print(err, file=sys.stderr)
+         sys.exit(1)
+      except IOError as err:
+         print("Error rebuilding the output: %s" % err, file=sys.stderr)
+         sys.exit(1)
+      return
+
+   try:
+      if opts.build_index:
+         LineIndex(args[0], opts.block_size)
+      elif opts.lockstep:
+         if assigning and opts.manifest is not None:
+            manifest = Manifest(opts.manifest, opts.modulo)
+         outfiles = []
+         for filename in args[1::2]:
+            outfiles.append(myopen(filename, 'wb'))
+         split_lockstep(args[0::2], outfiles, index, jndex, opts.modulo, opts.complement, opts.numbered,
+                        opts.block_size, opts.cost, manifest, key)
+         for outfile in outfiles:
+            outfile.close()
+         if manifest is not None:
+            manifest.close()
+      elif opts.contiguous:
+         if opts.template is not None:
+            outfiles = open_stripes(opts.template, index, jndex)
+         elif len(args) == 2:
+            outfiles = [myopen(args[1], 'wb')]
+         else:
+            outfiles = [stdout]
+         split_contiguous(args[0], outfiles, index, jndex, opts.modulo, opts.complement, opts.numbered, opts.block_size)
+         for outfile in outfiles:
+            outfile.close()
+      elif opts.fifos is not None:
+         infile = myopen(args[0], 'rb') if len(args) >= 1 else stdin
+         if assigning and opts.manifest is not None:
+            manifest = Manifest(opts.manifest, opts.modulo)
+         serve_stripes(infile, [opts.fifos % step for step in range(index, jndex)], index, opts.modulo,
+                       opts.numbered, opts.block_size, opts.cost, manifest, key)
+         infile.close()
+         if manifest is not None:
+            manifest.close()
+      else:
+         lineIndex = mapped_index(args, opts)
+         if lineIndex is not None:
+            if opts.template is not None:
+               outfiles = open_stripes(opts.template, index, jndex)
+            else:
+               outfiles = [myopen(args[1], 'wb') if len(args) == 2 else stdout]
+            split_mapped(args[0], outfiles, index, jndex, opts.modulo, opts.complement, opts.numbered,
+                         opts.block_size, lineIndex)
+            for outfile in outfiles:
+               outfile.close()
+         else:
+            # Performing a split
+            infile  = myopen(args[0], 'rb') if len(args) >= 1 else stdin
+            if assigning and opts.manifest is not None:
+               manifest = Manifest(opts.manifest, opts.modulo)
+            if opts.template is not None:
+               outfiles = open_stripes(opts.template, index, jndex)
+               split_stripes(infile, outfiles, index, opts.modulo, opts.numbered, opts.block_size,
+                             opts.cost, manifest, key)
+               for outfile in outfiles:
+                  outfile.close()
+            else:
+               outfile = myopen(args[1], 'wb') if len(args) == 2 else stdout
+               split(infile, outfile, index, jndex, opts.modulo, opts.complement, opts.numbered, opts.block_size,
+                     opts.cost, manifest, key)
+               outfile.close()
+            infile.close()
+            if manifest is not None:
+               manifest.close()
+   except (IOError, ValueError) as err:
+      print(err, file=sys.stderr)
+      sys.exit(1)
 
-   infile.close()
-   outfile.close()
 
+if __name__ == '__main__':
+   main()
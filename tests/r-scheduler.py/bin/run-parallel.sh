@@ -0,0 +1,11 @@
+#!/bin/bash
+# run-parallel.sh - Stand-in for run-parallel.sh, answering from the cluster simulated by
+#                   ../simulate.py in $R_SCHEDULER_SIM; see ../simulate.py -h.
+#
+# Traitement multilingue de textes / Multilingual Text Processing
+# Centre de recherche en technologies numeriques / Digital Technologies Research Centre
+# Conseil national de recherches Canada / National Research Council Canada
+# Copyright 2026, Sa Majeste le Roi du Chef du Canada /
+# Copyright 2026, His Majesty the King in Right of Canada
+
+exec "$(dirname "$0")/../simulate.py" -x run-parallel.sh "$@"
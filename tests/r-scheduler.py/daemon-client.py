@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# @file daemon-client.py
+# @brief Talk to a real r-parallel-d.pl with r-scheduler.py's DaemonClient.
+#
+# Traitement multilingue de textes / Multilingual Text Processing
+# Centre de recherche en technologies numeriques / Digital Technologies Research Centre
+# Conseil national de recherches Canada / National Research Council Canada
+# Copyright 2026, Sa Majeste le Roi du Chef du Canada /
+# Copyright 2026, His Majesty the King in Right of Canada
+
+import sys
+import os
+import time
+import asyncio
+import subprocess
+
+from simulate import HERE, load_scheduler
+
+
+def start_daemon(directory, tasks):
+   """
+   Start r-parallel-d.pl on tasks in directory, with one worker, and return
+   it once it listens, with its psub_cmd, which only notes the workers it
+   launches in directory/launched.
+   """
+   os.makedirs(directory)
+   with open(os.path.join(directory, "jobs"), "w") as f:
+      for i in range(tasks):
+         print("true", file=f)
+   with open(os.path.join(directory, "next_worker_id"), "w") as f:
+      print(1, file=f)
+   daemon = subprocess.Popen(["r-parallel-d.pl", "1", directory],
+                             stderr=open(os.path.join(directory, "log"), "w"))
+   port = os.path.join(directory, "port")
+   for _ in range(100):
+      if os.path.exists(port) and open(port).read().endswith("\n"):
+         break
+      time.sleep(0.1)
+   else:
+      daemon.kill()
+      sys.exit("r-parallel-d.pl did not start, see %s/log" % directory)
+   psub_cmd = os.path.join(directory, "psub_cmd")
+   with open(psub_cmd, "w") as f:
+      print("echo r-parallel-worker.pl -host=localhost -port=%s __WORKER__ID__ >> %s/launched"
+            % (open(port).read().strip(), directory), file=f)
+   return daemon, psub_cmd
+
+
+async def talk(rs, psub_cmd):
+   """Print what the daemon replies to each of the client's requests."""
+   client = rs.DaemonClient.from_psub_cmd(psub_cmd)
+   def show(what, status):
+      print(what, "w:%d q:%d a:%d jobs:%s started:%s done:%s" % (
+            status.workers, status.quenched, status.added, status.jobs, status.started, status.done))
+   show("STATUS", await client.status())
+   await client.add(2)
+   show("ADD 2", await client.status())
+   await client.quench(1)
+   show("QUENCH 1", await client.status())
+   await client.send("KILL")
+   try:
+      await client.status()
+   except IOError:
+      print("gone")
+
+
+def main():
+   directory = sys.argv[1]
+   rs = load_scheduler(os.path.join(HERE, "..", "..", "bin", "r-scheduler.py"))
+   daemon, psub_cmd = start_daemon(directory, 3)
+   try:
+      asyncio.run(talk(rs, psub_cmd))
+   finally:
+      try:
+         daemon.wait(10)
+      except subprocess.TimeoutExpired:
+         daemon.kill()
+   with open(os.path.join(directory, "launched")) as f:
+      print("launched", len(f.readlines()))
+
+
+if __name__ == '__main__':
+   main()
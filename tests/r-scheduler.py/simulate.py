@@ -0,0 +1,724 @@
+#!/usr/bin/env python3
+
+# @file simulate.py
+# @brief Discrete-event cluster simulator to benchmark r-scheduler.py offline.
+#
+# Traitement multilingue de textes / Multilingual Text Processing
+# Centre de recherche en technologies numeriques / Digital Technologies Research Centre
+# Conseil national de recherches Canada / National Research Council Canada
+# Copyright 2026, Sa Majeste le Roi du Chef du Canada /
+# Copyright 2026, His Majesty the King in Right of Canada
+
+from __future__ import print_function, division
+
+import sys
+import os
+import re
+import io
+import csv
+import json
+import math
+import time
+import heapq
+import fcntl
+import pickle
+import random
+import subprocess
+import importlib.util
+from contextlib import redirect_stderr
+from argparse import ArgumentParser, RawDescriptionHelpFormatter, REMAINDER
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Ids of the simulated jobs: FIRST_JOB_ID, FIRST_JOB_ID + 1, ...
+FIRST_JOB_ID = 1000
+
+# Like Torque's keep_completed, qstat still lists a finished job, as C, for
+# this many simulated seconds.
+KEEP_COMPLETED = 600
+
+
+def get_args():
+   """Command line argument processing."""
+
+   usage = "simulate.py [options] [-- r-scheduler.py options]"
+   help = """
+   Simulate a cluster running run-parallel.sh jobs next to a competing load,
+   and report how well r-scheduler.py sizes the jobs: the cluster's
+   utilization, each job's makespan, and the churn of workers added and
+   quenched.  Options after -- are those of r-scheduler.py, e.g. -p, -f, -m,
+   -b, --factor-add; -b and -t are in simulated time.
+
+   The model: a cluster of -c CPUs, whose competing load asks for a varying
+   number of CPUs, synthetic (-load, -swing, -period) or replayed from the -o
+   metrics file of a recorded r-scheduler.py run (-r); run-parallel.sh jobs
+   of -j TASKS:DURATION:WORKERS, whose tasks take DURATION seconds on
+   average; workers that wait in the queue for a free CPU, take -startup
+   seconds to start, and then run tasks until the job has none left or they
+   are quenched, like r-parallel-d.pl's workers.
+
+   By default, r-scheduler.py's policies are driven directly in simulated
+   time, as fast as the machine allows.  With -l DIR, the model is instead
+   saved to DIR and advances with the wall clock, -speed times faster, to
+   serve the stand-in analyze, qstat, pbsnodes, sinfo, squeue and
+   run-parallel.sh of ./bin to a real r-scheduler.py daemon; -R DIR then
+   reports on it.  E.g.:
+
+      ./simulate.py -l sim -speed 100 -j 500:60:4
+      R_SCHEDULER_SIM=sim PATH=$PWD/bin:$PATH \\
+         r-scheduler.py -b 0.01 -t 0.2 -e 0.1 -L 0.6 'sim/run-p.*/psub_cmd'
+      ./simulate.py -R sim
+   """
+
+   parser = ArgumentParser(usage=usage, description=help,
+                           formatter_class=RawDescriptionHelpFormatter, add_help=False)
+   parser.add_argument("-h", "--help", action="help",
+                       help="print this help message and exit")
+   parser.add_argument("-c", "--cpus", type=int, default=320,
+                       help="CPUs of the cluster, ignored with -r [%(default)s]")
+   parser.add_argument("-j", "--job", dest="jobs", action="append", default=[],
+                       help="a job of TASKS[:DURATION[:WORKERS]], repeatable [1000:120:4]")
+   parser.add_argument("-spread", type=float, default=0.5,
+                       help="log-normal sigma of the task durations [%(default)s]")
+   parser.add_argument("-startup", type=float, default=60,
+                       help="seconds a worker takes to start once it has a CPU [%(default)s]")
+   parser.add_argument("-load", type=float, default=0.7,
+                       help="mean fraction of the CPUs the competing load asks for [%(default)s]")
+   parser.add_argument("-swing", type=float, default=0.3,
+                       help="amplitude of the competing load's daily swing [%(default)s]")
+   parser.add_argument("-period", type=float, default=86400,
+                       help="period of the competing load's swing, in seconds [%(default)s]")
+   parser.add_argument("-step", type=float, default=300,
+                       help="seconds between changes of the competing load [%(default)s]")
+   parser.add_argument("-r", "--replay", default=None,
+                       help="replay the competing load, and the jobs if no -j, from the CSV or JSON "
+                       "lines metrics of r-scheduler.py -o")
+   parser.add_argument("-horizon", type=float, default=30 * 86400,
+                       help="give up after this many simulated seconds [%(default)s]")
+   parser.add_argument("-s", "--seed", type=int, default=1,
+                       help="random seed [%(default)s]")
+   parser.add_argument("--scheduler", default=os.path.join(HERE, "..", "..", "bin", "r-scheduler.py"),
+                       help="r-scheduler.py to benchmark [this repo's]")
+   parser.add_argument("--json", action="store_true", default=False,
+                       help="report as one JSON object")
+   parser.add_argument("-l", "--live", metavar="DIR", default=None,
+                       help="save the model to DIR for the stand-in commands instead of simulating")
+   parser.add_argument("-speed", type=float, default=60,
+                       help="simulated seconds per wall clock second, with -l [%(default)s]")
+   parser.add_argument("-nodes", metavar="FILE", default=None,
+                       help="with -l, what the stand-in pbsnodes -a prints, e.g. a fixture; the model "
+                       "has no nodes of its own [none]")
+   parser.add_argument("-local", action="store_true", default=False,
+                       help="with -l, start a stand-in run-parallel.sh master process per job, whose pid "
+                       "is the job's id and that lives until the job is done, for r-scheduler.py -k local")
+   parser.add_argument("-R", "--report", metavar="DIR", default=None,
+                       help="report on the model saved to DIR by -l")
+   parser.add_argument("-x", "--command", dest="command", nargs=REMAINDER, default=None,
+                       help="run stand-in command COMMAND [ARGS] on the model in $R_SCHEDULER_SIM")
+
+   args, scheduler_args = parser.parse_known_args()
+   if scheduler_args[:1] == ["--"]:
+      scheduler_args = scheduler_args[1:]
+   args.scheduler_args = scheduler_args
+   jobs = []
+   for job in args.jobs:
+      fields = job.split(":")
+      try:
+         jobs.append((int(fields[0]),
+                      float(fields[1]) if len(fields) > 1 else 120.0,
+                      int(fields[2]) if len(fields) > 2 else 4))
+      except ValueError:
+         parser.error("expected TASKS[:DURATION[:WORKERS]] for -j, got: %s" % job)
+      if len(fields) > 3 or jobs[-1][0] < 1 or jobs[-1][1] <= 0 or jobs[-1][2] < 1:
+         parser.error("expected TASKS[:DURATION[:WORKERS]] for -j, got: %s" % job)
+   args.jobs = jobs
+   return args
+
+
+def read_metrics(filename):
+   """
+   Read the metrics of r-scheduler.py -o, returning the records of each
+   tick, in time order, as [(time, [record])].
+   """
+   with open(filename) as f:
+      if filename.endswith(".csv"):
+         records = list(csv.DictReader(f))
+      else:
+         records = [json.loads(line) for line in f if line.strip()]
+   number = lambda value: None if value in (None, "") else float(value)
+   ticks = {}
+   for record in records:
+      record = dict((k, v if k in ("job", "policy") else number(v)) for k, v in record.items())
+      ticks.setdefault(record["time"], []).append(record)
+   return sorted(ticks.items())
+
+
+class Load:
+   """
+   The CPUs the competing load asks for over time, as [(time, CPUs)], with
+   the cluster's size.
+   """
+   def __init__(self, cpus, steps):
+      self.cpus = cpus
+      self.steps = steps
+
+   @staticmethod
+   def synthetic(args, rng):
+      """A load swinging around -load over -period, changing every -step."""
+      steps = []
+      t = 0.0
+      while t < args.horizon:
+         fraction = args.load + args.swing * math.sin(2 * math.pi * t / args.period) + rng.gauss(0, 0.02)
+         steps.append((t, int(round(args.cpus * min(1.0, max(0.0, fraction))))))
+         t += args.step
+      return Load(args.cpus, steps)
+
+   @staticmethod
+   def replayed(ticks):
+      """
+      The load recorded by r-scheduler.py: the busy CPUs not used by the jobs
+      it monitored, plus the jobs pending.
+      """
+      start = ticks[0][0]
+      steps = []
+      for when, records in ticks:
+         first = records[0]
+         busy = first["total_cpus"] - first["free_cpus"] - sum(r["workers"] or 0 for r in records)
+         steps.append((when - start, int(max(0, busy) + (first["pending"] or 0))))
+      return Load(int(ticks[-1][1][0]["total_cpus"]), steps)
+
+
+class Worker:
+   def __init__(self, job, number, primary=False):
+      self.job = job
+      self.number = number
+      self.primary = primary
+      self.state = "queued"  # then "starting", "running" or "gone"
+
+
+class Job:
+   """A run-parallel.sh job and its daemon's counters, as r-parallel-d.pl keeps them."""
+   def __init__(self, jobID, durations, workers):
+      self.jobID = jobID
+      self.durations = durations
+      self.initial = workers
+      self.started = 0
+      self.done = 0
+      self.num_workers = 0
+      self.add_count = 0
+      self.quench_count = 0
+      self.workers = 0  # numbered from 0, the primary
+      self.live = set()  # workers not gone yet
+      self.finished = None
+      self.task_seconds = 0.0
+      self.adds = self.quenches = 0
+      self.added = self.quenched = 0
+
+
+class Model:
+   """
+   The discrete-event model of the cluster: advance() processes its events up
+   to a given time, while the requests of r-scheduler.py or of the stand-in
+   commands query and change it in between.
+   """
+   def __init__(self, load, jobs, startup, seed):
+      self.load = load
+      self.jobs = jobs
+      self.startup = startup
+      self.rng = random.Random(seed)
+      self.now = 0.0
+      self.events = []
+      self.sequence = 0
+      self.queue = []  # workers waiting for a CPU, in order
+      self.holding = 0  # CPUs held by the workers, starting or running
+      self.demand = 0   # CPUs asked for by the competing load
+      # Statistics, integrated over time by account().
+      self.cpu_seconds = 0.0
+      self.worker_seconds = 0.0
+      self.ticks = 0
+      for when, cpus in load.steps:
+         self.schedule(when, "load", cpus)
+      for job in jobs:
+         for _ in range(job.initial):
+            self.launch(job)
+
+   def schedule(self, when, kind, data):
+      self.sequence += 1
+      heapq.heappush(self.events, (when, self.sequence, kind, data))
+
+   def background(self):
+      """(busy, pending) CPUs of the competing load."""
+      busy = min(self.demand, self.load.cpus - self.holding)
+      return busy, self.demand - busy
+
+   def account(self, until):
+      """Integrate the statistics from now until until."""
+      dt = until - self.now
+      if dt > 0:
+         self.cpu_seconds += (self.background()[0] + self.holding) * dt
+         self.worker_seconds += self.holding * dt
+         self.now = until
+
+   def finished(self):
+      return all(job.finished is not None for job in self.jobs)
+
+   def advance(self, until, stop_on_finish=False):
+      """
+      Process the events up to until, or only up to the next job finishing
+      with stop_on_finish; return whether a job finished.
+      """
+      while self.events and self.events[0][0] <= until:
+         when, _, kind, data = heapq.heappop(self.events)
+         self.account(when)
+         finishing = [job for job in self.jobs if job.finished is None]
+         getattr(self, "on_" + kind)(data)
+         if stop_on_finish and any(job.finished is not None for job in finishing):
+            return True
+      self.account(until)
+      return False
+
+
+   # Events: the competing load changing, a worker ready to work once
+   # started, and a worker done with its task.
+
+   def on_load(self, cpus):
+      self.demand = cpus
+      self.dispatch()
+
+   def on_ready(self, worker):
+      if worker.state == "gone":
+         return
+      worker.state = "running"
+      self.get(worker)
+
+   def on_done(self, task):
+      worker, duration = task
+      if worker.state == "gone":
+         return
+      job = worker.job
+      self.connection(job)
+      job.done += 1
+      job.task_seconds += duration
+      if job.done >= len(job.durations):
+         self.finish(job)
+      else:
+         self.get(worker)
+
+   # What r-parallel-d.pl does for its workers.
+
+   def connection(self, job):
+      """Each connection to the daemon launches one more worker of an ADD in progress."""
+      if job.add_count > 0:
+         job.add_count -= 1
+         self.launch(job)
+
+   def get(self, worker):
+      """The worker asks for a task, and may be told to stop instead."""
+      job = worker.job
+      self.connection(job)
+      if not worker.primary and job.quench_count > 0:
+         job.quench_count -= 1
+         self.leave(worker)
+      elif job.started < len(job.durations):
+         duration = job.durations[job.started]
+         job.started += 1
+         self.schedule(self.now + duration, "done", (worker, duration))
+      else:
+         self.leave(worker)
+
+   def launch(self, job):
+      """Submit one more worker for job."""
+      worker = Worker(job, job.workers, primary=job.workers == 0)
+      job.workers += 1
+      job.num_workers += 1
+      job.live.add(worker)
+      self.queue.append(worker)
+      self.dispatch()
+
+   def leave(self, worker):
+      """The worker exits, freeing its CPU."""
+      worker.job.num_workers -= 1
+      worker.job.live.discard(worker)
+      if worker.state in ("starting", "running"):
+         self.holding -= 1
+      worker.state = "gone"
+      self.dispatch()
+
+   def dispatch(self):
+      """Start the workers queued, as long as the competing load leaves CPUs free."""
+      while self.queue and self.holding + self.demand < self.load.cpus:
+         worker = self.queue.pop(0)
+         if worker.state == "queued":
+            worker.state = "starting"
+            self.holding += 1
+            self.schedule(self.now + self.startup, "ready", worker)
+
+   def finish(self, job):
+      """All of job's tasks are done: run-parallel.sh kills its remaining workers."""
+      job.finished = self.now
+      for worker in list(job.live):
+         self.leave(worker)
+      self.queue = [worker for worker in self.queue if worker.state == "queued"]
+
+   # What r-scheduler.py asks for.
+
+   def status(self, job):
+      """(W, Q, A, tasks, started, done), as r-parallel-d.pl's STATUS gives them."""
+      self.connection(job)
+      return job.num_workers, job.quench_count, job.add_count, len(job.durations), job.started, job.done
+
+   def add(self, job, n):
+      """ADD n, followed by run-parallel.sh add's PING."""
+      job.adds += 1
+      job.added += n
+      job.add_count += n
+      self.connection(job)
+      self.connection(job)
+
+   def quench(self, job, n):
+      job.quenches += 1
+      job.quenched += n
+      job.quench_count += n
+
+   def snapshot(self):
+      """(total, free, pending) CPUs, as analyze gives them."""
+      busy, pending = self.background()
+      return self.load.cpus, self.load.cpus - busy - self.holding, pending + len(self.queue)
+
+
+def make_model(args):
+   """The Model of args' cluster, load and jobs."""
+   rng = random.Random(args.seed)
+   specs = [(FIRST_JOB_ID + i, tasks, duration, workers) for i, (tasks, duration, workers) in enumerate(args.jobs)]
+   if args.replay:
+      ticks = read_metrics(args.replay)
+      if not ticks:
+         raise ValueError("No metrics in %s" % args.replay)
+      load = Load.replayed(ticks)
+      if not specs:
+         specs = replayed_jobs(ticks)
+   else:
+      load = Load.synthetic(args, rng)
+   if not specs:
+      specs = [(FIRST_JOB_ID, 1000, 120.0, 4)]
+   jobs = []
+   for jobID, tasks, duration, workers in specs:
+      # Log-normal durations whose mean is duration.
+      mu = math.log(duration) - args.spread ** 2 / 2
+      jobs.append(Job(jobID, [rng.lognormvariate(mu, args.spread) for _ in range(tasks)], workers))
+   return Model(load, jobs, args.startup, args.seed)
+
+
+def replayed_jobs(ticks):
+   """
+   The jobs recorded by r-scheduler.py, as [(jobID, tasks, duration,
+   workers)]: their tasks, initial workers, and mean task duration from the
+   tasks they completed per worker-second.
+   """
+   history = {}
+   for when, records in ticks:
+      for record in records:
+         if record["tasks"] is not None:
+            history.setdefault(record["job"], []).append((when, record))
+   specs = []
+   for i, (job, records) in enumerate(sorted(history.items())):
+      done = worker_seconds = 0.0
+      for (t0, r0), (t1, r1) in zip(records, records[1:]):
+         done += r1["done"] - r0["done"]
+         worker_seconds += r0["workers"] * (t1 - t0)
+      duration = worker_seconds / done if done > 0 and worker_seconds > 0 else 120.0
+      jobID = int(job) if job.isdigit() else FIRST_JOB_ID + i
+      specs.append((jobID, int(records[0][1]["tasks"]), duration, max(1, int(records[0][1]["workers"]))))
+   return specs
+
+
+def report(model, as_json=False):
+   """Print what the simulation shows about the scheduling."""
+   end = max(job.finished if job.finished is not None else model.now for job in model.jobs)
+   results = {
+      "makespan": round(end, 1),
+      "utilization": round(model.cpu_seconds / (model.load.cpus * end), 4) if end > 0 else None,
+      "efficiency": round(sum(job.task_seconds for job in model.jobs) / model.worker_seconds, 4)
+                    if model.worker_seconds > 0 else None,
+      "ticks": model.ticks,
+      "adds": sum(job.adds for job in model.jobs),
+      "added": sum(job.added for job in model.jobs),
+      "quenches": sum(job.quenches for job in model.jobs),
+      "quenched": sum(job.quenched for job in model.jobs),
+      "jobs": [{
+         "job": job.jobID,
+         "tasks": len(job.durations),
+         "done": job.done,
+         "makespan": None if job.finished is None else round(job.finished, 1),
+         "workers": job.workers,
+         "adds": job.adds,
+         "added": job.added,
+         "quenches": job.quenches,
+         "quenched": job.quenched,
+      } for job in model.jobs],
+   }
+   if as_json:
+      print(json.dumps(results, sort_keys=True))
+      return
+   print("makespan     %10.1f s" % results["makespan"])
+   for key in "utilization", "efficiency":
+      print("%-12s %10s" % (key, "-" if results[key] is None else "%.4f" % results[key]))
+   print("ticks        %10d" % results["ticks"])
+   print("churn        %10d adds of %d workers, %d quenches of %d workers"
+         % (results["adds"], results["added"], results["quenches"], results["quenched"]))
+   for job in results["jobs"]:
+      print("job %d: %d/%d tasks done in %s s, %d workers, %d added, %d quenched"
+            % (job["job"], job["done"], job["tasks"], "-" if job["makespan"] is None else job["makespan"],
+               job["workers"], job["added"], job["quenched"]))
+
+
+def load_scheduler(path):
+   """Import r-scheduler.py from path."""
+   spec = importlib.util.spec_from_file_location("r_scheduler", path)
+   module = importlib.util.module_from_spec(spec)
+   spec.loader.exec_module(module)
+   return module
+
+
+def scheduler_options(rs, argv):
+   """Parse r-scheduler.py's options in argv, quietly unless they are wrong."""
+   saved, sys.argv = sys.argv, ["r-scheduler.py"] + argv + ["simulated"]
+   log = io.StringIO()
+   try:
+      with redirect_stderr(log):
+         return rs.get_args()
+   except SystemExit:
+      sys.stderr.write(log.getvalue())
+      raise
+   finally:
+      sys.argv = saved
+
+
+class Clock:
+   """Stands for the time module in r-scheduler.py, telling simulated time."""
+   def __init__(self, model):
+      self.model = model
+
+   def time(self):
+      return self.model.now
+
+
+def simulate(model, rs, cmd_args, horizon):
+   """
+   Run the model, ticking r-scheduler.py's policy every -b minutes, or -t
+   seconds after a job finishes, until all jobs are done or the horizon.
+   """
+   if cmd_args.add or cmd_args.quench:
+      print("Warning: cron jobs (-a, -q) are not simulated", file=sys.stderr)
+   rs.time = Clock(model)
+   policy = rs.POLICIES[cmd_args.policy](cmd_args)
+   metrics = rs.Metrics(cmd_args)
+   weights = rs.JobSet([], cmd_args.weights)
+
+   class SimulatedJob(rs.Job):
+      def __init__(self, job):
+         rs.Job.__init__(self, str(job.jobID), None, weights.weight(str(job.jobID), None))
+         self.job = job
+
+      def progress(self):
+         return len(self.job.durations), self.job.done
+
+   jobs = [SimulatedJob(job) for job in model.jobs]
+   interval = 60 * cmd_args.burst_interval
+   try:
+      while not model.finished() and model.now < horizon:
+         tick(model, rs, policy, metrics, jobs, cmd_args)
+         last = model.now
+         if model.advance(min(horizon, last + interval), stop_on_finish=True):
+            # The daemon wakes up when a job finishes, once its -t TTL allows.
+            model.advance(min(horizon, max(model.now, last + cmd_args.ttl)))
+   finally:
+      metrics.close()
+
+
+def tick(model, rs, policy, metrics, jobs, cmd_args):
+   """What one tick of r-scheduler.py's loop does, on the model."""
+   model.ticks += 1
+   start = model.now
+   total, free, pending = model.snapshot()
+   jobs = [job for job in jobs if job.job.finished is None]
+   snapshot = rs.Snapshot(total, free, pending, set(job.jobID for job in jobs), when=model.now)
+   snapshot.latency = 0.0
+   workers = {}
+   for job in jobs:
+      job.status = rs.JobStatus(*model.status(job.job), when=model.now)
+      job.status.latency = 0.0
+      workers[job.jobID] = job.status.resources()
+   deltas = policy.decide(jobs, snapshot, workers)
+   if not cmd_args.notReally:
+      for job in jobs:
+         x = deltas.get(job.jobID, 0)
+         if x > 0:
+            model.add(job.job, x)
+         elif x < 0:
+            model.quench(job.job, -x)
+   metrics.record(start, snapshot, jobs, deltas, {})
+
+
+# Live mode: the model is kept in DIR/model.pickle, advanced to the simulated
+# present by each stand-in command.
+
+def save(directory, state):
+   with open(os.path.join(directory, "model.pickle.tmp"), "wb") as f:
+      pickle.dump(state, f)
+   os.rename(os.path.join(directory, "model.pickle.tmp"), os.path.join(directory, "model.pickle"))
+
+
+def load(directory):
+   with open(os.path.join(directory, "model.pickle"), "rb") as f:
+      return pickle.load(f)
+
+
+def job_directory(directory, job):
+   return os.path.join(directory, "run-p.%d.sim" % job.jobID)
+
+
+def setup_live(model, directory, speed, nodes=None, local=False):
+   """
+   Save model to directory, with a run-p directory per job, starting now,
+   and what pbsnodes -a prints from the file nodes.  With local, each job is
+   named after the pid of its stand-in master.
+   """
+   os.makedirs(directory)
+   if local:
+      env = dict(os.environ, R_SCHEDULER_SIM=directory)
+      for job in model.jobs:
+         master = subprocess.Popen([sys.executable, os.path.abspath(__file__), "-x", "master"],
+                                   env=env, stdin=subprocess.DEVNULL, start_new_session=True)
+         job.jobID = master.pid
+   for job in model.jobs:
+      os.mkdir(job_directory(directory, job))
+      with open(os.path.join(job_directory(directory, job), "psub_cmd"), "w") as f:
+         print("psub -N run-p.%d r-parallel-worker.pl -period 60" % job.jobID, file=f)
+      with open(os.path.join(job_directory(directory, job), "jobs"), "w") as f:
+         for duration in job.durations:
+            print("sleep %d" % round(duration), file=f)
+   if nodes is not None:
+      with open(nodes) as f:
+         nodes = f.read()
+   save(directory, {"model": model, "start": time.time(), "speed": speed, "nodes": nodes})
+
+
+def stand_in(command, argv):
+   """
+   Run stand-in command with its arguments argv on the model in
+   $R_SCHEDULER_SIM, printing what the real command would.  The stand-in
+   master of -local instead waits until the job named after its pid is done.
+   """
+   directory = os.environ.get("R_SCHEDULER_SIM")
+   if not directory:
+      print("%s: R_SCHEDULER_SIM is not set" % command, file=sys.stderr)
+      sys.exit(1)
+   if command == "master":
+      while not os.path.exists(os.path.join(directory, "model.pickle")) or \
+            serve(directory, "master", [str(os.getpid())]) != 0:
+         time.sleep(0.1)
+      sys.exit(0)
+   sys.exit(serve(directory, command, argv))
+
+
+def serve(directory, command, argv):
+   """Run stand-in command on the model saved to directory, returning its exit status."""
+   with open(os.path.join(directory, "model.lock"), "w") as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      state = load(directory)
+      model = state["model"]
+      model.advance((time.time() - state["start"]) * state["speed"])
+      rc = run_stand_in(model, command, argv, state["nodes"])
+      for job in model.jobs:
+         with open(os.path.join(job_directory(directory, job), "rc"), "w") as f:
+            f.write("0\n" * job.done)
+      save(directory, state)
+   return rc
+
+
+def run_stand_in(model, command, argv, nodes=None):
+   if command == "analyze":
+      model.ticks += 1
+      total, free, pending = model.snapshot()
+      print("||| %d jobs pending" % pending)
+      print("||| %d CPUs: 0 down or offline, %d busy, %d free" % (total, total - free, free))
+      return 0
+   if command == "qstat":
+      print("Job id         Name          User  Time Use S Queue")
+      print("-------------  ------------  ----  -------- - -----")
+      for job in model.jobs:
+         if job.finished is None:
+            print("%d.sim  run-p.%d  sim  00:00:00 R batch" % (job.jobID, job.jobID))
+         elif model.now - job.finished < KEEP_COMPLETED:
+            print("%d.sim  run-p.%d  sim  00:00:00 C batch" % (job.jobID, job.jobID))
+      return 0
+   if command == "sinfo" and argv == ["-h", "-o", "%C"]:
+      model.ticks += 1
+      total, free, pending = model.snapshot()
+      # allocated/idle/other/total
+      print("%d/%d/0/%d" % (total - free, free, total))
+      return 0
+   if command == "squeue" and argv == ["-h", "-o", "%i %t %C"]:
+      for job in model.jobs:
+         if job.finished is None:
+            print("%d R 1" % job.jobID)
+      # The background load's pending CPUs, as one pending job.
+      pending = model.snapshot()[2]
+      if pending:
+         print("%d PD %d" % (FIRST_JOB_ID - 1, pending))
+      return 0
+   if command == "pbsnodes" and argv == ["-a"] and nodes is not None:
+      # The nodes are as given, whatever the model's load.
+      sys.stdout.write(nodes)
+      return 0
+   if command == "master" and len(argv) == 1:
+      return 1 if any(job.jobID == int(argv[0]) and job.finished is None for job in model.jobs) else 0
+   if command == "run-parallel.sh" and argv:
+      m = re.search(r"(?:run-p\.)?(\d+)", argv[-1])
+      jobs = [job for job in model.jobs if m and job.jobID == int(m.group(1))]
+      if not jobs:
+         print("run-parallel.sh: no such job: %s" % argv[-1], file=sys.stderr)
+         return 1
+      job = jobs[0]
+      if argv[0] == "num_worker" and len(argv) == 2:
+         # A finished job's daemon is gone: no response to the request.
+         if job.finished is not None:
+            print("run-parallel.sh fatal error: Daemon error (response=), num_worker request failed.",
+                  file=sys.stderr)
+            return 1
+         print("w:%d q:%d a:%d" % model.status(job)[:3])
+         return 0
+      if argv[0] in ("add", "quench") and len(argv) == 3 and argv[1].isdigit() and int(argv[1]) > 0:
+         if job.finished is not None:
+            print("Daemon does not appear to be running", file=sys.stderr)
+            return 1
+         getattr(model, argv[0])(job, int(argv[1]))
+         return 0
+   print("Unsupported stand-in command: %s" % " ".join([command] + argv), file=sys.stderr)
+   return 1
+
+
+def main():
+   args = get_args()
+   if args.command:
+      stand_in(args.command[0], args.command[1:])
+   if args.report:
+      report(load(args.report)["model"], args.json)
+      return
+   try:
+      model = make_model(args)
+   except (IOError, ValueError, KeyError) as err:
+      print("Error: can't replay %s: %s" % (args.replay, err), file=sys.stderr)
+      sys.exit(1)
+   if args.live:
+      setup_live(model, args.live, args.speed, args.nodes, args.local)
+      return
+   rs = load_scheduler(args.scheduler)
+   simulate(model, rs, scheduler_options(rs, args.scheduler_args), args.horizon)
+   report(model, args.json)
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# @file units.py
+# @brief Unit tests of r-scheduler.py's classes, printing what they return.
+#
+# Traitement multilingue de textes / Multilingual Text Processing
+# Centre de recherche en technologies numeriques / Digital Technologies Research Centre
+# Conseil national de recherches Canada / National Research Council Canada
+# Copyright 2026, Sa Majeste le Roi du Chef du Canada /
+# Copyright 2026, His Majesty the King in Right of Canada
+
+import sys
+import os
+import argparse
+
+from simulate import HERE, load_scheduler
+
+
+def test_progress(rs, directory):
+   """Job.progress() as tasks get done, reading rc a bit at a time."""
+   os.makedirs(directory)
+   def append(filename, text):
+      with open(os.path.join(directory, filename), "a") as f:
+         f.write(text)
+   append("jobs", "true\n" * 4)
+   append("psub_cmd", "")
+   job = rs.Job("1", os.path.join(directory, "psub_cmd"))
+   print("no rc", job.progress())
+   append("rc", "0\n0\n")
+   print("2 done", job.progress(), job.tasks_left())
+   append("rc", "0")
+   print("half a line", job.progress())
+   append("rc", "\n1\n")
+   print("all done", job.progress(), job.tasks_left())
+   print("bytes read", sorted((os.path.basename(f), o) for f, (o, c) in job.lines.items()))
+
+
+def test_useful(rs):
+   """
+   ThroughputPolicy.useful() on a job with 100 tasks of 10s left and 10
+   workers, with new workers starting in 25s.  Alone, the 10 workers take 10
+   rounds, 100s.  No job can end before 35s, when new workers complete their
+   first task; by then the 10 workers did 3 rounds, 30 tasks, so 70 new
+   workers are needed for the other 70.  With 20 new workers, the best is 4
+   rounds for the 10 workers, 40 tasks, and 3 rounds, 55s, for the 20.
+   """
+   policy = rs.ThroughputPolicy(argparse.Namespace(startup=25))
+   print("makespan 0 more", rs.makespan(100, 10, 0, 10.0, 25))
+   print("makespan 20 more", rs.makespan(100, 10, 20, 10.0, 25))
+   print("makespan 69 more", rs.makespan(100, 10, 69, 10.0, 25))
+   print("makespan 70 more", rs.makespan(100, 10, 70, 10.0, 25))
+   print("useful 100 left", policy.useful(100, 10, 0.1))
+   # 2 rounds, 20s, is sooner than a new worker's first task: keep the 8
+   # workers that take 2 rounds for 15 tasks.
+   print("useful 15 left", policy.useful(15, 10, 0.1))
+   print("useful unknown rate", policy.useful(15, 10, None))
+
+
+def main():
+   directory = sys.argv[1]
+   rs = load_scheduler(os.path.join(HERE, "..", "..", "bin", "r-scheduler.py"))
+   test_progress(rs, os.path.join(directory, "progress"))
+   test_useful(rs)
+
+
+if __name__ == '__main__':
+   main()
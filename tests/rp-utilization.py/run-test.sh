@@ -0,0 +1,3 @@
+#!/bin/bash
+make clean
+make all -j 2
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# @file benchmark.py
+# @brief Measure the throughput of stripe.py against cat, zcat and split.
+#
+# Traitement multilingue de textes / Multilingual Text Processing
+# Centre de recherche en technologies numeriques / Digital Technologies Research Centre
+# Conseil national de recherches Canada / National Research Council Canada
+# Copyright 2026, Sa Majeste le Roi du Chef du Canada /
+# Copyright 2026, His Majesty the King in Right of Canada
+
+import sys
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+
+# Line lengths of the synthetic corpora: (min, max) bytes, log-uniform.
+PROFILES = {
+   "short": (1, 40),
+   "mixed": (1, 2000),
+   "long": (200, 4000),
+}
+
+# The commands timed, as (name, baseline or None, command template).  Templates
+# are formatted with: stripe, the stripe.py command; input, the corpus; i, m;
+# cat, cat or zcat depending on the format; stripes, the stripe files.
+SPLIT_CASES = [
+   ("read", None, "{cat} {input}"),
+   ("split", "split -n r/", "{stripe} -i {i} -m {m} {input}"),
+   ("split -c", None, "{stripe} -c -i {i} -m {m} {input}"),
+   ("split -n", None, "{stripe} -n -i {i} -m {m} {input}"),
+   ("split -o", "split -n r", "{stripe} -m {m} -o {workdir}/out.%d{ext} {input}"),
+   ("rebuild", "paste -d \\n", "{stripe} -r {stripes}"),
+   ("rebuild -n", None, "{stripe} -r -n -s {numbered}"),
+]
+
+# Baselines, formatted like the templates above.  paste -d \n only gives the
+# same output as stripe.py -r when the stripes are all the same length.
+BASELINES = {
+   "split -n r/": "{cat} {input} | split -n r/{k}/{m}",
+   "split -n r": "{cat} {input} | split -n r/{m} - {workdir}/split.",
+   "paste -d \\n": "paste -d '\\n' {plain_stripes}",
+}
+
+
+def get_args():
+   """Command line argument processing."""
+
+   usage = "benchmark.py [options]"
+   help = """
+   Generate synthetic corpora and report the throughput, in MB/s of
+   uncompressed text and in lines/s, of stripe.py splitting and rebuilding
+   them, next to baselines doing comparable work: cat or zcat reading the
+   input, GNU split -n r/ doing round-robin splits, and paste merging the
+   stripes.  Each command runs to /dev/null, or to files in a temporary
+   directory, and its best time over several runs is reported.  The stripes
+   of each corpus are first rebuilt, plainly and from their numbered lines,
+   and compared to the corpus, stopping the benchmark on any difference.
+
+   The mapped format is the plain corpus with the line-offset index of
+   stripe.py -x, which splits it from a memory map.
+
+   paste only rebuilds the input from stripes of equal lengths, padding the
+   shorter ones with empty lines otherwise, so it is only timed for the
+   numbers of stripes that divide the number of lines: the corpora have a
+   multiple of 1024 lines, so the powers of 2 up to 1024 always qualify.
+
+   Runs offline on a single machine, e.g. "make bench" before committing
+   changes to stripe.py.
+   """
+
+   parser = ArgumentParser(usage=usage, description=help,
+                           formatter_class=RawDescriptionHelpFormatter, add_help=False)
+   parser.add_argument("-h", "--help", action="help",
+                       help="print this help message and exit")
+   parser.add_argument("-s", "--sizes", default="16,128",
+                       help="corpus sizes in MB, comma separated [%(default)s]")
+   parser.add_argument("-l", "--lengths", default="short,mixed,long",
+                       help="line length profiles among %s [%%(default)s]" % ",".join(sorted(PROFILES)))
+   parser.add_argument("-m", "--modulos", default="4,64",
+                       help="numbers of stripes, comma separated [%(default)s]")
+   parser.add_argument("-f", "--formats", default="plain,gz,mapped",
+                       help="corpus formats among plain,gz,mapped [%(default)s]")
+   parser.add_argument("-r", "--repeat", type=int, default=3,
+                       help="runs of each command, the best one being reported [%(default)s]")
+   parser.add_argument("-t", "--tmpdir", default=None,
+                       help="where to create the corpora [$TMPDIR or /tmp]")
+   parser.add_argument("--stripe", default=None,
+                       help="stripe.py to benchmark [stripe.py from this repo's bin/]")
+   parser.add_argument("--no-baselines", dest="baselines", action="store_false", default=True,
+                       help="only time stripe.py")
+
+   args = parser.parse_args()
+   args.sizes = [int(size) for size in args.sizes.split(",")]
+   args.lengths = args.lengths.split(",")
+   args.modulos = [int(m) for m in args.modulos.split(",")]
+   args.formats = args.formats.split(",")
+   for length in args.lengths:
+      if length not in PROFILES:
+         parser.error("unknown line length profile: %s" % length)
+   for fmt in args.formats:
+      if fmt not in ("plain", "gz", "mapped"):
+         parser.error("unknown format: %s" % fmt)
+   if args.stripe is None:
+      here = os.path.dirname(os.path.abspath(__file__))
+      args.stripe = os.path.join(here, "..", "..", "bin", "stripe.py")
+   args.stripe = "python3 " + os.path.abspath(args.stripe)
+   return args
+
+
+def make_corpus(filename, size, profile, seed=1):
+   """
+   Write about size bytes of random lines, whose lengths are log-uniform
+   within profile, to filename; return the number of lines written.
+   """
+   rng = random.Random(seed)
+   shortest, longest = PROFILES[profile]
+   letters = b"abcdefghijklmnopqrstuvwxyz      "
+   text = bytes(rng.choice(letters) for _ in range(1<<16)) * 2
+   # A pool of distinct lines, sampled over and over, keeps generation fast.
+   pool = []
+   for _ in range(4096):
+      length = int(round(shortest * (longest / shortest) ** rng.random()))
+      start = rng.randrange(len(text) // 2)
+      pool.append(text[start:start + length - 1] + b"\n")
+   written = lines = 0
+   with open(filename, "wb") as corpus:
+      while written < size:
+         block = rng.choices(pool, k=1024)
+         corpus.write(b"".join(block))
+         written += sum(map(len, block))
+         lines += len(block)
+   return lines
+
+
+def best_time(command, repeat):
+   "Run command repeat times in bash, returning its best wall clock time."
+   best = None
+   for _ in range(repeat):
+      start = time.perf_counter()
+      subprocess.check_call(["bash", "-o", "pipefail", "-c", command + " > /dev/null"])
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+   return best
+
+
+def verify(command, corpus):
+   "Exit with an error unless command, run in bash, outputs corpus exactly."
+   if subprocess.call(["bash", "-o", "pipefail", "-c", "%s | cmp -s - %s" % (command, corpus)]) != 0:
+      print("benchmark.py: Fatal error: %s does not rebuild %s" % (command, corpus), file=sys.stderr)
+      sys.exit(1)
+
+
+def report(case, fmt, profile, size, m, seconds, lines):
+   "Print one line of results."
+   print("%-14s %-6s %-5s %6d %4d %9.3f %9.1f %12.0f"
+         % (case, fmt, profile, size >> 20, m, seconds, size / float(1<<20) / seconds, lines / seconds))
+   sys.stdout.flush()
+
+
+def main():
+   args = get_args()
+   workdir = tempfile.mkdtemp(prefix="stripe.py.benchmark.", dir=args.tmpdir)
+   print("%-14s %-6s %-5s %6s %4s %9s %9s %12s"
+         % ("case", "fmt", "len", "MB", "m", "seconds", "MB/s", "lines/s"))
+   try:
+      for size in args.sizes:
+         size <<= 20
+         for profile in args.lengths:
+            corpus = os.path.join(workdir, "corpus")
+            lines = make_corpus(corpus, size, profile)
+            for fmt in args.formats:
+               ext = ".gz" if fmt == "gz" else ""
+               if fmt == "gz":
+                  subprocess.check_call("gzip -c %s > %s.gz" % (corpus, corpus), shell=True)
+               if fmt == "mapped":
+                  subprocess.check_call("%s -x %s" % (args.stripe, corpus), shell=True)
+               for m in args.modulos:
+                  stripes = os.path.join(workdir, "stripe.%d" + ext)
+                  numbered = os.path.join(workdir, "numbered.%d" + ext)
+                  subprocess.check_call("%s -m %d -o %s %s" % (args.stripe, m, stripes, corpus + ext), shell=True)
+                  subprocess.check_call("%s -n -m %d -o %s %s" % (args.stripe, m, numbered, corpus + ext), shell=True)
+                  fields = {
+                     "stripe": args.stripe,
+                     "input": corpus + ext,
+                     "cat": "zcat" if fmt == "gz" else "cat",
+                     "i": m // 2,
+                     "k": m // 2 + 1,
+                     "m": m,
+                     "ext": ext,
+                     "workdir": workdir,
+                     "stripes": " ".join(stripes % s for s in range(m)),
+                     "numbered": " ".join(numbered % s for s in range(m)),
+                     "plain_stripes": " ".join(("<(zcat %s)" if fmt == "gz" else "%s") % (stripes % s) for s in range(m)),
+                  }
+                  verify("%s -r %s" % (args.stripe, fields["stripes"]), corpus)
+                  verify("%s -r -n -s %s" % (args.stripe, fields["numbered"]), corpus)
+                  for case, baseline, template in SPLIT_CASES:
+                     if case == "read" and not args.baselines:
+                        continue
+                     if case == "read" and m != args.modulos[0]:
+                        continue
+                     seconds = best_time(template.format(**fields), args.repeat)
+                     report(fields["cat"] if case == "read" else case, fmt, profile, size, m, seconds, lines)
+                     if baseline == "paste -d \\n" and lines % m:
+                        continue
+                     if baseline and args.baselines:
+                        seconds = best_time(BASELINES[baseline].format(**fields), args.repeat)
+                        report("  " + baseline, fmt, profile, size, m, seconds, lines)
+               if fmt == "gz":
+                  os.remove(corpus + ".gz")
+               if fmt == "mapped":
+                  os.remove(corpus + ".idx")
+   finally:
+      shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+   main()